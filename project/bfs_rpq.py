@@ -1,129 +1,557 @@
-from networkx import MultiDiGraph
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
 from pyformlang.finite_automaton import (
     State,
 )
 from pyformlang.regular_expression import Regex
-from scipy.sparse import lil_matrix, csr_matrix, vstack, block_diag
+from scipy.sparse import csr_matrix, vstack, block_diag, hstack
 
-from project.finite_automata_tools import graph_to_nfa, regex_to_dfa
-from project.rpq import decompose_automaton, FABooleanDecomposition
+from project.graph_matrices import (
+    OUTPUT_FORMATS,
+    GraphLike,
+    LabeledGraphMatrices,
+    as_graph_matrices,
+    pairs_output,
+)
+from project.query_stats import QueryStats
+from project.rpq import (
+    FABooleanDecomposition,
+    SearchLimits,
+    compile_regex,
+    prune_graph,
+    search_limits,
+    witness_reachability,
+)
+from project.sparse_backend import BackendLike, SparseBackend, get_backend
 
 
 def create_bfs_front(
-    graph_automation: FABooleanDecomposition,
+    graph_nodes_num: int,
     regex_automation: FABooleanDecomposition,
-    start_indexes: set,
+    start_indexes: Sequence[int],
 ):
-    buf_matrix = lil_matrix(
-        (
-            len(regex_automation.states_to_index),
-            len(graph_automation.states_to_index)
-            + len(regex_automation.states_to_index),
-        ),
+    """
+    Creates the front block for a set of start graph nodes: a row per regex state,
+    rows of regex start states have identity on the left and the start nodes on the right.
+    """
+    regex_n = len(regex_automation.states_to_index)
+    regex_starts = np.asarray(
+        [
+            regex_automation.states_to_index[state]
+            for state in regex_automation.start_states
+        ],
+        dtype=np.int64,
+    )
+    start_indexes = np.asarray(list(start_indexes), dtype=np.int64)
+    rows = np.concatenate([regex_starts, np.repeat(regex_starts, len(start_indexes))])
+    cols = np.concatenate(
+        [regex_starts, regex_n + np.tile(start_indexes, len(regex_starts))]
+    )
+    return csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)),
+        shape=(regex_n, regex_n + graph_nodes_num),
         dtype=bool,
     )
-    row = lil_matrix((1, len(graph_automation.states_to_index)), dtype=bool)
-    for i in start_indexes:
-        row[0, i] = True
-    for i in regex_automation.start_states:
-        buf_matrix[
-            regex_automation.states_to_index[i], regex_automation.states_to_index[i]
-        ] = True
-        buf_matrix[
-            regex_automation.states_to_index[i], len(regex_automation.states_to_index) :
-        ] = row
-    return buf_matrix.tocsr()
 
 
 def normalize_front(regex_bin_dec: FABooleanDecomposition, front: csr_matrix):
-    res = lil_matrix(front.shape, dtype=bool)
-    for i, j in zip(*front.nonzero()):
-        if front[
-            i, len(regex_bin_dec.states_to_index) :
-        ].count_nonzero() > 0 and j < len(regex_bin_dec.states_to_index):
-            node_number = i // len(regex_bin_dec.states_to_index)
-            res[node_number * len(regex_bin_dec.states_to_index) + j, j] = True
-            res[
-                node_number * len(regex_bin_dec.states_to_index) + j,
-                len(regex_bin_dec.states_to_index) :,
-            ] += front[i, len(regex_bin_dec.states_to_index) :]
-    return res.tocsr()
+    """
+    Moves graph parts of the front rows to the rows of the regex states they were reached with.
+    Row i of the front belongs to block i // n, where n is the number of regex states,
+    a nonzero (i, j) in the left n columns means the graph part of row i is reached in regex state j.
+    :param regex_bin_dec: The decomposition of the regex automaton.
+    :param front: The front after multiplication by the direct sum of label matrices.
+    :return: The normalized front, which has identity blocks on the left.
+    """
+    n = len(regex_bin_dec.states_to_index)
+    front = csr_matrix(front, dtype=bool)
+    regex_part = front[:, :n].tocoo()
+    graph_part = front[:, n:]
+    has_nodes = np.diff(graph_part.indptr) > 0
+    selected = has_nodes[regex_part.row]
+    rows = regex_part.row[selected]
+    targets = (rows // n) * n + regex_part.col[selected]
+    # row `target` collects graph parts of all rows moved to it
+    move = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (targets, rows)),
+        shape=(front.shape[0], front.shape[0]),
+        dtype=bool,
+    )
+    targets = np.unique(targets)
+    identity_part = csr_matrix(
+        (np.ones(len(targets), dtype=bool), (targets, targets % n)),
+        shape=(front.shape[0], n),
+        dtype=bool,
+    )
+    return hstack([identity_part, move @ graph_part], format="csr", dtype=bool)
 
 
-def bfs_rpq(
-    graph: MultiDiGraph,
-    regex: Regex,
-    start_nodes: set = None,
-    final_nodes: set = None,
-    for_each_node: bool = False,
-):
-    graph_bool_dec = decompose_automaton(graph_to_nfa(graph, start_nodes, final_nodes))
-    regex_bool_dec = decompose_automaton(regex_to_dfa(regex))
-
-    start_indexes = {
-        graph_bool_dec.states_to_index[st] for st in graph_bool_dec.start_states
-    }
-    # Create bfs front
-    front = (
-        vstack(
-            [
-                create_bfs_front(
-                    graph_bool_dec, regex_bool_dec, {graph_bool_dec.states_to_index[st]}
-                )
-                for st in graph_bool_dec.start_states
-            ]
-        )
-        if for_each_node
-        else create_bfs_front(graph_bool_dec, regex_bool_dec, start_indexes)
+def subtract_visited(
+    regex_bin_dec: FABooleanDecomposition, front: csr_matrix, visited: csr_matrix
+) -> csr_matrix:
+    """
+    Removes already visited graph nodes from a normalized front.
+    Rows left without graph nodes lose their identity part, so they would not be expanded.
+    :param regex_bin_dec: The decomposition of the regex automaton.
+    :param front: The normalized front.
+    :param visited: The normalized front of all visited product states.
+    :return: The normalized front of new product states.
+    """
+    n = len(regex_bin_dec.states_to_index)
+    graph_part = front[:, n:] > visited[:, n:]
+    rows = np.flatnonzero(np.diff(graph_part.indptr))
+    identity_part = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, rows % n)),
+        shape=(front.shape[0], n),
+        dtype=bool,
+    )
+    return hstack([identity_part, graph_part], format="csr", dtype=bool)
+
+
+def bfs_reachability(
+    graph_matrices: Dict[Any, csr_matrix],
+    graph_nodes_num: int,
+    regex_bool_dec: FABooleanDecomposition,
+    start_groups: List[Sequence[int]],
+    backend: BackendLike = None,
+    stats: QueryStats = None,
+    limits: SearchLimits = None,
+    final_mask: np.ndarray = None,
+) -> csr_matrix:
+    """
+    Runs the multiple-source BFS over the direct sums of graph and regex label matrices.
+    :param graph_matrices: Label matrices of the graph.
+    :param graph_nodes_num: The number of graph nodes.
+    :param regex_bool_dec: The decomposition of the regex automaton.
+    :param start_groups: Groups of start node indexes, every group gets its own front block.
+    :param backend: The sparse backend or its name used for front multiplications, see get_backend.
+    Fronts are normalized with scipy.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param limits: If given, the BFS stops as soon as they are reached.
+    :param final_mask: The mask of final graph nodes, required to count answers for limits with max_answers.
+    Answers are pairs (front block, node).
+    :return: The normalized front of all visited product states.
+    """
+    be = get_backend(backend)
+    front = vstack(
+        [
+            create_bfs_front(graph_nodes_num, regex_bool_dec, group)
+            for group in start_groups
+        ],
+        format="csr",
     )
 
     matrix_direct_sums = {}
 
-    for label in (
-        regex_bool_dec.decomposition.keys() & graph_bool_dec.decomposition.keys()
-    ):
-        matrix_direct_sums[label] = block_diag(
-            (regex_bool_dec.decomposition[label], graph_bool_dec.decomposition[label])
+    for label in regex_bool_dec.decomposition.keys() & graph_matrices.keys():
+        matrix_direct_sums[label] = be.from_scipy(
+            block_diag(
+                (regex_bool_dec.decomposition[label], graph_matrices[label]),
+                format="csr",
+            )
         )
 
     visited = csr_matrix(front.shape, dtype=bool)
-    is_first = True
+    regex_n = len(regex_bool_dec.states_to_index)
+    found = np.zeros(0, dtype=np.int64)
+    path_length = 0
 
-    while True:
-        prev = visited.count_nonzero()
-
-        for dec_matrix in matrix_direct_sums.values():
-            if is_first:
-                renewed_front = front @ dec_matrix
-            else:
-                renewed_front = visited @ dec_matrix
-            visited += normalize_front(regex_bool_dec, renewed_front)
-        is_first = False
-
-        if prev == visited.count_nonzero():
+    # only the newly discovered part of the front is multiplied every round
+    while front.nnz:
+        if limits is not None and limits.reached(path_length, len(found)):
+            if stats is not None:
+                stats.truncate(front[:, regex_n:].nnz)
             break
+        path_length += 1
+        renewed_front = csr_matrix(front.shape, dtype=bool)
+        front_matrix = be.from_scipy(front)
+        for dec_matrix in matrix_direct_sums.values():
+            renewed_front += normalize_front(
+                regex_bool_dec, be.to_scipy(be.matmul(front_matrix, dec_matrix))
+            )
+        front = subtract_visited(regex_bool_dec, renewed_front, visited)
+        visited += front
+        if stats is not None:
+            stats.iterations += 1
+            stats.update_peaks(
+                front[:, regex_n:].nnz, visited.data.nbytes + visited.indices.nbytes
+            )
+        if limits is not None and limits.max_answers is not None:
+            blocks, nodes = accepted_pairs(regex_bool_dec, front, final_mask)
+            found = np.union1d(found, blocks * graph_nodes_num + nodes)
+    if stats is not None:
+        stats.visited_states += visited[:, regex_n:].nnz
+    return visited
+
+
+def accepted_pairs(
+    regex_bool_dec: FABooleanDecomposition,
+    visited: csr_matrix,
+    final_mask: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: Arrays of front block numbers and graph node indexes reached in a final regex state.
+    """
+    regex_n = len(regex_bool_dec.states_to_index)
+    regex_final_mask = np.zeros(regex_n, dtype=bool)
+    regex_final_mask[
+        [regex_bool_dec.states_to_index[state] for state in regex_bool_dec.final_states]
+    ] = True
+    rows, cols = visited[:, regex_n:].nonzero()
+    accepted = regex_final_mask[rows % regex_n] & final_mask[cols]
+    return rows[accepted] // regex_n, cols[accepted]
+
+
+def share_matrices(
+    matrices: Dict[Any, csr_matrix]
+) -> Tuple[List[SharedMemory], Dict[Any, tuple]]:
+    """
+    Copies index arrays of boolean CSR matrices to shared memory.
+    :return: Shared memory blocks, which must be closed and unlinked by the caller,
+    and descriptors which can be passed to other processes to attach the matrices.
+    """
+    blocks = []
+    descriptors = {}
+    for label, matrix in matrices.items():
+        arrays = []
+        for array in (matrix.indptr, matrix.indices):
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+            blocks.append(block)
+            arrays.append((block.name, array.shape, array.dtype.str))
+        descriptors[label] = (matrix.shape, arrays[0], arrays[1])
+    return blocks, descriptors
+
+
+def attach_matrices(
+    descriptors: Dict[Any, tuple]
+) -> Tuple[List[SharedMemory], Dict[Any, csr_matrix]]:
+    """
+    Attaches matrices shared by share_matrices without copying their index arrays.
+    :return: Attached shared memory blocks, which must be closed by the caller, and the matrices.
+    """
+    blocks = []
+    matrices = {}
+    for label, (shape, indptr, indices) in descriptors.items():
+        arrays = []
+        for name, array_shape, dtype in (indptr, indices):
+            block = SharedMemory(name=name)
+            blocks.append(block)
+            arrays.append(np.ndarray(array_shape, np.dtype(dtype), buffer=block.buf))
+        matrices[label] = csr_matrix(
+            (np.ones(len(arrays[1]), dtype=bool), arrays[1], arrays[0]),
+            shape=shape,
+            copy=False,
+        )
+    return blocks, matrices
+
+
+def state_indexes(
+    regex_bool_dec: FABooleanDecomposition,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: Arrays of indexes of the start and the final regex states.
+    """
+    return tuple(
+        np.asarray(
+            sorted(regex_bool_dec.states_to_index[state] for state in states),
+            dtype=np.int64,
+        )
+        for states in (regex_bool_dec.start_states, regex_bool_dec.final_states)
+    )
+
+
+def indexed_decomposition(
+    regex_matrices: Dict[Any, csr_matrix],
+    states_num: int,
+    start_indexes: np.ndarray,
+    final_indexes: np.ndarray,
+) -> FABooleanDecomposition:
+    """
+    Builds the decomposition whose states are their own indexes. States of pyformlang automata cache hashes
+    of their values, which are not valid in processes with another hash seed, so only label matrices
+    and integer state indexes are sent to workers.
+    """
+    return FABooleanDecomposition(
+        set(np.asarray(start_indexes).tolist()),
+        set(np.asarray(final_indexes).tolist()),
+        {i: i for i in range(states_num)},
+        regex_matrices,
+    )
 
-    res = set()
-    graph_index_to_state = {v: k for k, v in graph_bool_dec.states_to_index.items()}
-    regex_index_to_state = {v: k for k, v in regex_bool_dec.states_to_index.items()}
-    for i, j in zip(*visited.nonzero()):
-        if (
-            len(regex_bool_dec.states_to_index) <= +j
-            and graph_index_to_state[j - len(regex_bool_dec.states_to_index)]
-            in graph_bool_dec.final_states
-            and regex_index_to_state[i % len(regex_bool_dec.states_to_index)]
-            in regex_bool_dec.final_states
-        ):
-            state_index = j - len(regex_bool_dec.states_to_index)
-            if graph_index_to_state[state_index] in graph_bool_dec.final_states:
-                if for_each_node:
-                    res.add(
-                        (
-                            State(i // len(regex_bool_dec.states_to_index)),
-                            State(state_index),
-                        )
-                    )
-                else:
-                    res.add(State(state_index))
-
-    return res
+
+_worker_state = {}
+
+
+def _init_worker(
+    descriptors: Dict[Any, tuple],
+    graph_nodes_num: int,
+    regex_matrices: Dict[Any, csr_matrix],
+    regex_states_num: int,
+    regex_start_indexes: np.ndarray,
+    regex_final_indexes: np.ndarray,
+    final_mask: np.ndarray,
+    backend: SparseBackend,
+    limits: SearchLimits,
+):
+    blocks, matrices = attach_matrices(descriptors)
+    _worker_state.update(
+        blocks=blocks,
+        matrices=matrices,
+        graph_nodes_num=graph_nodes_num,
+        regex_bool_dec=indexed_decomposition(
+            regex_matrices,
+            regex_states_num,
+            regex_start_indexes,
+            regex_final_indexes,
+        ),
+        final_mask=final_mask,
+        backend=backend,
+        limits=limits,
+    )
+
+
+def _run_chunk(offset: int, chunk: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    visited = bfs_reachability(
+        _worker_state["matrices"],
+        _worker_state["graph_nodes_num"],
+        _worker_state["regex_bool_dec"],
+        [[index] for index in chunk],
+        _worker_state["backend"],
+        limits=_worker_state["limits"],
+    )
+    blocks, nodes = accepted_pairs(
+        _worker_state["regex_bool_dec"], visited, _worker_state["final_mask"]
+    )
+    return blocks + offset, nodes
+
+
+def _chunks_reachability(
+    graph_matrices: LabeledGraphMatrices,
+    regex_bool_dec: FABooleanDecomposition,
+    chunk_size: int,
+    workers: int = None,
+    backend: BackendLike = None,
+    stats: QueryStats = None,
+    limits: SearchLimits = None,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Evaluates chunks of start vertices and yields pairs (start_vertex_numbers, reachable_vertex_indexes) per chunk.
+    Stats are filled and limits with max_answers are supported only without workers.
+    """
+    backend = get_backend(backend)
+    start_indexes = graph_matrices.start_indexes
+    chunks = [
+        (offset, start_indexes[offset : offset + chunk_size])
+        for offset in range(0, len(start_indexes), chunk_size)
+    ]
+
+    if workers is None:
+        remaining = limits.max_answers if limits is not None else None
+        for offset, chunk in chunks:
+            if remaining is not None and remaining <= 0:
+                # the rest of chunks is not searched at all
+                if stats is not None:
+                    stats.truncate(0)
+                return
+            chunk_limits = (
+                None
+                if limits is None
+                else SearchLimits(limits.max_path_length, remaining)
+            )
+            visited = bfs_reachability(
+                graph_matrices.matrices,
+                graph_matrices.nodes_num,
+                regex_bool_dec,
+                [[index] for index in chunk],
+                backend,
+                stats,
+                chunk_limits,
+                graph_matrices.final_mask,
+            )
+            blocks, nodes = accepted_pairs(
+                regex_bool_dec, visited, graph_matrices.final_mask
+            )
+            if remaining is not None:
+                remaining -= len(np.unique(blocks * graph_matrices.nodes_num + nodes))
+            yield blocks + offset, nodes
+        return
+    if limits is not None and limits.max_answers is not None:
+        raise ValueError("stop_when_found is not supported with workers")
+
+    shared_blocks, descriptors = share_matrices(graph_matrices.matrices)
+    regex_start_indexes, regex_final_indexes = state_indexes(regex_bool_dec)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(
+                descriptors,
+                graph_matrices.nodes_num,
+                regex_bool_dec.decomposition,
+                len(regex_bool_dec.states_to_index),
+                regex_start_indexes,
+                regex_final_indexes,
+                graph_matrices.final_mask,
+                backend,
+                limits,
+            ),
+        ) as executor:
+            futures = [
+                executor.submit(_run_chunk, offset, chunk) for offset, chunk in chunks
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
+
+
+def _pruned(
+    graph_matrices: LabeledGraphMatrices,
+    regex_bool_dec: FABooleanDecomposition,
+    prune: bool,
+) -> Tuple[LabeledGraphMatrices, np.ndarray]:
+    if prune:
+        return prune_graph(graph_matrices, regex_bool_dec.decomposition.keys())
+    return graph_matrices, np.arange(graph_matrices.nodes_num)
+
+
+def _for_each_output(
+    graph_matrices: LabeledGraphMatrices,
+    blocks: np.ndarray,
+    nodes: np.ndarray,
+    output: str,
+):
+    if output == "set":
+        return {
+            (State(int(block)), graph_matrices.nodes[node])
+            for block, node in zip(blocks, nodes)
+        }
+    return pairs_output(
+        graph_matrices, graph_matrices.start_indexes[blocks], nodes, output
+    )
+
+
+def bfs_rpq_chunks(
+    graph: GraphLike,
+    regex: Regex,
+    start_nodes: set = None,
+    final_nodes: set = None,
+    chunk_size: int = 1024,
+    workers: int = None,
+    output: str = "set",
+    backend: BackendLike = None,
+    prune: bool = True,
+) -> Iterator:
+    """
+    Computes reachable vertices for each start vertex, splitting start vertices into chunks.
+    Every chunk is evaluated independently, so only one chunk front per worker is kept in memory.
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
+    :param regex: The regular expression
+    :param start_nodes: The set of start vertices. If None, all vertices would be considered as start vertices.
+    :param final_nodes: The set of final vertices. If None, all vertices would be considered as final vertices.
+    :param chunk_size: The number of start vertices in a chunk.
+    :param workers: The number of worker processes. If None, chunks are evaluated in the current process.
+    Label matrices are passed to the workers through shared memory.
+    :param output: The per-chunk output format, see bfs_rpq.
+    :param backend: The sparse backend or its name, see get_backend.
+    :param prune: If True, the BFS runs over the graph pruned by prune_graph.
+    :return: Iterator over per-chunk results. Chunks are yielded in the order of completion.
+    """
+    if output not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format: " + str(output))
+    graph_matrices = as_graph_matrices(graph, start_nodes, final_nodes)
+    regex_bool_dec = compile_regex(regex).decomposition
+    pruned, kept = _pruned(graph_matrices, regex_bool_dec, prune)
+    for blocks, nodes in _chunks_reachability(
+        pruned, regex_bool_dec, chunk_size, workers, backend
+    ):
+        yield _for_each_output(graph_matrices, blocks, kept[nodes], output)
+
+
+def bfs_rpq(
+    graph: GraphLike,
+    regex: Regex,
+    start_nodes: set = None,
+    final_nodes: set = None,
+    for_each_node: bool = False,
+    chunk_size: int = None,
+    workers: int = None,
+    output: str = "set",
+    backend: BackendLike = None,
+    prune: bool = True,
+    stats: QueryStats = None,
+    max_path_length: int = None,
+    stop_when_found: Any = None,
+):
+    """
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
+    :param regex: The regular expression
+    :param start_nodes: The set of start vertices. If None, all vertices would be considered as start vertices.
+    :param final_nodes: The set of final vertices. If None, all vertices would be considered as final vertices.
+    :param for_each_node: If True, reachable vertices are computed for each start vertex separately.
+    :param chunk_size: If given with for_each_node, start vertices are processed in chunks of this size.
+    :param workers: If given with for_each_node, chunks are processed by this number of processes.
+    :param output: "set" or, with for_each_node only, one of the pairs_output formats ("pairs", "matrix", "result")
+    over pairs (start_vertex, reachable_vertex), or "witnesses" for PathWitnesses with a shortest path of every pair.
+    :param backend: The sparse backend or its name, see get_backend.
+    :param prune: If True, the BFS runs over the graph pruned by prune_graph.
+    :param stats: If given, it would be filled with the evaluation statistics. It is not filled by workers.
+    :param max_path_length: If given, only paths with at most this number of edges are considered.
+    :param stop_when_found: If given, the BFS stops early, see rpq. Answers are reachable vertices,
+    or pairs if for_each_node, and at most that number of them is returned. Not supported with workers.
+    :return: Set of reachable final vertices. If for_each_node, set of pairs (start_vertex_number, reachable_vertex),
+    where start_vertex_number is the position of the start vertex in the ascending order of start vertex indexes.
+    """
+    if output not in OUTPUT_FORMATS and output != "witnesses":
+        raise ValueError("Unknown output format: " + str(output))
+    if output != "set" and not for_each_node:
+        raise ValueError("Output format " + output + " requires for_each_node")
+    limits, start_nodes, final_nodes = search_limits(
+        max_path_length, stop_when_found, start_nodes, final_nodes
+    )
+    if limits.max_answers is not None and workers is not None:
+        raise ValueError("stop_when_found is not supported with workers")
+    graph_matrices = as_graph_matrices(graph, start_nodes, final_nodes)
+    regex_bool_dec = compile_regex(regex).decomposition
+    if output == "witnesses":
+        return witness_reachability(graph_matrices, regex_bool_dec, stats, limits)
+    pruned, kept = _pruned(graph_matrices, regex_bool_dec, prune)
+    if for_each_node:
+        chunks = list(
+            _chunks_reachability(
+                pruned,
+                regex_bool_dec,
+                chunk_size or max(len(pruned.start_indexes), 1),
+                workers,
+                backend,
+                stats,
+                limits,
+            )
+        )
+        empty = [np.zeros(0, dtype=np.int64)]
+        blocks = np.concatenate(empty + [blocks for blocks, _ in chunks])
+        nodes = np.concatenate(empty + [nodes for _, nodes in chunks])
+        blocks, nodes = limits.first_answers(
+            blocks, kept[nodes], graph_matrices.nodes_num
+        )
+        return _for_each_output(graph_matrices, blocks, nodes, output)
+
+    visited = bfs_reachability(
+        pruned.matrices,
+        pruned.nodes_num,
+        regex_bool_dec,
+        [pruned.start_indexes],
+        backend,
+        stats,
+        limits,
+        pruned.final_mask,
+    )
+    _, nodes = accepted_pairs(regex_bool_dec, visited, pruned.final_mask)
+    _, nodes = limits.first_answers(np.zeros_like(nodes), nodes, pruned.nodes_num)
+    return {pruned.nodes[node] for node in nodes}
@@ -1,13 +1,15 @@
 from typing import Set
 
-import networkx as nx
 from pyformlang.finite_automaton import (
     DeterministicFiniteAutomaton,
     NondeterministicFiniteAutomaton,
-    EpsilonNFA,
+    State,
 )
+from pyformlang.finite_automaton.finite_automaton import to_symbol
 from pyformlang.regular_expression import Regex
 
+from project.graph_matrices import GraphLike, as_graph_matrices
+
 
 def regex_to_dfa(regex: Regex) -> DeterministicFiniteAutomaton:
     """
@@ -19,42 +21,31 @@ def regex_to_dfa(regex: Regex) -> DeterministicFiniteAutomaton:
 
 
 def graph_to_nfa(
-    graph: nx.MultiDiGraph, start_states: Set[int] = None, final_states: Set[int] = None
+    graph: GraphLike, start_states: Set[int] = None, final_states: Set[int] = None
 ) -> NondeterministicFiniteAutomaton:
     """
-    Convert a networkx MultiDiGraph to a NondeterministicFiniteAutomaton
-    :param start_states: The start states of the graph. If None, all nodes would be considered as start states.
-    :param final_states: The final states of the graph. If None, all nodes would be considered as final states.
-    :param graph: The graph to convert. Transitions must be labeled with strings. Transitions with no label would be ignored.
+    Convert a networkx MultiDiGraph or LabeledGraphMatrices to a NondeterministicFiniteAutomaton.
+    The graph is not modified, so one graph can be shared by concurrent queries.
+    :param start_states: The start states of the graph. If None, all nodes would be considered as start states
+    (the graph's own start nodes for LabeledGraphMatrices).
+    :param final_states: The final states of the graph. If None, all nodes would be considered as final states
+    (the graph's own final nodes for LabeledGraphMatrices).
+    :param graph: The graph to convert. Transitions must be labeled with strings. Transitions with no label would be ignored,
+    epsilon transitions are folded, see LabeledGraphMatrices.remove_epsilon_edges.
     Start and final states must be passed using start_states and final_states parameters. Keys of the graph nodes would not be used for this purpose.
     :return: The NondeterministicFiniteAutomaton
     """
-    # Set start and final states of graph to false
-
-    for node in graph.nodes(data="is_start"):
-        graph.nodes[node[0]]["is_start"] = False
-    for node in graph.nodes(data="is_final"):
-        graph.nodes[node[0]]["is_final"] = False
-
-    # Set start and final states of graph to true if they are in start_states or final_states.
-    # If start_states or final_states is None, all nodes would be considered as start or final states respectively.
-
-    if start_states is not None and start_states != set():
-        for node in start_states:
-            graph.nodes[node]["is_start"] = True
-    else:
-        for node in graph.nodes:
-            if node in graph.nodes:
-                graph.nodes[node]["is_start"] = True
-
-    if final_states is not None and final_states != set():
-        for node in final_states:
-            if node in graph.nodes:
-                graph.nodes[node]["is_final"] = True
-    else:
-        for node in graph.nodes:
-            graph.nodes[node]["is_final"] = True
-
-    # Return NFA
-
-    return EpsilonNFA().from_networkx(graph).remove_epsilon_transitions()
+    graph_matrices = as_graph_matrices(graph, start_states, final_states)
+    states = [State(node) for node in graph_matrices.nodes]
+    automaton = NondeterministicFiniteAutomaton()
+    for label, matrix in graph_matrices.matrices.items():
+        rows, cols = matrix.nonzero()
+        symbol = to_symbol(label)
+        automaton.add_transitions(
+            [(states[u], symbol, states[v]) for u, v in zip(rows, cols)]
+        )
+    for i in graph_matrices.start_indexes:
+        automaton.add_start_state(states[i])
+    for i in graph_matrices.final_indexes:
+        automaton.add_final_state(states[i])
+    return automaton
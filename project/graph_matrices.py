@@ -0,0 +1,425 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+import numpy as np
+from networkx import MultiDiGraph
+from pyformlang.finite_automaton import Epsilon
+from pyformlang.finite_automaton.finite_automaton import to_symbol
+from scipy.sparse import csr_matrix, identity, issparse
+
+from project.reachability_result import ReachabilityResult, nodes_array
+
+
+def to_bool_csr(matrix) -> csr_matrix:
+    """
+    Converts a sparse or dense matrix to a boolean CSR matrix without explicit zeros.
+    All matrices of the boolean semiring are stored this way: bool data is 8 times smaller than float64 and
+    bool matmul saturates instead of counting paths. A boolean CSR matrix is returned as is, without copying.
+    """
+    if not issparse(matrix):
+        return csr_matrix(np.asarray(matrix) != 0)
+    matrix = matrix.tocsr()
+    if matrix.dtype == bool:
+        return matrix
+    matrix = matrix.astype(bool)
+    matrix.eliminate_zeros()
+    return matrix
+
+
+@dataclass
+class LabeledGraphMatrices:
+    """
+    Edge-labeled graph stored as one boolean CSR adjacency matrix per label.
+    Nodes are numbered 0..n-1 in the order of `nodes`, start and final nodes are stored as boolean masks.
+    """
+
+    nodes: List[Any] = field(default_factory=list)
+    node_to_index: Dict[Any, int] = field(default_factory=dict)
+    matrices: Dict[Any, csr_matrix] = field(default_factory=dict)
+    start_mask: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=bool))
+    final_mask: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=bool))
+    # label -> boolean mask of nodes incident to its edges, filled lazily and shared by views of the same graph
+    label_index: Dict[Any, np.ndarray] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+    # label -> transposed label matrix for backward traversals, filled lazily and shared like label_index
+    transposed_matrices: Dict[Any, csr_matrix] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+    # reflexive transitive closure of the epsilon edges folded by remove_epsilon_edges, None if there were none
+    epsilon_closure: csr_matrix = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        # masks left empty mark all nodes, as None start and final nodes do elsewhere
+        if len(self.start_mask) == 0:
+            self.start_mask = np.ones(self.nodes_num, dtype=bool)
+        if len(self.final_mask) == 0:
+            self.final_mask = np.ones(self.nodes_num, dtype=bool)
+        for label, matrix in self.matrices.items():
+            if not isinstance(matrix, csr_matrix) or matrix.dtype != bool:
+                self.matrices[label] = to_bool_csr(matrix)
+
+    @property
+    def nodes_num(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def nodes_array(self) -> np.ndarray:
+        """
+        Nodes as a NumPy array, see reachability_result.nodes_array.
+        """
+        return nodes_array(self.nodes)
+
+    @property
+    def labels(self) -> Set[Any]:
+        return set(self.matrices.keys())
+
+    @property
+    def start_indexes(self) -> np.ndarray:
+        return np.flatnonzero(self.start_mask)
+
+    @property
+    def final_indexes(self) -> np.ndarray:
+        return np.flatnonzero(self.final_mask)
+
+    def start_nodes(self) -> Set[Any]:
+        return {self.nodes[i] for i in self.start_indexes}
+
+    def final_nodes(self) -> Set[Any]:
+        return {self.nodes[i] for i in self.final_indexes}
+
+    def nodes_mask(self, nodes: Set[Any] = None) -> np.ndarray:
+        """
+        Builds a boolean mask of the given nodes. Nodes which are not in the graph are ignored.
+        :param nodes: The set of nodes. If None or empty, all nodes would be marked.
+        :return: The boolean mask of length nodes_num
+        """
+        if nodes is None or len(nodes) == 0:
+            return np.ones(self.nodes_num, dtype=bool)
+        return self.subset_mask(nodes)
+
+    def subset_mask(self, nodes: Iterable[Any]) -> np.ndarray:
+        """
+        Builds a boolean mask of exactly the given nodes. Nodes which are not in the graph are ignored.
+        """
+        mask = np.zeros(self.nodes_num, dtype=bool)
+        indexes = [
+            self.node_to_index[node] for node in nodes if node in self.node_to_index
+        ]
+        mask[indexes] = True
+        return mask
+
+    def closed_start_mask(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Extends a mask of start nodes with their epsilon closures, see remove_epsilon_edges.
+        """
+        if self.epsilon_closure is None:
+            return mask
+        closed = np.zeros(self.nodes_num, dtype=bool)
+        closed[self.epsilon_closure[np.flatnonzero(mask)].indices] = True
+        return closed
+
+    def closed_final_mask(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Extends a mask of final nodes with the nodes whose epsilon closures have a final node, see remove_epsilon_edges.
+        """
+        if self.epsilon_closure is None:
+            return mask
+        return np.diff(self.epsilon_closure[:, np.flatnonzero(mask)].indptr) > 0
+
+    def with_start_final(
+        self, start_nodes: Set[Any] = None, final_nodes: Set[Any] = None
+    ) -> "LabeledGraphMatrices":
+        """
+        Returns the same graph with other start and final nodes. Label matrices are shared, not copied.
+        Folded epsilon edges are taken into account, see closed_start_mask and closed_final_mask.
+        :param start_nodes: The start nodes. If None or empty, all nodes would be considered as start nodes.
+        :param final_nodes: The final nodes. If None or empty, all nodes would be considered as final nodes.
+        """
+        return LabeledGraphMatrices(
+            self.nodes,
+            self.node_to_index,
+            self.matrices,
+            self.closed_start_mask(self.nodes_mask(start_nodes)),
+            self.closed_final_mask(self.nodes_mask(final_nodes)),
+            self.label_index,
+            self.transposed_matrices,
+            self.epsilon_closure,
+        )
+
+    def transposed(self, label: Any) -> csr_matrix:
+        """
+        :return: The transposed adjacency matrix of the label in CSR format, computed once per graph.
+        """
+        if label not in self.transposed_matrices:
+            self.transposed_matrices[label] = self.matrices[label].T.tocsr()
+        return self.transposed_matrices[label]
+
+    def incident_mask(self, labels: Iterable[Any]) -> np.ndarray:
+        """
+        Builds a boolean mask of nodes incident to edges with the given labels.
+        :param labels: The labels. Labels which are not in the graph are ignored.
+        :return: The boolean mask of length nodes_num
+        """
+        mask = np.zeros(self.nodes_num, dtype=bool)
+        for label in self.labels & set(labels):
+            if label not in self.label_index:
+                matrix = self.matrices[label]
+                incident = np.diff(matrix.indptr) > 0
+                incident[matrix.indices] = True
+                self.label_index[label] = incident
+            mask |= self.label_index[label]
+        return mask
+
+    def remove_epsilon_edges(self) -> "LabeledGraphMatrices":
+        """
+        Folds edges labeled with epsilon into the other labels, as EpsilonNFA.remove_epsilon_transitions does:
+        a node gets an edge if a node of its epsilon closure has one, it becomes final if its epsilon closure
+        has a final node, and the epsilon closures of the start nodes become start nodes.
+        The closure is kept in epsilon_closure to apply it to start and final nodes given later.
+        :return: The graph without epsilon labels, or the graph itself if it has none.
+        """
+        epsilon_labels = {
+            label for label in self.matrices if isinstance(to_symbol(label), Epsilon)
+        }
+        if not epsilon_labels:
+            return self
+        closure = identity(self.nodes_num, dtype=bool, format="csr")
+        for label in epsilon_labels:
+            closure = closure + self.matrices[label]
+        # the closure is reflexive, so squaring only grows it until the fixpoint
+        while True:
+            squared = closure @ closure
+            if squared.nnz == closure.nnz:
+                break
+            closure = squared
+        graph_matrices = LabeledGraphMatrices(
+            self.nodes,
+            self.node_to_index,
+            {
+                label: to_bool_csr(closure @ matrix)
+                for label, matrix in self.matrices.items()
+                if label not in epsilon_labels
+            },
+            epsilon_closure=closure,
+        )
+        graph_matrices.start_mask = graph_matrices.closed_start_mask(self.start_mask)
+        graph_matrices.final_mask = graph_matrices.closed_final_mask(self.final_mask)
+        return graph_matrices
+
+    def subgraph(
+        self, indexes: np.ndarray, labels: Iterable[Any] = None
+    ) -> "LabeledGraphMatrices":
+        """
+        Returns the subgraph induced by the given nodes. Start and final masks are restricted to them.
+        :param indexes: Ascending indexes of the kept nodes.
+        :param labels: The kept labels. If None, all labels are kept.
+        :return: The LabeledGraphMatrices, node i of which is node indexes[i] of this graph.
+        """
+        labels = self.labels if labels is None else self.labels & set(labels)
+        if len(indexes) == self.nodes_num:
+            return LabeledGraphMatrices(
+                self.nodes,
+                self.node_to_index,
+                {label: self.matrices[label] for label in labels},
+                self.start_mask,
+                self.final_mask,
+                self.label_index,
+                self.transposed_matrices,
+                self.epsilon_closure,
+            )
+        nodes = [self.nodes[i] for i in indexes]
+        return LabeledGraphMatrices(
+            nodes,
+            {node: i for i, node in enumerate(nodes)},
+            {label: self.matrices[label][indexes][:, indexes] for label in labels},
+            self.start_mask[indexes],
+            self.final_mask[indexes],
+            # the closure is transitive, so its restriction keeps epsilon paths through dropped nodes
+            epsilon_closure=(
+                None
+                if self.epsilon_closure is None
+                else self.epsilon_closure[indexes][:, indexes]
+            ),
+        )
+
+    @classmethod
+    def from_edges(
+        cls,
+        edges: Iterable[Tuple[Any, Any, Any]],
+        start_nodes: Set[Any] = None,
+        final_nodes: Set[Any] = None,
+        nodes: Iterable[Any] = None,
+    ) -> "LabeledGraphMatrices":
+        """
+        Builds label matrices from an edge list.
+        :param edges: Triples (from_node, label, to_node). Edges with None label would be ignored,
+        edges labeled with epsilon are folded into the other labels, see remove_epsilon_edges.
+        :param start_nodes: The start nodes. If None or empty, all nodes would be considered as start nodes.
+        :param final_nodes: The final nodes. If None or empty, all nodes would be considered as final nodes.
+        :param nodes: The nodes of the graph in the order of their indexes. If None, nodes would be taken from edges.
+        :return: The LabeledGraphMatrices
+        """
+        node_to_index = {}
+        if nodes is not None:
+            for node in nodes:
+                node_to_index.setdefault(node, len(node_to_index))
+
+        label_to_code = {}
+        rows, cols, codes = [], [], []
+        for u, label, v in edges:
+            if u not in node_to_index:
+                node_to_index[u] = len(node_to_index)
+            if v not in node_to_index:
+                node_to_index[v] = len(node_to_index)
+            if label is None:
+                continue
+            rows.append(node_to_index[u])
+            cols.append(node_to_index[v])
+            codes.append(label_to_code.setdefault(label, len(label_to_code)))
+
+        n = len(node_to_index)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        codes = np.asarray(codes, dtype=np.int64)
+        # group edges by label with one sort instead of per-label python lists
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(label_to_code) + 1))
+        matrices = {}
+        for label, code in label_to_code.items():
+            selected = order[bounds[code] : bounds[code + 1]]
+            matrices[label] = csr_matrix(
+                (
+                    np.ones(len(selected), dtype=bool),
+                    (rows[selected], cols[selected]),
+                ),
+                shape=(n, n),
+                dtype=bool,
+            )
+
+        graph_matrices = cls(list(node_to_index.keys()), node_to_index, matrices)
+        graph_matrices.start_mask = graph_matrices.nodes_mask(start_nodes)
+        graph_matrices.final_mask = graph_matrices.nodes_mask(final_nodes)
+        return graph_matrices.remove_epsilon_edges()
+
+    @classmethod
+    def from_graph(
+        cls,
+        graph: MultiDiGraph,
+        start_nodes: Set[Any] = None,
+        final_nodes: Set[Any] = None,
+    ) -> "LabeledGraphMatrices":
+        """
+        Builds label matrices from a networkx MultiDiGraph. The graph is not modified.
+        :param graph: The graph. Edges with no label would be ignored, epsilon edges are folded, see from_edges.
+        :param start_nodes: The start nodes. If None or empty, all nodes would be considered as start nodes.
+        :param final_nodes: The final nodes. If None or empty, all nodes would be considered as final nodes.
+        :return: The LabeledGraphMatrices
+        """
+        return cls.from_edges(
+            ((u, label, v) for u, v, label in graph.edges(data="label")),
+            start_nodes,
+            final_nodes,
+            nodes=graph.nodes,
+        )
+
+
+GraphLike = Union[MultiDiGraph, LabeledGraphMatrices]
+
+OUTPUT_FORMATS = ("set", "pairs", "matrix", "result")
+
+
+def pairs_output(
+    graph_matrices: LabeledGraphMatrices,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    output: str = "set",
+):
+    """
+    Converts pairs of node indexes to the requested output format.
+    :param graph_matrices: The graph the indexes belong to.
+    :param rows: Indexes of the first nodes of pairs.
+    :param cols: Indexes of the second nodes of pairs.
+    :param output: "set" for a set of node pairs, "pairs" for a NumPy array of shape (k, 2) of node pairs,
+    "matrix" for a boolean CSR matrix over node indexes, "result" for a ReachabilityResult.
+    """
+    n = graph_matrices.nodes_num
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if output == "matrix":
+        return csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n), dtype=bool
+        )
+    if output == "result":
+        return ReachabilityResult(graph_matrices.nodes, rows, cols)
+    if output == "pairs":
+        keys = np.unique(rows * n + cols)
+        return graph_matrices.nodes_array[np.stack([keys // n, keys % n], axis=1)]
+    if output == "set":
+        nodes = graph_matrices.nodes
+        return {(nodes[i], nodes[j]) for i, j in zip(rows, cols)}
+    raise ValueError("Unknown output format: " + str(output))
+
+
+def as_graph_matrices(
+    graph: GraphLike, start_nodes: Set[Any] = None, final_nodes: Set[Any] = None
+) -> LabeledGraphMatrices:
+    """
+    Converts a graph to LabeledGraphMatrices if needed.
+    :param graph: The MultiDiGraph or LabeledGraphMatrices.
+    :param start_nodes: The start nodes. If None, the graph's own start nodes are kept (all nodes for MultiDiGraph).
+    :param final_nodes: The final nodes. If None, the graph's own final nodes are kept (all nodes for MultiDiGraph).
+    :return: The LabeledGraphMatrices
+    """
+    if not isinstance(graph, LabeledGraphMatrices):
+        return LabeledGraphMatrices.from_graph(graph, start_nodes, final_nodes)
+    if start_nodes is None and final_nodes is None:
+        return graph
+    return LabeledGraphMatrices(
+        graph.nodes,
+        graph.node_to_index,
+        graph.matrices,
+        (
+            graph.start_mask
+            if start_nodes is None
+            else graph.closed_start_mask(graph.nodes_mask(start_nodes))
+        ),
+        (
+            graph.final_mask
+            if final_nodes is None
+            else graph.closed_final_mask(graph.nodes_mask(final_nodes))
+        ),
+        graph.label_index,
+        graph.transposed_matrices,
+        graph.epsilon_closure,
+    )
+
+
+def matrix_pairs_output(
+    graph_matrices: LabeledGraphMatrices,
+    matrix: csr_matrix,
+    start_nodes: Set[Any] = None,
+    final_nodes: Set[Any] = None,
+    output: str = "set",
+):
+    """
+    Reads pairs from the nonzero entries of a node adjacency matrix.
+    :param graph_matrices: The graph the matrix belongs to.
+    :param matrix: The boolean matrix over node indexes.
+    :param start_nodes: The allowed first nodes. If None, the graph's start nodes are used.
+    :param final_nodes: The allowed second nodes. If None, the graph's final nodes are used.
+    :param output: The output format, see pairs_output.
+    """
+    start_mask = (
+        graph_matrices.start_mask
+        if start_nodes is None
+        else graph_matrices.closed_start_mask(graph_matrices.subset_mask(start_nodes))
+    )
+    final_mask = (
+        graph_matrices.final_mask
+        if final_nodes is None
+        else graph_matrices.closed_final_mask(graph_matrices.subset_mask(final_nodes))
+    )
+    rows, cols = matrix.nonzero()
+    selected = start_mask[rows] & final_mask[cols]
+    return pairs_output(graph_matrices, rows[selected], cols[selected], output)
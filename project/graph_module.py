@@ -1,12 +1,374 @@
-from typing import Tuple
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Tuple, Union
 
 import cfpq_data
 import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, load_npz, save_npz
 
+from project.graph_matrices import LabeledGraphMatrices
 
-def get_graph(name: str) -> nx.MultiDiGraph:
-    gr_path = cfpq_data.download(name)
-    return cfpq_data.graph_from_csv(gr_path)
+# Directory of the decomposed graphs cache. Can be overridden with this environment variable.
+GRAPH_CACHE_ENV = "CFPQ_GRAPH_CACHE"
+DEFAULT_GRAPH_CACHE_DIR = Path.home() / ".cache" / "cfpq_graphs"
+
+
+def graph_cache_path(name: str, cache_dir: Union[str, Path] = None) -> Path:
+    """
+    :param name: The name of the cfpq_data graph.
+    :param cache_dir: The cache directory. If None, the GRAPH_CACHE_ENV variable or DEFAULT_GRAPH_CACHE_DIR is used.
+    :return: The cache entry directory of the graph for the installed cfpq_data version.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(GRAPH_CACHE_ENV, DEFAULT_GRAPH_CACHE_DIR)
+    return Path(cache_dir) / f"{name}-{cfpq_data.__version__}"
+
+
+# Number of CSV rows read at once by the streaming loader
+CSV_CHUNK_SIZE = 1 << 20
+
+
+def _index_dtype(nnz: int, nodes_num: int):
+    # indptr and indices share a dtype so scipy does not copy memory-mapped arrays
+    return np.int32 if max(nnz, nodes_num) < np.iinfo(np.int32).max else np.int64
+
+
+@contextmanager
+def _atomic_directory(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=path.parent, prefix=path.name + "."))
+    try:
+        yield tmp_path
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+
+
+def _save_nodes_meta(
+    path: Path,
+    labels: List[Any],
+    nodes: List[Any],
+    start_mask: np.ndarray,
+    final_mask: np.ndarray,
+):
+    nodes_array = np.asarray(nodes)
+    numeric_nodes = nodes_array.ndim == 1 and nodes_array.dtype.kind in "biuf"
+    if numeric_nodes:
+        np.save(path / "nodes.npy", nodes_array)
+    np.save(path / "start_mask.npy", start_mask)
+    np.save(path / "final_mask.npy", final_mask)
+    with open(path / "meta.json", "w") as f:
+        json.dump({"labels": labels, "nodes": None if numeric_nodes else nodes}, f)
+
+
+def save_graph_matrices(graph_matrices: LabeledGraphMatrices, path: Union[str, Path]):
+    """
+    Saves label matrices to a directory of .npy files. The directory is written atomically.
+    Row pointers of all labels are stacked into one (labels, nodes + 1) array, column indexes of all labels
+    are concatenated into one array split by label offsets.
+    Nodes must be scalars, labels and nodes of non-numeric types must be JSON serializable.
+    The closure of folded epsilon edges, if any, is saved as well.
+    """
+    labels = list(graph_matrices.matrices.keys())
+    matrices = [graph_matrices.matrices[label].tocsr() for label in labels]
+    for matrix in matrices:
+        matrix.sum_duplicates()
+    offsets = np.cumsum([0] + [matrix.nnz for matrix in matrices])
+    dtype = _index_dtype(int(offsets[-1]), graph_matrices.nodes_num)
+    indptr = np.zeros((len(labels), graph_matrices.nodes_num + 1), dtype=dtype)
+    for i, matrix in enumerate(matrices):
+        indptr[i] = matrix.indptr
+    indices = np.concatenate(
+        [np.zeros(0, dtype=dtype)] + [matrix.indices for matrix in matrices]
+    ).astype(dtype)
+
+    with _atomic_directory(Path(path)) as tmp_path:
+        np.save(tmp_path / "indptr.npy", indptr)
+        np.save(tmp_path / "indices.npy", indices)
+        np.save(tmp_path / "label_offsets.npy", offsets.astype(np.int64))
+        if graph_matrices.epsilon_closure is not None:
+            save_npz(tmp_path / "epsilon_closure.npz", graph_matrices.epsilon_closure)
+        _save_nodes_meta(
+            tmp_path,
+            labels,
+            list(graph_matrices.nodes),
+            graph_matrices.start_mask,
+            graph_matrices.final_mask,
+        )
+
+
+def read_graph_matrices(
+    path: Union[str, Path], mmap: bool = True
+) -> LabeledGraphMatrices:
+    """
+    Reads label matrices saved by save_graph_matrices or csv_to_graph_matrices.
+    Epsilon labels are folded into the other labels on reading, see LabeledGraphMatrices.remove_epsilon_edges.
+    :param path: The directory of the saved graph.
+    :param mmap: If True, row pointers and column indexes of the matrices are memory-mapped instead of being read.
+    """
+    path = Path(path)
+    mmap_mode = "r" if mmap else None
+    with open(path / "meta.json", "r") as f:
+        meta = json.load(f)
+    if meta["nodes"] is None:
+        nodes = np.load(path / "nodes.npy").tolist()
+    else:
+        nodes = meta["nodes"]
+    indptr = np.load(path / "indptr.npy", mmap_mode=mmap_mode)
+    indices = np.load(path / "indices.npy", mmap_mode=mmap_mode)
+    offsets = np.load(path / "label_offsets.npy")
+    n = len(nodes)
+    matrices = {}
+    for i, label in enumerate(meta["labels"]):
+        begin, end = offsets[i], offsets[i + 1]
+        matrices[label] = csr_matrix(
+            (np.ones(end - begin, dtype=bool), indices[begin:end], indptr[i]),
+            shape=(n, n),
+            dtype=bool,
+        )
+    epsilon_closure = None
+    if (path / "epsilon_closure.npz").exists():
+        epsilon_closure = load_npz(path / "epsilon_closure.npz").tocsr()
+    return LabeledGraphMatrices(
+        nodes,
+        {node: i for i, node in enumerate(nodes)},
+        matrices,
+        np.load(path / "start_mask.npy"),
+        np.load(path / "final_mask.npy"),
+        epsilon_closure=epsilon_closure,
+    ).remove_epsilon_edges()
+
+
+def _global_indexes(values: np.ndarray, value_to_index: Dict[Any, int]) -> np.ndarray:
+    # factorize the chunk and look up only its distinct values in the global dictionary
+    codes, uniques = pd.factorize(values)
+    mapping = np.fromiter(
+        (
+            value_to_index.setdefault(value, len(value_to_index))
+            for value in uniques.tolist()
+        ),
+        dtype=np.int64,
+        count=len(uniques),
+    )
+    return mapping[codes]
+
+
+def _typed_values(values: List[str]) -> List[Any]:
+    # values are read as strings and converted to numbers only if all of them are numbers, as pandas types
+    # a whole column, so that "NA" or "null" stay names instead of becoming NaN
+    numbers = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce")
+    if len(values) == 0 or numbers.isna().any():
+        return values
+    return numbers.tolist()
+
+
+def csv_to_graph_matrices(
+    csv_path: Union[str, Path],
+    path: Union[str, Path],
+    chunk_size: int = CSV_CHUNK_SIZE,
+) -> LabeledGraphMatrices:
+    """
+    Converts a space separated edge list "from to label" to label matrices saved as by save_graph_matrices,
+    without building a MultiDiGraph. The CSV is read in chunks, edges are counted per label and row,
+    then column indexes are scattered into a memory-mapped file, so only O(chunk_size) edges and
+    O(labels * nodes) row pointers are kept in memory. Nodes are numbered in the order of their first occurrence.
+    Nodes and labels are numbers if all of them are, strings otherwise, rows with missing fields are rejected.
+    :param csv_path: The CSV file.
+    :param path: The directory to save the matrices to.
+    :param chunk_size: The number of CSV rows read at once.
+    :return: The memory-mapped LabeledGraphMatrices read from path, epsilon labels folded, see read_graph_matrices.
+    """
+    csv_path, path = Path(csv_path), Path(path)
+    node_to_index, label_to_code = {}, {}
+    with _atomic_directory(path) as tmp_path:
+        # first pass: number nodes and labels, store edges as integer triples
+        edges_path = tmp_path / "edges.bin"
+        edges_num = 0
+        with open(edges_path, "wb") as edges_file:
+            if csv_path.stat().st_size > 0:
+                for chunk in pd.read_csv(
+                    csv_path,
+                    sep=" ",
+                    header=None,
+                    names=["from", "to", "label"],
+                    engine="c",
+                    chunksize=chunk_size,
+                    dtype=str,
+                    keep_default_na=False,
+                ):
+                    # short rows get NaN, empty fields between repeated separators get ""
+                    missing = chunk.isna().any(axis=1) | (chunk == "").any(axis=1)
+                    if missing.any():
+                        raise ValueError(
+                            f"Missing fields in {csv_path} at row {missing.idxmax() + 1}"
+                        )
+                    ends = np.stack(
+                        [chunk["from"].to_numpy(), chunk["to"].to_numpy()], axis=1
+                    ).ravel()
+                    ends = _global_indexes(ends, node_to_index).reshape(-1, 2)
+                    codes = _global_indexes(chunk["label"].to_numpy(), label_to_code)
+                    np.column_stack([ends, codes]).astype(np.int64).tofile(edges_file)
+                    edges_num += len(chunk)
+
+        n, labels_num = len(node_to_index), len(label_to_code)
+        dtype = _index_dtype(edges_num, n)
+        edges = np.memmap(edges_path, dtype=np.int64, mode="r", shape=(edges_num, 3))
+        chunks = range(0, edges_num, chunk_size)
+
+        # second pass: count edges per label and row
+        indptr = np.zeros((labels_num, n + 1), dtype=np.int64)
+        flat_indptr = indptr.reshape(-1)
+        for begin in chunks:
+            chunk = np.asarray(edges[begin : begin + chunk_size])
+            keys, counts = np.unique(
+                chunk[:, 2] * (n + 1) + chunk[:, 0] + 1, return_counts=True
+            )
+            flat_indptr[keys] += counts
+        np.cumsum(indptr, axis=1, out=indptr)
+        offsets = np.cumsum(np.concatenate([[0], indptr[:, -1]]))
+
+        # third pass: scatter column indexes into their rows
+        raw_indices = np.lib.format.open_memmap(
+            tmp_path / "raw_indices.npy", mode="w+", dtype=dtype, shape=(edges_num,)
+        )
+        cursor = indptr[:, :-1].copy().reshape(-1)
+        for begin in chunks:
+            chunk = np.asarray(edges[begin : begin + chunk_size])
+            keys = chunk[:, 2] * n + chunk[:, 0]
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            unique_keys, first, counts = np.unique(
+                keys, return_index=True, return_counts=True
+            )
+            rank = np.arange(len(keys)) - np.repeat(first, counts)
+            positions = offsets[chunk[order, 2]] + cursor[keys] + rank
+            raw_indices[positions] = chunk[order, 1]
+            cursor[unique_keys] += counts
+        del edges, cursor
+        os.remove(edges_path)
+
+        # fourth pass: sort and deduplicate every row in place, blocks of rows are bounded by chunk_size edges
+        written = 0
+        new_offsets = np.zeros(labels_num + 1, dtype=np.int64)
+        for label in range(labels_num):
+            old_indptr = indptr[label].copy()
+            row = 0
+            while row < n:
+                next_row = max(
+                    row + 1,
+                    int(
+                        np.searchsorted(
+                            old_indptr, old_indptr[row] + chunk_size, "right"
+                        )
+                    )
+                    - 1,
+                )
+                next_row = min(next_row, n)
+                begin = offsets[label] + old_indptr[row]
+                end = offsets[label] + old_indptr[next_row]
+                cols = np.array(raw_indices[begin:end])
+                rows = np.repeat(
+                    np.arange(row, next_row), np.diff(old_indptr[row : next_row + 1])
+                )
+                order = np.lexsort((cols, rows))
+                cols, rows = cols[order], rows[order]
+                kept = np.ones(len(cols), dtype=bool)
+                kept[1:] = (cols[1:] != cols[:-1]) | (rows[1:] != rows[:-1])
+                cols, rows = cols[kept], rows[kept]
+                raw_indices[written : written + len(cols)] = cols
+                written += len(cols)
+                indptr[label, row + 1 : next_row + 1] = (
+                    written
+                    - new_offsets[label]
+                    - len(cols)
+                    + np.cumsum(np.bincount(rows - row, minlength=next_row - row))
+                )
+                row = next_row
+            new_offsets[label + 1] = written
+
+        indices = np.lib.format.open_memmap(
+            tmp_path / "indices.npy", mode="w+", dtype=dtype, shape=(written,)
+        )
+        for begin in range(0, written, chunk_size):
+            end = min(begin + chunk_size, written)
+            indices[begin:end] = raw_indices[begin:end]
+        indices.flush()
+        del indices, raw_indices
+        os.remove(tmp_path / "raw_indices.npy")
+
+        np.save(tmp_path / "indptr.npy", indptr.astype(dtype))
+        np.save(tmp_path / "label_offsets.npy", new_offsets)
+        _save_nodes_meta(
+            tmp_path,
+            _typed_values(list(label_to_code.keys())),
+            _typed_values(list(node_to_index.keys())),
+            np.ones(n, dtype=bool),
+            np.ones(n, dtype=bool),
+        )
+    return read_graph_matrices(path)
+
+
+def _downloaded_csv_path(path: Path) -> Path:
+    # cfpq_data.download returns either the CSV itself or the extracted graph directory
+    if path.is_dir():
+        return sorted(path.rglob("*.csv"))[0]
+    return path
+
+
+def graph_csv_path(name: str, cache_dir: Union[str, Path] = None) -> Path:
+    """
+    Returns the edge list of a cfpq_data graph kept in the local cache as is.
+    The graph is downloaded on the first call, later calls work offline.
+    :param name: The name of the cfpq_data graph.
+    :param cache_dir: The cache directory, see graph_cache_path.
+    """
+    entry = graph_cache_path(name, cache_dir)
+    path = entry.parent / (entry.name + ".csv")
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        downloaded = _downloaded_csv_path(Path(cfpq_data.download(name)))
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+        os.close(fd)
+        tmp_path = Path(tmp_path)
+        try:
+            shutil.copyfile(downloaded, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+    return path
+
+
+def load_graph_matrices(
+    name: str, cache_dir: Union[str, Path] = None
+) -> LabeledGraphMatrices:
+    """
+    Loads label matrices of a cfpq_data graph from the local cache.
+    The cached edge list is converted with csv_to_graph_matrices on the first call, later calls work offline.
+    :param name: The name of the cfpq_data graph.
+    :param cache_dir: The cache directory, see graph_cache_path.
+    """
+    path = graph_cache_path(name, cache_dir)
+    if not (path / "meta.json").exists():
+        csv_to_graph_matrices(graph_csv_path(name, cache_dir), path)
+    return read_graph_matrices(path)
+
+
+def get_graph(name: str, cache_dir: Union[str, Path] = None) -> nx.MultiDiGraph:
+    """
+    Loads a cfpq_data graph from the edge list kept in the local cache, see graph_csv_path.
+    All edges are kept, parallel ones included.
+    """
+    return cfpq_data.graph_from_csv(graph_csv_path(name, cache_dir))
 
 
 def get_graph_metrics(graph: nx.MultiDiGraph) -> Tuple[int, int, set]:
@@ -4,15 +4,19 @@ from pathlib import Path
 
 import networkx as nx
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton as Nfa
-from pyformlang.regular_expression import Regex
 from pyformlang.cfg import CFG
 from scipy.sparse import csr_matrix
 
-from project.finite_automata_tools import regex_to_dfa, graph_to_nfa
-from project.graph_module import get_graph
+from project.finite_automata_tools import graph_to_nfa
+from project.graph_module import load_graph_matrices
 from project.parser.interpreter.set import Set
 from project.parser.interpreter.tuples import Pair, Triple
-from project.rpq import transitive_closure, decompose_automaton, fa_intersection
+from project.rpq import (
+    compile_regex,
+    decompose_automaton,
+    fa_intersection,
+    transitive_closure,
+)
 from project.task_7 import ecfg_to_rsm, cfg_to_ecfg
 from project.task_6 import cfg_from_file
 
@@ -92,7 +96,7 @@ class Automation(AutomationAbstract, ABC):
 
     @classmethod
     def from_str(cls, s: str) -> "Automation":
-        return cls(regex_to_dfa(Regex(s)))
+        return cls(compile_regex(s).dfa)
 
     @classmethod
     def from_file(cls, path: Path) -> "Automation":
@@ -102,7 +106,7 @@ class Automation(AutomationAbstract, ABC):
 
     @classmethod
     def load(cls, name: str) -> "Automation":
-        return cls(graph_to_nfa(get_graph(name)))
+        return cls(graph_to_nfa(load_graph_matrices(name)))
 
     def set_start(self, start: "Set") -> "Automation":
         if isinstance(None, start.type):
@@ -186,7 +190,9 @@ class Automation(AutomationAbstract, ABC):
             result.add(Pair(s.value, s.value))
         decomposed = decompose_automaton(self._nfa)
         n = len(decomposed.states_to_index)
-        m_sum = sum(decomposed.decomposition.values(), start=csr_matrix((n, n)))
+        m_sum = sum(
+            decomposed.decomposition.values(), start=csr_matrix((n, n), dtype=bool)
+        )
         closure = transitive_closure(m_sum)
 
         start_indexes = {
@@ -198,11 +204,8 @@ class Automation(AutomationAbstract, ABC):
         index_to_state = {v: k for k, v in decomposed.states_to_index.items()}
         for start, finish in closure:
             if start in start_indexes and finish in finish_indexes:
-                result.add(
-                    Pair(
-                        index_to_state[start][0].value, index_to_state[finish][0].value
-                    )
-                )
+                # product states of fa_intersection are pairs of plain state values
+                result.add(Pair(index_to_state[start][0], index_to_state[finish][0]))
 
         return Set(result)
 
@@ -217,7 +220,9 @@ class Automation(AutomationAbstract, ABC):
 
     def intersect(self, other: "Automation") -> "Automation":
         if isinstance(other, Automation):
-            return Automation(fa_intersection(self._nfa, other._nfa))
+            return Automation(
+                fa_intersection(self._nfa, other._nfa, reachable_only=True)
+            )
         else:
             other.intersect(self)
 
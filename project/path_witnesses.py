@@ -0,0 +1,108 @@
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from project.reachability_result import ReachabilityResult
+
+
+class PathWitnesses:
+    """
+    Shortest witness paths of reachable node pairs, stored as a BFS forest over product states.
+    Every entry of the forest is a visited product state given by its graph node index, the int32 position
+    of its parent entry (-1 for roots) and the int32 code of the label of the edge it was reached by.
+    Paths are reconstructed on demand by following parent pointers.
+    """
+
+    def __init__(
+        self,
+        nodes: Sequence[Any],
+        labels: Sequence[Any],
+        entry_nodes: np.ndarray,
+        parents: np.ndarray,
+        entry_labels: np.ndarray,
+        pair_sources: np.ndarray,
+        pair_entries: np.ndarray,
+    ):
+        """
+        :param nodes: The nodes of the graph in the order of their indexes.
+        :param labels: The labels in the order of their codes.
+        :param entry_nodes: Graph node indexes of the entries.
+        :param parents: Positions of the parent entries, -1 for roots.
+        :param entry_labels: Label codes of the entries, ignored for roots.
+        :param pair_sources: Graph node indexes of the first nodes of pairs.
+        :param pair_entries: Positions of the entries ending accepted paths. For every pair only
+        the first entry in BFS order, which ends a shortest path, is kept.
+        """
+        self.nodes = nodes
+        self.labels = labels
+        self.entry_nodes = np.asarray(entry_nodes, dtype=np.int32)
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.entry_labels = np.asarray(entry_labels, dtype=np.int32)
+        pair_entries = np.asarray(pair_entries, dtype=np.int64)
+        keys = self._pair_keys(pair_sources, self.entry_nodes[pair_entries])
+        keys, first = np.unique(keys, return_index=True)
+        self._keys = keys
+        self._pair_entries = pair_entries[first].astype(np.int32)
+        self._node_to_index = None
+
+    def _pair_keys(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        return np.asarray(sources, dtype=np.int64) * len(self.nodes) + targets
+
+    @property
+    def node_to_index(self):
+        if self._node_to_index is None:
+            self._node_to_index = {node: i for i, node in enumerate(self.nodes)}
+        return self._node_to_index
+
+    def _entry(self, u: Any, v: Any) -> Optional[int]:
+        if u not in self.node_to_index or v not in self.node_to_index:
+            return None
+        key = self._pair_keys(self.node_to_index[u], self.node_to_index[v])
+        position = np.searchsorted(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            return int(self._pair_entries[position])
+        return None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, pair: Tuple[Any, Any]) -> bool:
+        return self._entry(*pair) is not None
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        n = max(len(self.nodes), 1)
+        for key in self._keys:
+            yield self.nodes[key // n], self.nodes[key % n]
+
+    def result(self) -> ReachabilityResult:
+        n = max(len(self.nodes), 1)
+        return ReachabilityResult(self.nodes, self._keys // n, self._keys % n)
+
+    def path(self, u: Any, v: Any) -> Optional[List[Tuple[Any, Any, Any]]]:
+        """
+        :return: Edges (from_node, label, to_node) of a shortest path from u to v accepted by the query,
+        or None if v is not reachable from u.
+        """
+        entry = self._entry(u, v)
+        if entry is None:
+            return None
+        edges = []
+        while self.parents[entry] >= 0:
+            parent = self.parents[entry]
+            edges.append(
+                (
+                    self.nodes[self.entry_nodes[parent]],
+                    self.labels[self.entry_labels[entry]],
+                    self.nodes[self.entry_nodes[entry]],
+                )
+            )
+            entry = parent
+        edges.reverse()
+        return edges
+
+    def paths(self) -> Iterator[Tuple[Tuple[Any, Any], List[Tuple[Any, Any, Any]]]]:
+        """
+        :return: Iterator over pairs and their shortest paths.
+        """
+        for u, v in self:
+            yield (u, v), self.path(u, v)
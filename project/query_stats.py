@@ -0,0 +1,26 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class QueryStats:
+    """
+    Statistics of a query evaluation. Pass an instance to a query function to have it filled.
+    """
+
+    iterations: int = 0
+    visited_states: int = 0
+    peak_frontier_size: int = 0
+    peak_memory_bytes: int = 0
+    elapsed_seconds: float = 0.0
+    # set when max_path_length or stop_when_found ended the search before the fixpoint,
+    # frontier_size is then the number of states left unexpanded by all the cut searches
+    truncated: bool = False
+    frontier_size: int = 0
+
+    def update_peaks(self, frontier_size: int, memory_bytes: int):
+        self.peak_frontier_size = max(self.peak_frontier_size, frontier_size)
+        self.peak_memory_bytes = max(self.peak_memory_bytes, memory_bytes)
+
+    def truncate(self, frontier_size: int):
+        self.truncated = True
+        self.frontier_size += frontier_size
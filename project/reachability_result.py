@@ -0,0 +1,156 @@
+from typing import Any, Iterable, Iterator, Sequence, Set, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def nodes_array(nodes: Sequence[Any]) -> np.ndarray:
+    """
+    Converts nodes to a NumPy array: an integer array if all nodes are integers, an object array of the nodes otherwise,
+    so that nodes of mixed types are not converted to strings or floats.
+    """
+    if all(
+        isinstance(node, (int, np.integer)) and not isinstance(node, bool)
+        for node in nodes
+    ):
+        array = np.asarray(nodes)
+        # integers beyond int64 give an object array
+        if array.dtype.kind in "iu":
+            return array
+    return np.fromiter(nodes, dtype=object, count=len(nodes))
+
+
+class ReachabilityResult:
+    """
+    Set of reachable node pairs stored as two int32 arrays of node indexes,
+    sorted by source and then by target.
+    """
+
+    def __init__(self, nodes: Sequence[Any], sources: np.ndarray, targets: np.ndarray):
+        """
+        :param nodes: The nodes of the graph in the order of their indexes.
+        :param sources: Indexes of the first nodes of pairs. Pairs may repeat.
+        :param targets: Indexes of the second nodes of pairs.
+        """
+        self.nodes = nodes
+        keys = np.unique(
+            np.asarray(sources, dtype=np.int64) * len(nodes)
+            + np.asarray(targets, dtype=np.int64)
+        )
+        self._set_keys(keys)
+        self._node_to_index = None
+
+    @classmethod
+    def from_matrix(
+        cls, nodes: Sequence[Any], matrix: csr_matrix
+    ) -> "ReachabilityResult":
+        rows, cols = matrix.nonzero()
+        return cls(nodes, rows, cols)
+
+    def _set_keys(self, keys: np.ndarray):
+        n = max(len(self.nodes), 1)
+        self.sources = (keys // n).astype(np.int32)
+        self.targets = (keys % n).astype(np.int32)
+
+    def _keys(self) -> np.ndarray:
+        return self.sources.astype(np.int64) * len(self.nodes) + self.targets
+
+    def _with_keys(self, keys: np.ndarray) -> "ReachabilityResult":
+        result = ReachabilityResult.__new__(ReachabilityResult)
+        result.nodes = self.nodes
+        result._node_to_index = self._node_to_index
+        result._set_keys(keys)
+        return result
+
+    @property
+    def node_to_index(self):
+        if self._node_to_index is None:
+            self._node_to_index = {node: i for i, node in enumerate(self.nodes)}
+        return self._node_to_index
+
+    def _indexes_mask(self, nodes: Iterable[Any]) -> np.ndarray:
+        mask = np.zeros(len(self.nodes), dtype=bool)
+        mask[
+            [self.node_to_index[node] for node in nodes if node in self.node_to_index]
+        ] = True
+        return mask
+
+    def _check_compatible(self, other: "ReachabilityResult"):
+        if other.nodes is not self.nodes and list(other.nodes) != list(self.nodes):
+            raise ValueError("Results must be computed over the same nodes")
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __contains__(self, pair: Tuple[Any, Any]) -> bool:
+        u, v = pair
+        if u not in self.node_to_index or v not in self.node_to_index:
+            return False
+        u, v = self.node_to_index[u], self.node_to_index[v]
+        left = np.searchsorted(self.sources, u, side="left")
+        right = np.searchsorted(self.sources, u, side="right")
+        position = left + np.searchsorted(self.targets[left:right], v)
+        return position < right and self.targets[position] == v
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        for u, v in zip(self.sources, self.targets):
+            yield self.nodes[u], self.nodes[v]
+
+    def __eq__(self, other):
+        if isinstance(other, ReachabilityResult):
+            self._check_compatible(other)
+            return np.array_equal(self._keys(), other._keys())
+        if isinstance(other, (set, frozenset)):
+            return self.to_set() == other
+        return NotImplemented
+
+    def __and__(self, other: "ReachabilityResult") -> "ReachabilityResult":
+        self._check_compatible(other)
+        return self._with_keys(
+            np.intersect1d(self._keys(), other._keys(), assume_unique=True)
+        )
+
+    def __or__(self, other: "ReachabilityResult") -> "ReachabilityResult":
+        self._check_compatible(other)
+        return self._with_keys(np.union1d(self._keys(), other._keys()))
+
+    def __sub__(self, other: "ReachabilityResult") -> "ReachabilityResult":
+        self._check_compatible(other)
+        return self._with_keys(
+            np.setdiff1d(self._keys(), other._keys(), assume_unique=True)
+        )
+
+    def __str__(self):
+        return "{" + ", ".join(f"({u}, {v})" for u, v in self) + "}"
+
+    def filter(
+        self, sources: Iterable[Any] = None, targets: Iterable[Any] = None
+    ) -> "ReachabilityResult":
+        """
+        :param sources: The allowed first nodes. If None, all nodes are allowed.
+        :param targets: The allowed second nodes. If None, all nodes are allowed.
+        :return: The result with pairs of the allowed nodes only.
+        """
+        selected = np.ones(len(self), dtype=bool)
+        if sources is not None:
+            selected &= self._indexes_mask(sources)[self.sources]
+        if targets is not None:
+            selected &= self._indexes_mask(targets)[self.targets]
+        return self._with_keys(self._keys()[selected])
+
+    def to_set(self) -> Set[Tuple[Any, Any]]:
+        return set(self)
+
+    def to_pairs(self) -> np.ndarray:
+        """
+        :return: The pairs as an array of shape (len, 2), see nodes_array for its dtype.
+        """
+        return nodes_array(self.nodes)[np.stack([self.sources, self.targets], axis=1)]
+
+    def to_matrix(self) -> csr_matrix:
+        n = len(self.nodes)
+        return csr_matrix(
+            (np.ones(len(self), dtype=bool), (self.sources, self.targets)),
+            shape=(n, n),
+            dtype=bool,
+        )
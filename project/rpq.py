@@ -1,8 +1,11 @@
-from dataclasses import dataclass, field
-from typing import Tuple, Any, Set, Dict, List
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields
+from typing import Tuple, Any, Callable, Set, Dict, List, Union
 
-import networkx as nx
+import numpy as np
 from pyformlang.finite_automaton import (
+    DeterministicFiniteAutomaton,
     FiniteAutomaton,
     State,
     NondeterministicFiniteAutomaton,
@@ -10,7 +13,18 @@ from pyformlang.finite_automaton import (
 from pyformlang.regular_expression import Regex
 from scipy.sparse import csr_matrix, kron
 
-from project.finite_automata_tools import graph_to_nfa, regex_to_dfa
+from project.finite_automata_tools import regex_to_dfa
+from project.graph_matrices import (
+    OUTPUT_FORMATS,
+    GraphLike,
+    LabeledGraphMatrices,
+    as_graph_matrices,
+    pairs_output,
+    to_bool_csr,
+)
+from project.path_witnesses import PathWitnesses
+from project.query_stats import QueryStats
+from project.sparse_backend import BackendLike, get_backend
 
 
 @dataclass
@@ -20,51 +34,180 @@ class FABooleanDecomposition:
     states_to_index: Dict[Any, int] = field(default_factory=dict)
     decomposition: Dict[Any, csr_matrix] = field(default_factory=dict)
 
+    def __post_init__(self):
+        for label, matrix in self.decomposition.items():
+            if not isinstance(matrix, csr_matrix) or matrix.dtype != bool:
+                self.decomposition[label] = to_bool_csr(matrix)
+
+
+def _stable_order(values: List[Any]) -> List[Any]:
+    # sort by value where possible so that state indexes do not depend on set iteration order
+    try:
+        return sorted(values)
+    except TypeError:
+        return sorted(values, key=lambda value: (type(value).__name__, repr(value)))
+
 
 def decompose_automaton(automaton: FiniteAutomaton) -> FABooleanDecomposition:
     """
     Decompose a finite automaton into a set of boolean matrices.
-    :param automaton: The automaton to decompose.
+    States are indexed in the ascending order of their values, transitions are read from the transition function
+    directly and grouped by label with a single sort.
+    :param automaton: The automaton to decompose. It is not modified.
     :return: The bool_decomposition.
     """
-    automaton = automaton.copy()
-    bool_decomposition = FABooleanDecomposition()
-    bool_decomposition.start_states = automaton.start_states.copy()
-    bool_decomposition.final_states = automaton.final_states.copy()
-    for state in bool_decomposition.start_states:
-        automaton.remove_start_state(State(state))
-    for state in bool_decomposition.final_states:
-        automaton.remove_final_state(State(state))
-    graph = automaton.to_networkx()
-    edges = graph.edges(data="label")
-    nodes = graph.nodes()
-    counter = 0
-    for node in nodes:
-        bool_decomposition.states_to_index[node] = counter
-        counter += 1
-
-    decomposition_buf: Dict[str : Tuple[List[int], List[int], List[int]]] = {}
-    for edge in edges:
-        if edge[2] is not None:
-            if edge[2] not in decomposition_buf:
-                decomposition_buf[edge[2]] = (list(), list(), list())
-            decomposition_buf[edge[2]][0].append(
-                bool_decomposition.states_to_index[edge[0]]
-            )
-            decomposition_buf[edge[2]][1].append(
-                bool_decomposition.states_to_index[edge[1]]
-            )
-            decomposition_buf[edge[2]][2].append(1)
+    states = _stable_order([state.value for state in automaton.states])
+    states_to_index = {state: i for i, state in enumerate(states)}
+    n = len(states)
 
-    for key in decomposition_buf:
-        bool_decomposition.decomposition[key] = csr_matrix(
-            (
-                decomposition_buf[key][2],
-                (decomposition_buf[key][0], decomposition_buf[key][1]),
-            ),
-            shape=(len(nodes), len(nodes)),
+    label_to_code = {}
+    rows, cols, codes = [], [], []
+    for s_from, symbol, s_to in automaton:
+        label = symbol.value
+        # keep the epsilon label used by the networkx representation of automata
+        if label == "epsilon":
+            label = "ɛ"
+        rows.append(states_to_index[s_from.value])
+        cols.append(states_to_index[s_to.value])
+        codes.append(label_to_code.setdefault(label, len(label_to_code)))
+
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    codes = np.asarray(codes, dtype=np.int64)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(label_to_code) + 1))
+    decomposition = {}
+    for label, code in label_to_code.items():
+        selected = order[bounds[code] : bounds[code + 1]]
+        decomposition[label] = csr_matrix(
+            (np.ones(len(selected), dtype=bool), (rows[selected], cols[selected])),
+            shape=(n, n),
+            dtype=bool,
         )
-    return bool_decomposition
+
+    return FABooleanDecomposition(
+        set(automaton.start_states),
+        set(automaton.final_states),
+        states_to_index,
+        decomposition,
+    )
+
+
+# Default number of regexes kept by the process-wide REGEX_CACHE
+REGEX_CACHE_SIZE = 128
+
+
+@dataclass
+class CompiledRegex:
+    dfa: DeterministicFiniteAutomaton
+    decomposition: FABooleanDecomposition
+
+
+class RegexCache:
+    """
+    Thread-safe LRU cache of minimal DFAs and their boolean decompositions keyed by the normalized regex text.
+    Cached automata and decompositions are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_size: int = REGEX_CACHE_SIZE):
+        self._max_size = max_size
+        self._entries: "OrderedDict[str, CompiledRegex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(regex: Union[Regex, str]) -> str:
+        """
+        :return: The normalized text of the regex, equal for regexes that differ only in spacing and brackets.
+        """
+        if not isinstance(regex, Regex):
+            regex = Regex(regex)
+        return str(regex)
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size: int):
+        with self._lock:
+            self._max_size = max_size
+            self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, regex: Union[Regex, str]) -> bool:
+        return self.key(regex) in self._entries
+
+    def _evict(self):
+        while len(self._entries) > max(self._max_size, 0):
+            self._entries.popitem(last=False)
+
+    def get(self, regex: Union[Regex, str]) -> CompiledRegex:
+        """
+        :return: The cached minimal DFA and its decomposition, compiled on a miss.
+        """
+        if not isinstance(regex, Regex):
+            regex = Regex(regex)
+        key = self.key(regex)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        # compile outside of the lock so that other regexes are not blocked
+        dfa = regex_to_dfa(regex)
+        compiled = CompiledRegex(dfa, decompose_automaton(dfa))
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            self._evict()
+        return compiled
+
+    def invalidate(self, regex: Union[Regex, str] = None):
+        """
+        Removes the regex from the cache. If regex is None, the whole cache is cleared and counters are reset.
+        """
+        with self._lock:
+            if regex is None:
+                self._entries.clear()
+                self.hits = 0
+                self.misses = 0
+            else:
+                self._entries.pop(self.key(regex), None)
+
+
+REGEX_CACHE = RegexCache()
+
+
+def compile_regex(regex: Union[Regex, str]) -> CompiledRegex:
+    """
+    :return: The minimal DFA of the regex and its decomposition from the process-wide REGEX_CACHE.
+    """
+    return REGEX_CACHE.get(regex)
+
+
+def decompose_graph(
+    graph: GraphLike, start_states: Set[Any] = None, final_states: Set[Any] = None
+) -> FABooleanDecomposition:
+    """
+    Decompose a graph into a set of boolean matrices without building an automaton for it.
+    :param graph: The MultiDiGraph or LabeledGraphMatrices.
+    :param start_states: The start nodes. If None, all nodes would be considered as start nodes.
+    :param final_states: The final nodes. If None, all nodes would be considered as final nodes.
+    :return: The bool_decomposition. States of the decomposition are the graph nodes.
+    """
+    graph_matrices = as_graph_matrices(graph, start_states, final_states)
+    return FABooleanDecomposition(
+        graph_matrices.start_nodes(),
+        graph_matrices.final_nodes(),
+        graph_matrices.node_to_index,
+        dict(graph_matrices.matrices),
+    )
 
 
 def decomposition_intersection(
@@ -108,76 +251,1031 @@ def decomposition_intersection(
     )
 
 
+def reachable_mask(matrix: csr_matrix, start_indexes) -> np.ndarray:
+    """
+    Finds states reachable from the start states in a graph given by its adjacency matrix.
+    :param matrix: The adjacency matrix.
+    :param start_indexes: Indexes of the start states.
+    :return: Boolean mask of reachable states, start states included.
+    """
+    matrix = to_bool_csr(matrix)
+    visited = np.zeros(matrix.shape[0], dtype=bool)
+    front = np.unique(np.asarray(start_indexes, dtype=np.int64))
+    visited[front] = True
+    while len(front) > 0:
+        front = np.unique(matrix[front].indices)
+        front = front[~visited[front]]
+        visited[front] = True
+    return visited
+
+
+def prune_graph(
+    graph_matrices: LabeledGraphMatrices, labels: Set[Any]
+) -> Tuple[LabeledGraphMatrices, np.ndarray]:
+    """
+    Restricts the graph to the part a query over the given labels can visit: edges of the labels between
+    nodes incident to them, and then nodes reachable from the start nodes by these edges.
+    Start nodes are always kept, so the order of start indexes is preserved.
+    :param graph_matrices: The graph with its start and final nodes.
+    :param labels: The alphabet of the query.
+    :return: The pruned graph and the indexes of its nodes in the original graph.
+    """
+    labels = graph_matrices.labels & set(labels)
+    kept = np.flatnonzero(
+        graph_matrices.incident_mask(labels) | graph_matrices.start_mask
+    )
+    if len(kept) == graph_matrices.nodes_num and labels == graph_matrices.labels:
+        pruned = graph_matrices
+    else:
+        pruned = graph_matrices.subgraph(kept, labels)
+    if pruned.start_mask.all():
+        return pruned, kept
+
+    adjacency = csr_matrix((pruned.nodes_num, pruned.nodes_num), dtype=bool)
+    for matrix in pruned.matrices.values():
+        adjacency = adjacency + matrix
+    reachable = reachable_mask(adjacency, pruned.start_indexes)
+    if not reachable.all():
+        pruned = pruned.subgraph(np.flatnonzero(reachable))
+        kept = kept[reachable]
+    return pruned, kept
+
+
 def fa_intersection(
-    first_automation: FiniteAutomaton, second_automation: FiniteAutomaton
+    first_automation: FiniteAutomaton,
+    second_automation: FiniteAutomaton,
+    reachable_only: bool = False,
 ) -> FiniteAutomaton():
-    first_fa_decomposition = decompose_automaton(first_automation)
-    second_fa_decomposition = decompose_automaton(second_automation)
-    intersection_decomposition = decomposition_intersection(
-        first_fa_decomposition, second_fa_decomposition
-    )
-    index_to_state = {
-        v: k for k, v in intersection_decomposition.states_to_index.items()
+    """
+    Builds the product of two finite automata.
+    :param first_automation: The first automaton.
+    :param second_automation: The second automaton.
+    :param reachable_only: If True, the product would contain only states reachable from the start states.
+    :return: The automaton which accepts the intersection of the languages.
+    """
+    first_dec = decompose_automaton(first_automation)
+    second_dec = decompose_automaton(second_automation)
+    first_index_to_state = {v: k for k, v in first_dec.states_to_index.items()}
+    second_index_to_state = {v: k for k, v in second_dec.states_to_index.items()}
+    second_dimension = len(second_dec.states_to_index)
+    product_size = len(first_dec.states_to_index) * second_dimension
+
+    def index_to_state(index: int) -> State:
+        return State(
+            (
+                first_index_to_state[index // second_dimension],
+                second_index_to_state[index % second_dimension],
+            )
+        )
+
+    def state_to_index(first_state, second_state) -> int:
+        return (
+            first_dec.states_to_index[first_state] * second_dimension
+            + second_dec.states_to_index[second_state]
+        )
+
+    products = {
+        label: kron(
+            first_dec.decomposition[label],
+            second_dec.decomposition[label],
+            format="coo",
+        )
+        for label in first_dec.decomposition.keys() & second_dec.decomposition.keys()
     }
-    # transfer decomposition to FiniteAutomaton
+    start_indexes = [
+        state_to_index(f_start, s_start)
+        for f_start in first_dec.start_states
+        for s_start in second_dec.start_states
+    ]
+    final_indexes = [
+        state_to_index(f_final, s_final)
+        for f_final in first_dec.final_states
+        for s_final in second_dec.final_states
+    ]
+    reachable = np.ones(product_size, dtype=bool)
+    if reachable_only:
+        adjacency = csr_matrix((product_size, product_size), dtype=bool)
+        for matrix in products.values():
+            adjacency = adjacency + matrix.tocsr()
+        reachable = reachable_mask(adjacency, start_indexes)
+
+    # transfer decomposition to FiniteAutomaton walking only nonzero entries
     automation = NondeterministicFiniteAutomaton()
-    for label, matrix in intersection_decomposition.decomposition.items():
+    for label, matrix in products.items():
         matrix.eliminate_zeros()
-        for i in range(matrix.todense().shape[0]):
-            for j in range(matrix.todense().shape[1]):
-                if matrix.todense()[i, j] == 1:
-                    automation.add_transition(
-                        State(index_to_state[i]), label, State(index_to_state[j])
-                    )
-    for state in intersection_decomposition.start_states:
-        automation.add_start_state(State(state))
+        for i, j in zip(matrix.row, matrix.col):
+            if reachable[i]:
+                automation.add_transition(index_to_state(i), label, index_to_state(j))
+    for index in start_indexes:
+        automation.add_start_state(index_to_state(index))
 
-    for state in intersection_decomposition.final_states:
-        automation.add_final_state(State(state))
+    for index in final_indexes:
+        if reachable[index]:
+            automation.add_final_state(index_to_state(index))
 
     return automation
 
 
-def transitive_closure(matrix: csr_matrix) -> List[Tuple[int, int]]:
+@dataclass
+class SearchLimits:
+    """
+    Early termination conditions of a level-synchronous search, round i of which finds paths of length i.
+    """
+
+    max_path_length: int = None
+    max_answers: int = None
+
+    def reached(self, path_length: int, answers_num: int) -> bool:
+        """
+        :return: True if paths of the given length are the longest allowed or enough answers are found.
+        """
+        return (
+            self.max_path_length is not None and path_length >= self.max_path_length
+        ) or (self.max_answers is not None and answers_num >= self.max_answers)
+
+    def first_answers(
+        self, rows: np.ndarray, cols: np.ndarray, nodes_num: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: At most max_answers distinct pairs of node indexes in ascending order.
+        """
+        if self.max_answers is None:
+            return rows, cols
+        n = max(nodes_num, 1)
+        keys = np.unique(np.asarray(rows, dtype=np.int64) * n + cols)
+        keys = keys[: self.max_answers]
+        return keys // n, keys % n
+
+
+def search_limits(
+    max_path_length: int = None,
+    stop_when_found: Any = None,
+    start_nodes: Set[Any] = None,
+    final_nodes: Set[Any] = None,
+) -> Tuple[SearchLimits, Set[Any], Set[Any]]:
+    """
+    Normalizes the early termination options of rpq and bfs_rpq.
+    :param max_path_length: Only paths with at most this number of edges are considered.
+    :param stop_when_found: "any" stops at the first answer, an integer k stops after k answers,
+    a pair (u, v) only checks whether v is reachable from u.
+    :param start_nodes: The start nodes of the query.
+    :param final_nodes: The final nodes of the query.
+    :return: The limits and the start and final nodes, which are u and v for a single pair.
+    """
+    if max_path_length is not None and max_path_length < 0:
+        raise ValueError("max_path_length must be non-negative")
+    max_answers = None
+    if isinstance(stop_when_found, str):
+        if stop_when_found != "any":
+            raise ValueError("Unknown stop_when_found: " + stop_when_found)
+        max_answers = 1
+    elif isinstance(stop_when_found, tuple):
+        if len(stop_when_found) != 2:
+            raise ValueError("stop_when_found pair must be (start_node, final_node)")
+        start_nodes, final_nodes = {stop_when_found[0]}, {stop_when_found[1]}
+        max_answers = 1
+    elif isinstance(stop_when_found, int) and not isinstance(stop_when_found, bool):
+        if stop_when_found < 1:
+            raise ValueError("stop_when_found must be a positive number of answers")
+        max_answers = stop_when_found
+    elif stop_when_found is not None:
+        raise ValueError("Unknown stop_when_found: " + str(stop_when_found))
+    return SearchLimits(max_path_length, max_answers), start_nodes, final_nodes
+
+
+CLOSURE_DENSITY_THRESHOLD = 0.01
+
+
+def choose_closure_strategy(matrix: csr_matrix) -> str:
+    """
+    Chooses the transitive closure strategy: repeated squaring needs a logarithmic number of rounds
+    but its products grow fast, so it is used only for dense matrices.
+    :param matrix: The adjacency matrix.
+    :return: "squaring" or "linear"
+    """
+    n = max(matrix.shape[0], 1)
+    if matrix.nnz / (n * n) >= CLOSURE_DENSITY_THRESHOLD:
+        return "squaring"
+    return "linear"
+
+
+def boolean_closure(
+    matrix: csr_matrix,
+    strategy: str = "auto",
+    stats: QueryStats = None,
+    backend: BackendLike = None,
+    max_path_length: int = None,
+) -> csr_matrix:
+    """
+    Computes the transitive closure of an adjacency matrix with semi-naive evaluation:
+    every round only the pairs discovered in the previous round are multiplied.
+    The input matrix is not modified.
+    :param matrix: The adjacency matrix.
+    :param strategy: "squaring" joins known paths with new paths, "linear" extends new paths by one edge,
+    "auto" chooses by the matrix density.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param backend: The sparse backend or its name, see get_backend.
+    :param max_path_length: If given, only pairs connected by paths of at most this length are computed
+    and the "linear" strategy is used, since each of its rounds extends paths by one edge.
+    :return: The boolean closure matrix.
+    """
+    be = get_backend(backend)
+    closure = to_bool_csr(matrix)
+    if max_path_length is not None:
+        strategy = "linear"
+        if max_path_length == 0:
+            closure = csr_matrix(closure.shape, dtype=bool)
+    if strategy == "auto":
+        strategy = choose_closure_strategy(closure)
+    if strategy not in ("squaring", "linear"):
+        raise ValueError("Unknown closure strategy: " + str(strategy))
+
+    closure = be.from_scipy(closure)
+    base = closure
+    delta = closure
+    path_length = 1
+    while be.nnz(delta):
+        if max_path_length is not None and path_length >= max_path_length:
+            if stats is not None:
+                stats.truncate(be.nnz(delta))
+            break
+        path_length += 1
+        if stats is not None:
+            stats.iterations += 1
+            stats.update_peaks(be.nnz(delta), be.nbytes(closure))
+        if strategy == "squaring":
+            new = be.add(be.matmul(delta, closure), be.matmul(closure, delta))
+        else:
+            new = be.matmul(delta, base)
+        delta = be.mask(new, closure)
+        closure = be.add(closure, delta)
+    if stats is not None:
+        stats.visited_states = be.nnz(closure)
+    return be.to_scipy(closure)
+
+
+def extend_closure(
+    closure: csr_matrix,
+    edges: csr_matrix,
+    stats: QueryStats = None,
+    backend: BackendLike = None,
+) -> Tuple[csr_matrix, csr_matrix]:
+    """
+    Updates a transitive closure after adding edges. Since the closure is already closed,
+    only paths through the new pairs are multiplied. The input matrices are not modified.
+    :param closure: The boolean closure matrix.
+    :param edges: The added edges.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param backend: The sparse backend or its name, see get_backend.
+    :return: The updated closure and the matrix of pairs added to it.
+    """
+    be = get_backend(backend)
+    closure = be.from_scipy(closure)
+    delta = be.mask(be.from_scipy(edges), closure)
+    closure = be.add(closure, delta)
+    added = delta
+    while be.nnz(delta):
+        if stats is not None:
+            stats.iterations += 1
+            stats.update_peaks(be.nnz(delta), be.nbytes(closure))
+        delta = be.mask(
+            be.add(be.matmul(delta, closure), be.matmul(closure, delta)), closure
+        )
+        closure = be.add(closure, delta)
+        added = be.add(added, delta)
+    return be.to_scipy(closure), be.to_scipy(added)
+
+
+def transitive_closure(
+    matrix: csr_matrix, strategy: str = "auto", max_path_length: int = None
+) -> List[Tuple[int, int]]:
+    """
+    :param matrix: The adjacency matrix. It is not modified.
+    :param strategy: The closure strategy, see boolean_closure.
+    :param max_path_length: If given, only paths of at most this length are considered.
+    :return: List of pairs of indexes connected by a path.
+    """
     if not matrix.nnz:
         return []
+    closure = boolean_closure(matrix, strategy, max_path_length=max_path_length)
+    return list(zip(*closure.nonzero()))
 
-    matrix.eliminate_zeros()
 
-    prev = -1
-    curr = matrix.nnz
-    while prev != curr:
-        matrix += matrix @ matrix
-        prev = curr
-        curr = matrix.nnz
+def _product_transitions(
+    graph_matrices: Dict[Any, csr_matrix],
+    regex_matrices: Dict[Any, csr_matrix],
+    regex_n: int,
+) -> List[Tuple[Any, csr_matrix, int, np.ndarray]]:
+    # (label, graph label matrix, regex source state, regex target states)
+    transitions = []
+    for label in graph_matrices.keys() & regex_matrices:
+        regex_matrix = regex_matrices[label]
+        for regex_state in range(regex_n):
+            targets = regex_matrix[regex_state].indices
+            if len(targets) > 0:
+                transitions.append((label, graph_matrices[label], regex_state, targets))
+    return transitions
 
-    return list(zip(*matrix.nonzero()))
+
+def _step_keys(
+    transitions: List[Tuple[Any, csr_matrix, int, np.ndarray]],
+    keys: np.ndarray,
+    graph_n: int,
+    regex_n: int,
+    with_parents: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Makes one step from product states encoded as int64 keys (origin * graph_n + node) * regex_n + regex_state,
+    where origin is the number of the node the search started from.
+    :param with_parents: If True, the positions of the parents in keys and the numbers of the transitions
+    are returned for every reached state, otherwise they are None.
+    :return: Keys of the reached states, possibly repeated, their parents and transitions.
+    """
+    front_regex = keys % regex_n
+    front_node = (keys // regex_n) % graph_n
+    front_origin = keys // (regex_n * graph_n)
+    reached, parents, steps = [], [], []
+    for number, (_, label_matrix, regex_state, targets) in enumerate(transitions):
+        selected = np.flatnonzero(front_regex == regex_state)
+        if len(selected) == 0:
+            continue
+        rows = label_matrix[front_node[selected]]
+        next_node = rows.indices.astype(np.int64)
+        next_origin = np.repeat(front_origin[selected], np.diff(rows.indptr))
+        for target in targets:
+            reached.append((next_origin * graph_n + next_node) * regex_n + target)
+            if with_parents:
+                parents.append(np.repeat(selected, np.diff(rows.indptr)))
+                steps.append(np.full(len(next_node), number, dtype=np.int32))
+    if not reached:
+        empty = keys[:0]
+        return (
+            empty,
+            (empty if with_parents else None),
+            (empty if with_parents else None),
+        )
+    if not with_parents:
+        return np.concatenate(reached), None, None
+    return np.concatenate(reached), np.concatenate(parents), np.concatenate(steps)
+
+
+def _expand_keys(
+    transitions: List[Tuple[Any, csr_matrix, int, np.ndarray]],
+    keys: np.ndarray,
+    graph_n: int,
+    regex_n: int,
+) -> Tuple[np.ndarray, int]:
+    """
+    Makes one step from product states encoded as int64 keys, see _step_keys.
+    :return: Unique keys of the reached states and the size of the intermediate arrays in bytes.
+    """
+    reached, _, _ = _step_keys(transitions, keys, graph_n, regex_n)
+    return np.unique(reached), reached.nbytes + keys.nbytes * 3
+
+
+def _initial_keys(
+    nodes: np.ndarray, regex_states: List[int], graph_n: int, regex_n: int
+):
+    # every node is the origin of its own search and starts in all the given regex states
+    origins = np.arange(len(nodes), dtype=np.int64)
+    return (
+        (origins[:, None] * graph_n + nodes.astype(np.int64)[:, None]) * regex_n
+        + np.asarray(regex_states, dtype=np.int64)
+    ).ravel()
+
+
+def _accepted_keys(
+    keys: np.ndarray,
+    regex_final_mask: np.ndarray,
+    final_mask: np.ndarray,
+    graph_n: int,
+    regex_n: int,
+) -> np.ndarray:
+    # origin * graph_n + node of the accepted product state keys, which identifies their pairs
+    pairs = keys // regex_n
+    return pairs[regex_final_mask[keys % regex_n] & final_mask[pairs % graph_n]]
+
+
+class _KeySet:
+    """
+    Set of int64 keys stored as disjoint sorted runs of halving sizes, like the levels of a log-structured merge tree.
+    Looking up or adding k keys costs O(k log^2 n) and merges are amortized, while merging new keys
+    into a single sorted array would cost O(n) on every level of a search, quadratic on deep products.
+    """
+
+    def __init__(self):
+        self.runs: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self.runs)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(run.nbytes for run in self.runs)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :return: The boolean mask of the keys which are in the set.
+        """
+        mask = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            mask |= run[positions] == keys
+        return mask
+
+    def add_new(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Adds keys to the set.
+        :param keys: Unique keys in ascending order.
+        :return: The boolean mask of the keys which were not in the set before.
+        """
+        new = ~self.contains(keys)
+        if np.any(new):
+            self.runs.append(keys[new])
+        # runs are merged as the digits of a binary counter, so every key is merged O(log n) times
+        while len(self.runs) > 1 and len(self.runs[-2]) <= len(self.runs[-1]):
+            last = self.runs.pop()
+            self.runs[-1] = np.sort(np.concatenate([self.runs[-1], last]))
+        return new
+
+    def in_ranges(
+        self, begins: np.ndarray, ends: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the keys in the half-open ranges [begins[i], ends[i]).
+        :return: Arrays of range numbers and keys in the ranges.
+        """
+        numbers, found = [begins[:0]], [begins[:0]]
+        for run in self.runs:
+            first = np.searchsorted(run, begins)
+            counts = np.searchsorted(run, ends) - first
+            offsets = np.repeat(first - np.cumsum(counts) + counts, counts)
+            numbers.append(np.repeat(np.arange(len(begins)), counts))
+            found.append(run[offsets + np.arange(len(offsets))])
+        return np.concatenate(numbers), np.concatenate(found)
+
+    def keys(self) -> np.ndarray:
+        """
+        :return: All keys in ascending order.
+        """
+        return np.sort(np.concatenate([np.zeros(0, dtype=np.int64)] + self.runs))
+
+
+def product_reachability(
+    graph_matrices: LabeledGraphMatrices,
+    regex_decomposition: FABooleanDecomposition,
+    stats: QueryStats = None,
+    limits: SearchLimits = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Evaluates a regular path query expanding the product of the graph and the regex automaton on the fly.
+    Product states are reached from the start states by per-label sparse row lookups,
+    the full product and its state index are never built.
+    :param graph_matrices: The graph with its start and final nodes.
+    :param regex_decomposition: The decomposition of the regex automaton.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param limits: If given, the search stops as soon as they are reached.
+    :return: Arrays of start and end node indexes of pairs connected by a path, corresponding to the regex.
+    Pairs may repeat.
+    """
+    if stats is None:
+        stats = QueryStats()
+    graph_n = graph_matrices.nodes_num
+    regex_n = len(regex_decomposition.states_to_index)
+    start_nodes = graph_matrices.start_indexes
+    regex_starts = [
+        regex_decomposition.states_to_index[state]
+        for state in regex_decomposition.start_states
+    ]
+    regex_final_mask = np.zeros(regex_n, dtype=bool)
+    regex_final_mask[
+        [
+            regex_decomposition.states_to_index[state]
+            for state in regex_decomposition.final_states
+        ]
+    ] = True
+    transitions = _product_transitions(
+        graph_matrices.matrices, regex_decomposition.decomposition, regex_n
+    )
+
+    front = _initial_keys(start_nodes, regex_starts, graph_n, regex_n)
+    visited = _KeySet()
+    found = _KeySet()
+    path_length = 0
+    while len(front) > 0:
+        if limits is not None and limits.reached(path_length, len(found)):
+            stats.truncate(len(front))
+            break
+        path_length += 1
+        stats.iterations += 1
+        keys, reached_bytes = _expand_keys(transitions, front, graph_n, regex_n)
+        keys = keys[visited.add_new(keys)]
+        stats.update_peaks(len(keys), visited.nbytes + keys.nbytes + reached_bytes)
+        front = keys
+        if limits is not None and limits.max_answers is not None:
+            found.add_new(
+                np.unique(
+                    _accepted_keys(
+                        keys,
+                        regex_final_mask,
+                        graph_matrices.final_mask,
+                        graph_n,
+                        regex_n,
+                    )
+                )
+            )
+    visited = visited.keys()
+    stats.visited_states = len(visited)
+
+    regex_states = visited % regex_n
+    nodes = (visited // regex_n) % graph_n
+    origins = visited // (regex_n * graph_n)
+    accepted = regex_final_mask[regex_states] & graph_matrices.final_mask[nodes]
+    return start_nodes[origins[accepted]], nodes[accepted]
+
+
+def witness_reachability(
+    graph_matrices: LabeledGraphMatrices,
+    regex_decomposition: FABooleanDecomposition,
+    stats: QueryStats = None,
+    limits: SearchLimits = None,
+) -> PathWitnesses:
+    """
+    Evaluates a regular path query by a BFS over the product expanded on the fly, as "lazy" mode does,
+    recording the parent and the label of every visited product state in int32 arrays,
+    so that a shortest path of every pair can be reconstructed without re-running the query.
+    :param graph_matrices: The graph with its start and final nodes.
+    :param regex_decomposition: The decomposition of the regex automaton.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param limits: If given, the search stops as soon as they are reached. With max_answers,
+    only this number of pairs with the shortest paths are kept.
+    :return: The PathWitnesses of pairs connected by a path, corresponding to the regex.
+    """
+    if stats is None:
+        stats = QueryStats()
+    graph_n = graph_matrices.nodes_num
+    regex_n = len(regex_decomposition.states_to_index)
+    start_nodes = graph_matrices.start_indexes
+    regex_starts = [
+        regex_decomposition.states_to_index[state]
+        for state in regex_decomposition.start_states
+    ]
+    regex_final_mask = np.zeros(regex_n, dtype=bool)
+    regex_final_mask[
+        [
+            regex_decomposition.states_to_index[state]
+            for state in regex_decomposition.final_states
+        ]
+    ] = True
+    transitions = _product_transitions(
+        graph_matrices.matrices, regex_decomposition.decomposition, regex_n
+    )
+
+    # entries are appended level by level, so the first entry of a pair ends its shortest path
+    roots = _initial_keys(start_nodes, regex_starts, graph_n, regex_n)
+    entry_keys = [roots]
+    entry_parents = [np.full(len(roots), -1, dtype=np.int32)]
+    entry_steps = [np.zeros(len(roots), dtype=np.int32)]
+    entries_num = len(roots)
+    front, front_offset = roots, 0
+    # roots are not visited, so that they can be reached again by a non-empty path
+    visited = _KeySet()
+    found = _KeySet()
+    path_length = 0
+    while len(front) > 0:
+        if limits is not None and limits.reached(path_length, len(found)):
+            stats.truncate(len(front))
+            break
+        path_length += 1
+        stats.iterations += 1
+        reached, parents, steps = _step_keys(
+            transitions, front, graph_n, regex_n, with_parents=True
+        )
+        keys, first = np.unique(reached, return_index=True)
+        new = visited.add_new(keys)
+        keys, first = keys[new], first[new]
+        if entries_num + len(keys) > np.iinfo(np.int32).max:
+            raise ValueError("Too many product states for int32 parent pointers")
+        entry_keys.append(keys)
+        entry_parents.append((front_offset + parents[first]).astype(np.int32))
+        entry_steps.append(steps[first])
+        front, front_offset = keys, entries_num
+        entries_num += len(keys)
+        stats.update_peaks(
+            len(keys), visited.nbytes + reached.nbytes * 3 + entries_num * 16
+        )
+        if limits is not None and limits.max_answers is not None:
+            found.add_new(
+                np.unique(
+                    _accepted_keys(
+                        keys,
+                        regex_final_mask,
+                        graph_matrices.final_mask,
+                        graph_n,
+                        regex_n,
+                    )
+                )
+            )
+    stats.visited_states = len(visited)
+
+    keys = np.concatenate(entry_keys)
+    regex_states = keys % regex_n
+    nodes = (keys // regex_n) % graph_n
+    origins = keys // (regex_n * graph_n)
+    accepted = regex_final_mask[regex_states] & graph_matrices.final_mask[nodes]
+    accepted[: len(roots)] = False
+    pair_entries = np.flatnonzero(accepted)
+    if limits is not None and limits.max_answers is not None:
+        # entries are in BFS order, so the first entries of pairs end the shortest paths
+        _, first = np.unique(keys[pair_entries] // regex_n, return_index=True)
+        pair_entries = pair_entries[np.sort(first)[: limits.max_answers]]
+    return PathWitnesses(
+        graph_matrices.nodes,
+        [label for label, _, _, _ in transitions],
+        nodes,
+        np.concatenate(entry_parents),
+        np.concatenate(entry_steps),
+        start_nodes[origins[pair_entries]],
+        pair_entries,
+    )
+
+
+def bidirectional_reachability(
+    graph_matrices: LabeledGraphMatrices,
+    regex_decomposition: FABooleanDecomposition,
+    stats: QueryStats = None,
+    limits: SearchLimits = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Evaluates a regular path query expanding the product on the fly from both ends: forward from the start nodes
+    through the regex automaton and backward from the final nodes through the reversed automaton over the
+    transposed label matrices. The smaller frontier is expanded first, a pair is found as soon as its frontiers meet,
+    and searches from nodes whose pairs are all found are stopped.
+    :param graph_matrices: The graph with its start and final nodes.
+    :param regex_decomposition: The decomposition of the regex automaton.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param limits: If given, the search stops as soon as they are reached. Paths found by the searches
+    meeting are as long as the forward and the backward search depths together.
+    :return: Arrays of start and end node indexes of pairs connected by a path, corresponding to the regex.
+    """
+    if stats is None:
+        stats = QueryStats()
+    graph_n = graph_matrices.nodes_num
+    regex_n = len(regex_decomposition.states_to_index)
+    product_n = graph_n * regex_n
+    labels = graph_matrices.matrices.keys() & regex_decomposition.decomposition
+    transitions = [
+        _product_transitions(
+            {label: graph_matrices.matrices[label] for label in labels},
+            regex_decomposition.decomposition,
+            regex_n,
+        ),
+        _product_transitions(
+            {label: graph_matrices.transposed(label) for label in labels},
+            {
+                label: regex_decomposition.decomposition[label].T.tocsr()
+                for label in labels
+            },
+            regex_n,
+        ),
+    ]
+    ends = [graph_matrices.start_indexes, graph_matrices.final_indexes]
+    regex_ends = [
+        [regex_decomposition.states_to_index[state] for state in states]
+        for states in (
+            regex_decomposition.start_states,
+            regex_decomposition.final_states,
+        )
+    ]
+
+    origins_nums = [len(ends[0]), len(ends[1])]
+
+    def by_state(keys: np.ndarray, side: int) -> np.ndarray:
+        # keys origin * product_n + state renumbered as state * origins_num + origin, ordered by product state
+        return (keys % product_n) * origins_nums[side] + keys // product_n
+
+    fronts = [
+        _initial_keys(ends[side], regex_ends[side], graph_n, regex_n) for side in (0, 1)
+    ]
+    # states reached by a non-empty path are visited, reached states include the initial ones as well
+    visited = [_KeySet(), _KeySet()]
+    reached = [_KeySet(), _KeySet()]
+    for side in (0, 1):
+        reached[side].add_new(np.unique(by_state(fronts[side], side)))
+    # keys start_origin * final_origins_num + final_origin of the found pairs, and their numbers per origin
+    met = _KeySet()
+    found = [np.zeros(origins_nums[side], dtype=np.int64) for side in (0, 1)]
+    depths = [0, 0]
+    while True:
+        done = [found[0] == origins_nums[1], found[1] == origins_nums[0]]
+        fronts = [
+            fronts[side][~done[side][fronts[side] // product_n]] for side in (0, 1)
+        ]
+        # a search which ran out of states has found all pairs of its origins
+        if len(fronts[0]) == 0 or len(fronts[1]) == 0:
+            break
+        if limits is not None and limits.reached(sum(depths), len(met)):
+            stats.truncate(len(fronts[0]) + len(fronts[1]))
+            break
+        side = 0 if len(fronts[0]) <= len(fronts[1]) else 1
+        other = 1 - side
+        depths[side] += 1
+        stats.iterations += 1
+        keys, reached_bytes = _expand_keys(
+            transitions[side], fronts[side], graph_n, regex_n
+        )
+        keys = keys[visited[side].add_new(keys)]
+        # the new states meet the searches of the other side which have reached the same product states,
+        # origins are joined through the distinct states by a sparse product, which saturates instead of
+        # listing every pair of origins meeting at every state
+        states, columns = np.unique(keys % product_n, return_inverse=True)
+        numbers, other_keys = reached[other].in_ranges(
+            states * origins_nums[other], (states + 1) * origins_nums[other]
+        )
+        new_states = csr_matrix(
+            (np.ones(len(keys), dtype=bool), (keys // product_n, columns)),
+            shape=(origins_nums[side], len(states)),
+            dtype=bool,
+        )
+        meeting = csr_matrix(
+            (
+                np.ones(len(numbers), dtype=bool),
+                (numbers, other_keys % origins_nums[other]),
+            ),
+            shape=(len(states), origins_nums[other]),
+            dtype=bool,
+        )
+        origins = list((new_states @ meeting).nonzero())
+        if side == 1:
+            origins.reverse()
+        pairs = np.unique(origins[0] * origins_nums[1] + origins[1])
+        pairs = pairs[met.add_new(pairs)]
+        found[0] += np.bincount(pairs // origins_nums[1], minlength=origins_nums[0])
+        found[1] += np.bincount(pairs % origins_nums[1], minlength=origins_nums[1])
+        reached[side].add_new(np.unique(by_state(keys, side)))
+        fronts[side] = keys
+        stats.update_peaks(
+            len(keys),
+            visited[0].nbytes
+            + visited[1].nbytes
+            + reached_bytes
+            + reached[0].nbytes
+            + reached[1].nbytes,
+        )
+    stats.visited_states = len(visited[0]) + len(visited[1])
+    pairs = met.keys()
+    return (
+        ends[0][pairs // max(origins_nums[1], 1)],
+        ends[1][pairs % max(origins_nums[1], 1)],
+    )
+
+
+SOURCES_CROSSOVER = 0.1
+# "auto" mode searches from both ends when there are at most this many start and final nodes,
+# and gives up on it after this many levels, as a level of the bidirectional search costs more than
+# a level of "sources" mode and deep products are faster there, see _bounded_bidirectional_reachability
+BIDIRECTIONAL_THRESHOLD = 4
+BIDIRECTIONAL_MAX_DEPTH = 32
+
+
+def _bounded_bidirectional_reachability(
+    graph_matrices: LabeledGraphMatrices,
+    regex_decomposition: FABooleanDecomposition,
+    stats: QueryStats = None,
+    limits: SearchLimits = None,
+) -> Union[Tuple[np.ndarray, np.ndarray], None]:
+    """
+    Runs bidirectional_reachability for at most BIDIRECTIONAL_MAX_DEPTH levels.
+    :return: Arrays of start and end node indexes of the found pairs,
+    or None if the search needs more levels and another mode should be used. Stats are filled only for pairs.
+    """
+    if limits is None:
+        limits = SearchLimits()
+    if (
+        limits.max_path_length is not None
+        and limits.max_path_length <= BIDIRECTIONAL_MAX_DEPTH
+    ):
+        return bidirectional_reachability(
+            graph_matrices, regex_decomposition, stats, limits
+        )
+    attempt_stats = QueryStats()
+    rows, cols = bidirectional_reachability(
+        graph_matrices,
+        regex_decomposition,
+        attempt_stats,
+        SearchLimits(BIDIRECTIONAL_MAX_DEPTH, limits.max_answers),
+    )
+    # a search cut by enough answers is complete, one cut by the levels is not
+    enough = limits.max_answers is not None and limits.max_answers <= len(
+        np.unique(rows * graph_matrices.nodes_num + cols)
+    )
+    if attempt_stats.truncated and not enough:
+        return None
+    if stats is not None:
+        for stats_field in fields(QueryStats):
+            setattr(stats, stats_field.name, getattr(attempt_stats, stats_field.name))
+    return rows, cols
+
+
+def product_matrix(
+    graph_matrices: LabeledGraphMatrices,
+    regex_decomposition: FABooleanDecomposition,
+    backend: BackendLike = None,
+) -> csr_matrix:
+    """
+    Builds the adjacency matrix of the tensor product of the graph and the regex automaton.
+    Product state (graph node i, regex state j) has index i * regex_states_num + j.
+    :param backend: The sparse backend or its name, see get_backend.
+    """
+    be = get_backend(backend)
+    regex_n = len(regex_decomposition.states_to_index)
+    n = graph_matrices.nodes_num * regex_n
+    matrix = be.zeros((n, n))
+    for label in graph_matrices.matrices.keys() & regex_decomposition.decomposition:
+        matrix = be.add(
+            matrix,
+            be.kron(
+                be.from_scipy(graph_matrices.matrices[label]),
+                be.from_scipy(regex_decomposition.decomposition[label]),
+            ),
+        )
+    return be.to_scipy(matrix)
+
+
+def sources_reachability(
+    matrix: csr_matrix,
+    sources: np.ndarray,
+    stats: QueryStats = None,
+    backend: BackendLike = None,
+    limits: SearchLimits = None,
+    answer_keys: Callable[[csr_matrix], np.ndarray] = None,
+) -> csr_matrix:
+    """
+    Computes rows of the transitive closure only for the given sources:
+    the frontier of each source is propagated by sparse vector-matrix products until it is empty.
+    :param matrix: The adjacency matrix.
+    :param sources: Indexes of the source states.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param backend: The sparse backend or its name, see get_backend.
+    :param limits: If given, the propagation stops as soon as they are reached.
+    :param answer_keys: Maps a frontier to keys of the answers it contains, required to count answers for
+    limits with max_answers.
+    :return: Boolean matrix with a row per source marking states reachable by a non-empty path.
+    """
+    be = get_backend(backend)
+    matrix = be.from_scipy(matrix)
+    front = csr_matrix(
+        (
+            np.ones(len(sources), dtype=bool),
+            (np.arange(len(sources)), sources),
+        ),
+        shape=(len(sources), matrix.shape[0]),
+        dtype=bool,
+    )
+    front = be.from_scipy(front)
+    visited = be.zeros(front.shape)
+    found = np.zeros(0, dtype=np.int64)
+    path_length = 0
+    while be.nnz(front):
+        if limits is not None and limits.reached(path_length, len(found)):
+            if stats is not None:
+                stats.truncate(be.nnz(front))
+            break
+        path_length += 1
+        if stats is not None:
+            stats.iterations += 1
+            stats.update_peaks(be.nnz(front), be.nbytes(visited))
+        front = be.mask(be.matmul(front, matrix), visited)
+        visited = be.add(visited, front)
+        if limits is not None and limits.max_answers is not None:
+            found = np.union1d(found, answer_keys(be.to_scipy(front)))
+    if stats is not None:
+        stats.visited_states = be.nnz(visited)
+    return be.to_scipy(visited)
 
 
 def rpq(
-    graph: nx.MultiDiGraph,
+    graph: GraphLike,
     regex: Regex,
     start_states: Set[int] = None,
     final_states: Set[int] = None,
-) -> Set[Tuple[int, int]]:
-    gr_automation = graph_to_nfa(graph, start_states, final_states)
-    re_automation = regex_to_dfa(regex)
-    intersection = decomposition_intersection(
-        decompose_automaton(gr_automation), decompose_automaton(re_automation)
+    mode: str = "auto",
+    stats: QueryStats = None,
+    output: str = "set",
+    backend: BackendLike = None,
+    prune: bool = True,
+    max_path_length: int = None,
+    stop_when_found: Any = None,
+):
+    """
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
+    :param regex: The regular expression
+    :param start_states: The set of start vertices. If None, all vertices would be considered as start vertices.
+    :param final_states: The set of final vertices. If None, all vertices would be considered as final vertices.
+    :param mode: "closure" computes the transitive closure of the full tensor product,
+    "sources" computes closure rows only for the start vertices,
+    "lazy" expands only the part of the product reachable from the start vertices without building it,
+    "bidirectional" expands the product without building it from the start and the final vertices until they meet,
+    "auto" uses "bidirectional" when both start and final sets are small and the search ends within
+    BIDIRECTIONAL_MAX_DEPTH levels, "sources" for small start sets and "closure" otherwise.
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param output: The output format, see pairs_output, or "witnesses" for PathWitnesses with a shortest path
+    of every pair. Witnesses are recorded by the BFS of "lazy" mode whatever the mode is.
+    :param backend: The sparse backend or its name used by "sources" and "closure" modes, see get_backend.
+    :param prune: If True, "sources" and "closure" modes build the product over the graph pruned by prune_graph.
+    :param max_path_length: If given, only paths with at most this number of edges are considered.
+    :param stop_when_found: If given, the search stops early: "any" after the first answer, an integer k
+    after k answers, a pair (u, v) as soon as v is found reachable from u. At most that number of answers
+    is returned and "auto" mode avoids "closure", which does not support it.
+    Whether the search was cut short is reported by stats.truncated and stats.frontier_size.
+    :return: Pairs (start_node, end_node) connected by a path, corresponding to the regex
+    """
+    if output not in OUTPUT_FORMATS and output != "witnesses":
+        raise ValueError("Unknown output format: " + str(output))
+    limits, start_states, final_states = search_limits(
+        max_path_length, stop_when_found, start_states, final_states
     )
-    index_to_state = {v: k for k, v in intersection.states_to_index.items()}
-    n = len(intersection.states_to_index)
-    sum_matrix = sum(intersection.decomposition.values(), start=csr_matrix((n, n)))
-    closure_pairs = transitive_closure(sum_matrix)
-    result = set()
-    # states to indexes
-    start_indexes = {
-        intersection.states_to_index[state] for state in intersection.start_states
-    }
-    finish_indexes = {
-        intersection.states_to_index[state] for state in intersection.final_states
-    }
-    for start, finish in closure_pairs:
-        if start in start_indexes and finish in finish_indexes:
-            result.add((index_to_state[start][0], index_to_state[finish][0]))
-    return result
+    graph_matrices = as_graph_matrices(graph, start_states, final_states)
+    regex_decomposition = compile_regex(regex).decomposition
+    if output == "witnesses":
+        return witness_reachability(graph_matrices, regex_decomposition, stats, limits)
+    if mode == "auto" and (
+        np.count_nonzero(graph_matrices.start_mask) <= BIDIRECTIONAL_THRESHOLD
+        and np.count_nonzero(graph_matrices.final_mask) <= BIDIRECTIONAL_THRESHOLD
+    ):
+        found = _bounded_bidirectional_reachability(
+            graph_matrices, regex_decomposition, stats, limits
+        )
+        if found is not None:
+            rows, cols = limits.first_answers(*found, graph_matrices.nodes_num)
+            return pairs_output(graph_matrices, rows, cols, output)
+    if mode in ("lazy", "bidirectional"):
+        reachability = (
+            product_reachability if mode == "lazy" else bidirectional_reachability
+        )
+        rows, cols = reachability(graph_matrices, regex_decomposition, stats, limits)
+        rows, cols = limits.first_answers(rows, cols, graph_matrices.nodes_num)
+        return pairs_output(graph_matrices, rows, cols, output)
+    if mode not in ("auto", "sources", "closure"):
+        raise ValueError("Unknown rpq mode: " + str(mode))
+    if mode == "closure" and limits.max_answers is not None:
+        raise ValueError("closure mode does not support stop_when_found")
+    original_matrices = graph_matrices
+    if prune:
+        graph_matrices, kept = prune_graph(
+            graph_matrices, regex_decomposition.decomposition.keys()
+        )
+    else:
+        kept = np.arange(graph_matrices.nodes_num)
+
+    regex_n = len(regex_decomposition.states_to_index)
+    regex_starts = [
+        regex_decomposition.states_to_index[state]
+        for state in regex_decomposition.start_states
+    ]
+    regex_finals = [
+        regex_decomposition.states_to_index[state]
+        for state in regex_decomposition.final_states
+    ]
+    start_indexes = (
+        graph_matrices.start_indexes[:, None] * regex_n
+        + np.asarray(regex_starts, dtype=np.int64)
+    ).ravel()
+    final_indexes = (
+        graph_matrices.final_indexes[:, None] * regex_n
+        + np.asarray(regex_finals, dtype=np.int64)
+    ).ravel()
+    matrix = product_matrix(graph_matrices, regex_decomposition, backend)
+
+    if mode == "auto":
+        mode = (
+            "sources"
+            if limits.max_answers is not None
+            or len(start_indexes) <= SOURCES_CROSSOVER * matrix.shape[0]
+            else "closure"
+        )
+    if mode == "sources":
+
+        def answer_keys(front: csr_matrix) -> np.ndarray:
+            front_rows, front_cols = front[:, final_indexes].nonzero()
+            return (start_indexes[front_rows] // regex_n) * graph_matrices.nodes_num + (
+                final_indexes[front_cols] // regex_n
+            )
+
+        reachable = sources_reachability(
+            matrix, start_indexes, stats, backend, limits, answer_keys
+        )
+    else:
+        reachable = boolean_closure(
+            matrix,
+            stats=stats,
+            backend=backend,
+            max_path_length=limits.max_path_length,
+        )[start_indexes]
+    rows, cols = reachable[:, final_indexes].nonzero()
+    rows, cols = limits.first_answers(
+        kept[start_indexes[rows] // regex_n],
+        kept[final_indexes[cols] // regex_n],
+        original_matrices.nodes_num,
+    )
+    return pairs_output(original_matrices, rows, cols, output)
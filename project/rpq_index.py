@@ -0,0 +1,277 @@
+from typing import Any, Iterable, Set, Tuple
+
+import numpy as np
+from pyformlang.finite_automaton import Epsilon
+from pyformlang.finite_automaton.finite_automaton import to_symbol
+from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix, diags, kron
+
+from project.graph_matrices import (
+    OUTPUT_FORMATS,
+    GraphLike,
+    LabeledGraphMatrices,
+    as_graph_matrices,
+    pairs_output,
+    to_bool_csr,
+)
+from project.query_stats import QueryStats
+from project.rpq import (
+    boolean_closure,
+    compile_regex,
+    extend_closure,
+    product_matrix,
+    sources_reachability,
+)
+from project.sparse_backend import BackendLike
+
+
+def _resized(matrix: csr_matrix, n: int) -> csr_matrix:
+    # new rows and columns are appended empty, data and indices arrays are shared
+    indptr = np.concatenate(
+        [matrix.indptr, np.full(n - matrix.shape[0], matrix.indptr[-1])]
+    )
+    return csr_matrix((matrix.data, matrix.indices, indptr), shape=(n, n))
+
+
+class RPQIndex:
+    """
+    Standing regular path query over a changing graph.
+    The closure of the tensor product of the graph and the regex automaton is kept up to date:
+    inserted edges are propagated from the new product edges only, and on deletions closure rows are
+    re-derived only for the product states which could reach a removed product edge.
+    Answers are pairs connected by a non-empty path, as in rpq "closure" and "sources" modes.
+    Parallel edges with the same label are stored once, so removing such an edge removes all of them.
+    Epsilon edges of the initial graph are folded into the other labels, see LabeledGraphMatrices.from_edges,
+    and can not be added or removed later. Added edges are folded through their epsilon closure as well,
+    while edges can not be removed from a graph which had epsilon edges.
+    """
+
+    def __init__(
+        self,
+        graph: GraphLike,
+        regex: Regex,
+        start_nodes: Set[Any] = None,
+        final_nodes: Set[Any] = None,
+        stats: QueryStats = None,
+        backend: BackendLike = None,
+    ):
+        """
+        :param graph: The MultiDiGraph or LabeledGraphMatrices. It is copied, not modified.
+        :param regex: The regular expression
+        :param start_nodes: The start vertices. If None or empty, all vertices, including added later, are start vertices.
+        :param final_nodes: The final vertices. If None or empty, all vertices, including added later, are final vertices.
+        :param stats: If given, it would be filled with the statistics of all closure updates.
+        :param backend: The sparse backend or its name, see get_backend.
+        """
+        graph_matrices = as_graph_matrices(graph)
+        self.nodes = list(graph_matrices.nodes)
+        self.node_to_index = dict(graph_matrices.node_to_index)
+        self.matrices = dict(graph_matrices.matrices)
+        self._epsilon_closure = graph_matrices.epsilon_closure
+        self.start_nodes = set(start_nodes) if start_nodes else None
+        self.final_nodes = set(final_nodes) if final_nodes else None
+        self.stats = stats
+        self.backend = backend
+
+        self._regex = compile_regex(regex).decomposition
+        self._regex_n = len(self._regex.states_to_index)
+        self._regex_start_mask = np.zeros(self._regex_n, dtype=bool)
+        self._regex_start_mask[
+            [self._regex.states_to_index[state] for state in self._regex.start_states]
+        ] = True
+        self._regex_final_mask = np.zeros(self._regex_n, dtype=bool)
+        self._regex_final_mask[
+            [self._regex.states_to_index[state] for state in self._regex.final_states]
+        ] = True
+
+        self._product = product_matrix(self.graph_matrices(), self._regex, backend)
+        self._closure = boolean_closure(self._product, stats=stats, backend=backend)
+        self._answers = self._answers_from(
+            self._closure, np.arange(self._closure.shape[0])
+        )
+
+    @property
+    def nodes_num(self) -> int:
+        return len(self.nodes)
+
+    def graph_matrices(self) -> LabeledGraphMatrices:
+        """
+        :return: The current graph with the start and final vertices of the query.
+        """
+        graph_matrices = LabeledGraphMatrices(
+            self.nodes,
+            self.node_to_index,
+            self.matrices,
+            epsilon_closure=self._epsilon_closure,
+        )
+        return graph_matrices.with_start_final(self.start_nodes, self.final_nodes)
+
+    def _answers_from(self, closure_rows: csr_matrix, row_indexes: np.ndarray):
+        # node pairs of closure entries going from a start state to a final state
+        graph_matrices = self.graph_matrices()
+        rows, cols = closure_rows.nonzero()
+        rows = row_indexes[rows]
+        regex_n = self._regex_n
+        selected = (
+            self._regex_start_mask[rows % regex_n]
+            & self._regex_final_mask[cols % regex_n]
+            & graph_matrices.start_mask[rows // regex_n]
+            & graph_matrices.final_mask[cols // regex_n]
+        )
+        n = self.nodes_num
+        return csr_matrix(
+            (
+                np.ones(np.count_nonzero(selected), dtype=bool),
+                (rows[selected] // regex_n, cols[selected] // regex_n),
+            ),
+            shape=(n, n),
+            dtype=bool,
+        )
+
+    def _output(self, answers: csr_matrix, output: str):
+        rows, cols = answers.nonzero()
+        return pairs_output(self.graph_matrices(), rows, cols, output)
+
+    def _grow(self, nodes: Iterable[Any]):
+        for node in nodes:
+            if node not in self.node_to_index:
+                self.node_to_index[node] = len(self.nodes)
+                self.nodes.append(node)
+        n = self.nodes_num
+        if n == self._answers.shape[0]:
+            return
+        self.matrices = {
+            label: _resized(matrix, n) for label, matrix in self.matrices.items()
+        }
+        self._product = _resized(self._product, n * self._regex_n)
+        self._closure = _resized(self._closure, n * self._regex_n)
+        self._answers = _resized(self._answers, n)
+        if self._epsilon_closure is not None:
+            # added nodes have no epsilon edges, so they are closed only under themselves
+            added = np.arange(n) >= self._epsilon_closure.shape[0]
+            self._epsilon_closure = _resized(self._epsilon_closure, n) + diags(
+                added, dtype=bool, format="csr"
+            )
+
+    def _batch(self, edges: Iterable[Tuple[Any, Any, Any]]) -> LabeledGraphMatrices:
+        edges = list(edges)
+        if any(isinstance(to_symbol(label), Epsilon) for _, label, _ in edges):
+            raise ValueError("Epsilon edges can not be updated incrementally")
+        return LabeledGraphMatrices.from_edges(edges, nodes=self.nodes)
+
+    def result(self, output: str = "set"):
+        """
+        :param output: The output format, see pairs_output.
+        :return: The current answers.
+        """
+        if output not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format: " + str(output))
+        return self._output(self._answers, output)
+
+    def add_edges(self, edges: Iterable[Tuple[Any, Any, Any]], output: str = "set"):
+        """
+        Inserts a batch of edges. Unknown vertices are added to the graph.
+        :param edges: Triples (from_node, label, to_node).
+        :param output: The output format, see pairs_output.
+        :return: The answers which appeared after the insertion.
+        """
+        if output not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format: " + str(output))
+        batch = self._batch(edges)
+        self._grow(batch.nodes)
+        size = self.nodes_num * self._regex_n
+        product_delta = csr_matrix((size, size), dtype=bool)
+        for label, matrix in batch.matrices.items():
+            if self._epsilon_closure is not None:
+                # nodes reaching the tail by epsilon edges get the edge too, as in remove_epsilon_edges
+                matrix = to_bool_csr(self._epsilon_closure @ matrix)
+            if label in self.matrices:
+                matrix = matrix > self.matrices[label]
+                self.matrices[label] = self.matrices[label] + matrix
+            else:
+                self.matrices[label] = matrix
+            if label in self._regex.decomposition and matrix.nnz:
+                product_delta = product_delta + kron(
+                    matrix, self._regex.decomposition[label], format="csr"
+                )
+        product_delta = product_delta > self._product
+        self._product = self._product + product_delta
+
+        self._closure, added = extend_closure(
+            self._closure, product_delta, self.stats, self.backend
+        )
+        new_answers = self._answers_from(added, np.arange(size)) > self._answers
+        self._answers = self._answers + new_answers
+        return self._output(new_answers, output)
+
+    def remove_edges(self, edges: Iterable[Tuple[Any, Any, Any]], output: str = "set"):
+        """
+        Deletes a batch of edges. Edges which are not in the graph are ignored, vertices are kept.
+        :param edges: Triples (from_node, label, to_node).
+        :param output: The output format, see pairs_output.
+        :return: The answers which disappeared after the deletion.
+        """
+        if output not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format: " + str(output))
+        if self._epsilon_closure is not None:
+            raise ValueError("Edges can not be removed from a graph with epsilon edges")
+        batch = self._batch(
+            (u, label, v)
+            for u, label, v in edges
+            if u in self.node_to_index and v in self.node_to_index
+        )
+        size = self.nodes_num * self._regex_n
+        product_removed = csr_matrix((size, size), dtype=bool)
+        removed_sources = np.zeros(self.nodes_num, dtype=bool)
+        for label, matrix in batch.matrices.items():
+            if label not in self.matrices:
+                continue
+            matrix = matrix.multiply(self.matrices[label]).tocsr()
+            self.matrices[label] = self.matrices[label] > matrix
+            if label in self._regex.decomposition and matrix.nnz:
+                removed_sources[matrix.nonzero()[0]] = True
+                product_removed = product_removed + kron(
+                    matrix, self._regex.decomposition[label], format="csr"
+                )
+        # a product edge stays while an edge with another label still induces it
+        rows = diags(removed_sources, dtype=bool)
+        for label in self.matrices.keys() & self._regex.decomposition:
+            product_removed = product_removed > kron(
+                rows @ self.matrices[label],
+                self._regex.decomposition[label],
+                format="csr",
+            )
+        if not product_removed.nnz:
+            return self._output(csr_matrix(self._answers.shape, dtype=bool), output)
+        self._product = self._product > product_removed
+
+        # only states reaching the tail of a removed product edge could lose closure pairs
+        tails = np.zeros(size, dtype=bool)
+        tails[product_removed.nonzero()[0]] = True
+        affected = tails | (self._closure @ tails)
+        affected_rows = np.flatnonzero(affected)
+        rederived = sources_reachability(
+            self._product, affected_rows, self.stats, self.backend
+        ).tocoo()
+        self._closure = diags(~affected, dtype=bool) @ self._closure + csr_matrix(
+            (rederived.data, (affected_rows[rederived.row], rederived.col)),
+            shape=(size, size),
+            dtype=bool,
+        )
+
+        affected_nodes = np.unique(affected_rows // self._regex_n)
+        node_mask = np.zeros(self.nodes_num, dtype=bool)
+        node_mask[affected_nodes] = True
+        rows = (
+            affected_nodes[:, None] * self._regex_n + np.arange(self._regex_n)
+        ).ravel()
+        old_answers = diags(node_mask, dtype=bool) @ self._answers
+        new_answers = self._answers_from(self._closure[rows], rows)
+        self._answers = diags(~node_mask, dtype=bool) @ self._answers + new_answers
+        return self._output(old_answers > new_answers, output)
+
+    def add_edge(self, u: Any, label: Any, v: Any, output: str = "set"):
+        return self.add_edges([(u, label, v)], output)
+
+    def remove_edge(self, u: Any, label: Any, v: Any, output: str = "set"):
+        return self.remove_edges([(u, label, v)], output)
@@ -0,0 +1,222 @@
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix, eye, kron
+
+from project.graph_matrices import to_bool_csr
+
+try:
+    import graphblas
+except ImportError:  # the GraphBLAS backend is optional
+    graphblas = None
+
+# Name of the backend used when none is passed explicitly. Can be overridden with this environment variable.
+SPARSE_BACKEND_ENV = "CFPQ_SPARSE_BACKEND"
+DEFAULT_SPARSE_BACKEND = "scipy"
+
+
+class SparseBackend(ABC):
+    """
+    Boolean matrix operations used by the linear algebra RPQ and CFPQ algorithms.
+    Matrices enter and leave a backend as boolean scipy CSR matrices, the representation in between is
+    backend specific.
+    """
+
+    name: str
+
+    @abstractmethod
+    def from_scipy(self, matrix: csr_matrix) -> Any:
+        pass
+
+    @abstractmethod
+    def to_scipy(self, matrix: Any) -> csr_matrix:
+        pass
+
+    @abstractmethod
+    def zeros(self, shape: Tuple[int, int]) -> Any:
+        pass
+
+    def identity(self, n: int) -> Any:
+        return self.from_scipy(eye(n, dtype=bool, format="csr"))
+
+    @abstractmethod
+    def matmul(self, first: Any, second: Any) -> Any:
+        pass
+
+    @abstractmethod
+    def kron(self, first: Any, second: Any) -> Any:
+        pass
+
+    @abstractmethod
+    def add(self, first: Any, second: Any) -> Any:
+        """
+        :return: Element-wise disjunction of the matrices.
+        """
+
+    @abstractmethod
+    def mask(self, matrix: Any, excluded: Any) -> Any:
+        """
+        :return: Entries of matrix which are not set in excluded.
+        """
+
+    @abstractmethod
+    def nnz(self, matrix: Any) -> int:
+        pass
+
+    @abstractmethod
+    def nbytes(self, matrix: Any) -> int:
+        pass
+
+
+class ScipyBackend(SparseBackend):
+    name = "scipy"
+
+    def from_scipy(self, matrix: csr_matrix) -> csr_matrix:
+        return to_bool_csr(matrix)
+
+    def to_scipy(self, matrix: csr_matrix) -> csr_matrix:
+        return matrix
+
+    def zeros(self, shape: Tuple[int, int]) -> csr_matrix:
+        return csr_matrix(shape, dtype=bool)
+
+    def matmul(self, first: csr_matrix, second: csr_matrix) -> csr_matrix:
+        return first @ second
+
+    def kron(self, first: csr_matrix, second: csr_matrix) -> csr_matrix:
+        return kron(first, second, format="csr")
+
+    def add(self, first: csr_matrix, second: csr_matrix) -> csr_matrix:
+        return first + second
+
+    def mask(self, matrix: csr_matrix, excluded: csr_matrix) -> csr_matrix:
+        return matrix > excluded
+
+    def nnz(self, matrix: csr_matrix) -> int:
+        return matrix.nnz
+
+    def nbytes(self, matrix: csr_matrix) -> int:
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+@dataclass
+class PackedBits:
+    """
+    Dense boolean matrix with every row packed into bytes, 8 columns per byte.
+    """
+
+    bits: np.ndarray
+    shape: Tuple[int, int]
+
+
+class PackedBitBackend(SparseBackend):
+    """
+    Dense packed-bit matrices: one bit per entry regardless of the number of nonzeros.
+    Intended for small dense automata and products, where CSR indexes cost more than the entries.
+    """
+
+    name = "packed"
+
+    @staticmethod
+    def _unpack(matrix: PackedBits) -> np.ndarray:
+        return np.unpackbits(matrix.bits, axis=1, count=matrix.shape[1]).astype(bool)
+
+    @staticmethod
+    def _pack(array: np.ndarray) -> PackedBits:
+        return PackedBits(np.packbits(array, axis=1), array.shape)
+
+    def from_scipy(self, matrix: csr_matrix) -> PackedBits:
+        return self._pack(to_bool_csr(matrix).toarray())
+
+    def to_scipy(self, matrix: PackedBits) -> csr_matrix:
+        return csr_matrix(self._unpack(matrix))
+
+    def zeros(self, shape: Tuple[int, int]) -> PackedBits:
+        return PackedBits(np.zeros((shape[0], (shape[1] + 7) // 8), np.uint8), shape)
+
+    def matmul(self, first: PackedBits, second: PackedBits) -> PackedBits:
+        # row i of the product is the disjunction of rows of second selected by row i of first
+        left = self._unpack(first)
+        bits = np.zeros((first.shape[0], second.bits.shape[1]), dtype=np.uint8)
+        for j in np.flatnonzero(left.any(axis=0)):
+            bits[left[:, j]] |= second.bits[j]
+        return PackedBits(bits, (first.shape[0], second.shape[1]))
+
+    def kron(self, first: PackedBits, second: PackedBits) -> PackedBits:
+        return self._pack(np.kron(self._unpack(first), self._unpack(second)))
+
+    def add(self, first: PackedBits, second: PackedBits) -> PackedBits:
+        return PackedBits(first.bits | second.bits, first.shape)
+
+    def mask(self, matrix: PackedBits, excluded: PackedBits) -> PackedBits:
+        return PackedBits(matrix.bits & ~excluded.bits, matrix.shape)
+
+    def nnz(self, matrix: PackedBits) -> int:
+        return int(np.unpackbits(matrix.bits).sum())
+
+    def nbytes(self, matrix: PackedBits) -> int:
+        return matrix.bits.nbytes
+
+
+class GraphBLASBackend(SparseBackend):
+    """
+    SuiteSparse:GraphBLAS through python-graphblas, matrices are multiplied over the lor_land semiring.
+    """
+
+    name = "graphblas"
+
+    def from_scipy(self, matrix: csr_matrix) -> Any:
+        return graphblas.io.from_scipy_sparse(to_bool_csr(matrix))
+
+    def to_scipy(self, matrix: Any) -> csr_matrix:
+        return to_bool_csr(graphblas.io.to_scipy_sparse(matrix, format="csr"))
+
+    def zeros(self, shape: Tuple[int, int]) -> Any:
+        return graphblas.Matrix(bool, shape[0], shape[1])
+
+    def matmul(self, first: Any, second: Any) -> Any:
+        return first.mxm(second, graphblas.semiring.lor_land).new()
+
+    def kron(self, first: Any, second: Any) -> Any:
+        return first.kronecker(second, graphblas.binary.land).new()
+
+    def add(self, first: Any, second: Any) -> Any:
+        return first.ewise_add(second, graphblas.binary.lor).new()
+
+    def mask(self, matrix: Any, excluded: Any) -> Any:
+        return matrix.dup(mask=~excluded.S)
+
+    def nnz(self, matrix: Any) -> int:
+        return matrix.nvals
+
+    def nbytes(self, matrix: Any) -> int:
+        return matrix.ss.nbytes
+
+
+BACKENDS = {
+    ScipyBackend.name: ScipyBackend,
+    PackedBitBackend.name: PackedBitBackend,
+}
+if graphblas is not None:
+    BACKENDS[GraphBLASBackend.name] = GraphBLASBackend
+
+BackendLike = Union[str, SparseBackend, None]
+
+
+def get_backend(backend: BackendLike = None) -> SparseBackend:
+    """
+    :param backend: The backend or its name. If None, the SPARSE_BACKEND_ENV variable or DEFAULT_SPARSE_BACKEND is used.
+    :return: The sparse backend
+    """
+    if isinstance(backend, SparseBackend):
+        return backend
+    if backend is None:
+        backend = os.environ.get(SPARSE_BACKEND_ENV, DEFAULT_SPARSE_BACKEND)
+    if backend == GraphBLASBackend.name and graphblas is None:
+        raise ValueError("The graphblas backend requires python-graphblas")
+    if backend not in BACKENDS:
+        raise ValueError("Unknown sparse backend: " + str(backend))
+    return BACKENDS[backend]()
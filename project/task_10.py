@@ -1,43 +1,55 @@
-from typing import Set, Tuple
+from collections import defaultdict
+from typing import Any, Dict, Set, Tuple
 
-from networkx import MultiDiGraph
+import numpy as np
 from pyformlang.cfg import CFG, Variable
 from pyformlang.finite_automaton import EpsilonNFA, State
 from scipy.sparse import eye, csr_matrix
 
+from project.graph_matrices import (
+    GraphLike,
+    LabeledGraphMatrices,
+    as_graph_matrices,
+    matrix_pairs_output,
+)
+from project.query_stats import QueryStats
+from project.sparse_backend import BackendLike, get_backend
 from project.rpq import (
+    boolean_closure,
     decompose_automaton,
-    decomposition_intersection,
-    transitive_closure,
+    decompose_graph,
+    extend_closure,
 )
 from project.task_7 import cfg_to_ecfg, ecfg_to_rsm, minimize_rsm
 
 
 def cfpq_tensors(
-    graph: MultiDiGraph,
+    graph: GraphLike,
     cfg: CFG,
     start: Set = None,
     finish: Set = None,
     start_nonterminal: Variable = Variable("S"),
-) -> Set[Tuple]:
+    stats: QueryStats = None,
+    output: str = "set",
+    backend: BackendLike = None,
+):
     """
-    :param graph: The graph
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
     :param cfg: The context-free grammar
     :param start: The set of start vertices
     :param finish: The set of final vertices
-    :return: Set of tuples (start_node, end_node). Pairs of vertices which are connected by a path, corresponding to a cfg
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param output: The output format, see pairs_output.
+    :param backend: The sparse backend or its name, see get_backend.
+    :return: Pairs (start_node, end_node) of vertices which are connected by a path, corresponding to a cfg
     """
-    if start is None:
-        start = set(graph.nodes())
-    if finish is None:
-        finish = set(graph.nodes())
-
-    r = tensors_algo(cfg, graph)
-    result = set()
-    for (u, N, v) in r:
-        if u in start and v in finish and N == start_nonterminal.value:
-            result.add((u, v))
-    return result
+    graph_matrices = as_graph_matrices(graph)
+    decomposition = tensors_closure(cfg, graph_matrices, stats, backend)
+    matrix = decomposition.get(
+        start_nonterminal.value,
+        csr_matrix((graph_matrices.nodes_num, graph_matrices.nodes_num), dtype=bool),
+    )
+    return matrix_pairs_output(graph_matrices, matrix, start, finish, output)
 
 
 def cfg_to_automation(cfg: CFG) -> EpsilonNFA:
@@ -56,12 +68,22 @@ def cfg_to_automation(cfg: CFG) -> EpsilonNFA:
     return automation
 
 
-def tensors_algo(cfg: CFG, graph: MultiDiGraph) -> Set[Tuple]:
+def tensors_closure(
+    cfg: CFG,
+    graph_matrices: LabeledGraphMatrices,
+    stats: QueryStats = None,
+    backend: BackendLike = None,
+) -> Dict[Any, csr_matrix]:
     """
+    Incremental tensor CFPQ: the closure of the product of the RSM and the graph is computed once
+    and then only extended with product edges of the nonterminal edges found in the previous round.
     :param cfg: The context-free grammar
-    :param graph: The graph
-    :return: Set of tuples (start_node, nonterminal, end_node). Pairs of vertices which are connected by a path, corresponding to a cfg
+    :param graph_matrices: The graph
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param backend: The sparse backend or its name used for products and closures, see get_backend.
+    :return: Boolean matrices over node indexes for each graph label and each nonterminal
     """
+    be = get_backend(backend)
     cfg_decomposition = decompose_automaton(cfg_to_automation(cfg))
     # add paths for epsilons
     nullable = cfg.get_nullable_symbols()
@@ -72,50 +94,90 @@ def tensors_algo(cfg: CFG, graph: MultiDiGraph) -> Set[Tuple]:
         else:
             cfg_decomposition.decomposition[nonterm] += eye(n, n, dtype=bool)
 
-    graph_decomposition = decompose_automaton(
-        EpsilonNFA.from_networkx(graph).remove_epsilon_transitions()
-    )
+    graph_decomposition = decompose_graph(graph_matrices)
     # index to states
     cfg_index_to_state = {v: k for k, v in cfg_decomposition.states_to_index.items()}
-    graph_index_to_state = {
-        v: k for k, v in graph_decomposition.states_to_index.items()
-    }
-    closure_nnz = -1
-    is_continue = True
-    while is_continue:
-        intersection = decomposition_intersection(
-            cfg_decomposition, graph_decomposition
+    graph_n = len(graph_decomposition.states_to_index)
+    cfg_n = len(cfg_decomposition.states_to_index)
+    # product state (cfg state i, graph node j) has index i * graph_n + j
+    cfg_vars = [cfg_index_to_state[i][0] for i in range(cfg_n)]
+    cfg_start_mask = np.zeros(cfg_n, dtype=bool)
+    cfg_start_mask[
+        [cfg_decomposition.states_to_index[st] for st in cfg_decomposition.start_states]
+    ] = True
+    cfg_final_mask = np.zeros(cfg_n, dtype=bool)
+    cfg_final_mask[
+        [cfg_decomposition.states_to_index[st] for st in cfg_decomposition.final_states]
+    ] = True
+
+    size = cfg_n * graph_n
+    product = be.zeros((size, size))
+    for label in (
+        cfg_decomposition.decomposition.keys()
+        & graph_decomposition.decomposition.keys()
+    ):
+        product = be.add(
+            product,
+            be.kron(
+                be.from_scipy(cfg_decomposition.decomposition[label]),
+                be.from_scipy(graph_decomposition.decomposition[label]),
+            ),
         )
-        sum_matrix = sum(intersection.decomposition.values())
-        closure_pairs = transitive_closure(sum_matrix)
-        if closure_nnz == len(closure_pairs):
-            is_continue = False
-        closure_nnz = len(closure_pairs)
-        for start, finish in closure_pairs:
-            n = len(graph_decomposition.states_to_index)
-            cfg_i = start // n
-            cfg_j = finish // n
-            graph_i = start % n
-            graph_j = finish % n
-            var = cfg_index_to_state[cfg_i][0]
-            if (
-                cfg_index_to_state[cfg_i] in cfg_decomposition.start_states
-                and cfg_index_to_state[cfg_j] in cfg_decomposition.final_states
-            ):
-                if var not in graph_decomposition.decomposition:
-                    graph_decomposition.decomposition[var] = csr_matrix(
-                        (
-                            len(graph_decomposition.states_to_index),
-                            len(graph_decomposition.states_to_index),
-                        ),
-                        dtype=bool,
-                    )
-                graph_decomposition.decomposition[var][graph_i, graph_j] = True
-    result = set()
-    for var, matrix in graph_decomposition.decomposition.items():
-        for i in range(matrix.shape[0]):
-            for j in range(matrix.shape[1]):
-                if matrix[i, j]:
-                    result.add((graph_index_to_state[i], var, graph_index_to_state[j]))
+    closure = boolean_closure(be.to_scipy(product), stats=stats, backend=be)
+    added = closure
 
+    while added.nnz:
+        rows, cols = added.nonzero()
+        cfg_i, cfg_j = rows // graph_n, cols // graph_n
+        selected = cfg_start_mask[cfg_i] & cfg_final_mask[cfg_j]
+        # batch new nonterminal edges per nonterminal
+        new_edges = defaultdict(lambda: ([], []))
+        for i, graph_i, graph_j in zip(
+            cfg_i[selected], rows[selected] % graph_n, cols[selected] % graph_n
+        ):
+            new_edges[cfg_vars[i]][0].append(graph_i)
+            new_edges[cfg_vars[i]][1].append(graph_j)
+
+        product_delta = be.zeros((size, size))
+        for var, (graph_rows, graph_cols) in new_edges.items():
+            edges = csr_matrix(
+                (np.ones(len(graph_rows), dtype=bool), (graph_rows, graph_cols)),
+                shape=(graph_n, graph_n),
+                dtype=bool,
+            )
+            if var in graph_decomposition.decomposition:
+                edges = edges > graph_decomposition.decomposition[var]
+                graph_decomposition.decomposition[var] = (
+                    graph_decomposition.decomposition[var] + edges
+                )
+            else:
+                graph_decomposition.decomposition[var] = edges
+            if var in cfg_decomposition.decomposition and edges.nnz:
+                product_delta = be.add(
+                    product_delta,
+                    be.kron(
+                        be.from_scipy(cfg_decomposition.decomposition[var]),
+                        be.from_scipy(edges),
+                    ),
+                )
+        closure, added = extend_closure(closure, be.to_scipy(product_delta), stats, be)
+
+    return graph_decomposition.decomposition
+
+
+def tensors_algo(
+    cfg: CFG, graph: GraphLike, stats: QueryStats = None, backend: BackendLike = None
+) -> Set[Tuple]:
+    """
+    :param cfg: The context-free grammar
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param backend: The sparse backend or its name, see get_backend.
+    :return: Set of tuples (start_node, nonterminal, end_node). Pairs of vertices which are connected by a path, corresponding to a cfg
+    """
+    graph_matrices = as_graph_matrices(graph)
+    result = set()
+    for var, matrix in tensors_closure(cfg, graph_matrices, stats, backend).items():
+        for i, j in zip(*matrix.nonzero()):
+            result.add((graph_matrices.nodes[i], var, graph_matrices.nodes[j]))
     return result
@@ -1,98 +1,104 @@
-from typing import List, Tuple, Set
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Tuple, Set
 
-from networkx import MultiDiGraph
-from pyformlang.cfg import CFG, Variable, Terminal
+import numpy as np
+from pyformlang.cfg import CFG, Variable
+from scipy.sparse import csr_matrix
 
+from project.graph_matrices import GraphLike, as_graph_matrices, matrix_pairs_output
 from project.task_6 import cfg_to_weak_cnf
 
 
-def hellings(cfg: CFG, graph: MultiDiGraph) -> List[Tuple]:
+def hellings(cfg: CFG, graph: GraphLike) -> List[Tuple]:
     """
     :param cfg: The context-free grammar
-    :param graph: The graph
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
     :return: List of tuples (start_node, nonterminal, end_node)
     """
+    graph_matrices = as_graph_matrices(graph)
     weak_cnf = cfg_to_weak_cnf(cfg)
-    term_prods = []
-    nonterm_prods = []
+    # productions indexed by body, heads are converted to text once
+    term_prods: Dict[str, List[str]] = defaultdict(list)
+    by_left: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+    by_right: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
     epsilons = []
     for prod in weak_cnf.productions:
+        head = prod.head.to_text()
         if len(prod.body) == 1:
-            term_prods.append(prod)
+            term_prods[prod.body[0].to_text()].append(head)
         elif len(prod.body) == 2:
-            nonterm_prods.append(prod)
+            left, right = prod.body[0].to_text(), prod.body[1].to_text()
+            by_left[left].append((right, head))
+            by_right[right].append((left, head))
         else:
-            epsilons.append(prod)
+            epsilons.append(head)
 
     paths_from_nonterminals_list = []
-    edges = graph.edges(data="label")
-    for (u, v, label) in edges:
-        for prod in term_prods:
-            if label == prod.body[0].to_text():
-                paths_from_nonterminals_list.append((u, prod.head.to_text(), v))
-    for node in graph.nodes():
-        for prod in epsilons:
-            paths_from_nonterminals_list.append((node, prod.head.to_text(), node))
-    paths_from_nonterminals_queue = paths_from_nonterminals_list.copy()
-    while len(paths_from_nonterminals_queue) > 0:
-        (u, N, v) = paths_from_nonterminals_queue.pop(0)
+    known = set()
+    # incoming[v][N] = {u | (u, N, v)}, outgoing[u][N] = {v | (u, N, v)}
+    incoming: Dict[Any, Dict[str, Set]] = defaultdict(lambda: defaultdict(set))
+    outgoing: Dict[Any, Dict[str, Set]] = defaultdict(lambda: defaultdict(set))
+    queue = deque()
 
-        for (a, NT, b) in paths_from_nonterminals_list:
-            if u == b:
-                for prod in nonterm_prods:
-                    if NT == prod.body[0].to_text() and N == prod.body[1].to_text():
-                        if (
-                            a,
-                            prod.head.to_text(),
-                            v,
-                        ) not in paths_from_nonterminals_list:
-                            paths_from_nonterminals_list.append(
-                                (a, prod.head.to_text(), v)
-                            )
-                            paths_from_nonterminals_queue.append(
-                                (a, prod.head.to_text(), v)
-                            )
+    def add_path(u, N, v):
+        if (u, N, v) in known:
+            return
+        known.add((u, N, v))
+        paths_from_nonterminals_list.append((u, N, v))
+        incoming[v][N].add(u)
+        outgoing[u][N].add(v)
+        queue.append((u, N, v))
 
-        for (a, NT, b) in paths_from_nonterminals_list:
-            if v == a:
-                for prod in nonterm_prods:
-                    if NT == prod.body[1].to_text() and N == prod.body[0].to_text():
-                        if (
-                            u,
-                            prod.head.to_text(),
-                            b,
-                        ) not in paths_from_nonterminals_list:
-                            paths_from_nonterminals_list.append(
-                                (u, prod.head.to_text(), b)
-                            )
-                            paths_from_nonterminals_queue.append(
-                                (u, prod.head.to_text(), b)
-                            )
+    for label, heads in term_prods.items():
+        if label not in graph_matrices.matrices:
+            continue
+        for i, j in zip(*graph_matrices.matrices[label].nonzero()):
+            u, v = graph_matrices.nodes[i], graph_matrices.nodes[j]
+            for head in heads:
+                add_path(u, head, v)
+    for node in graph_matrices.nodes:
+        for head in epsilons:
+            add_path(node, head, node)
+
+    while queue:
+        (u, N, v) = queue.popleft()
+        # (a, NT, u) + (u, N, v) -> (a, head, v) for head -> NT N
+        for NT, head in by_right.get(N, ()):
+            for a in list(incoming[u].get(NT, ())):
+                add_path(a, head, v)
+        # (u, N, v) + (v, NT, b) -> (u, head, b) for head -> N NT
+        for NT, head in by_left.get(N, ()):
+            for b in list(outgoing[v].get(NT, ())):
+                add_path(u, head, b)
     return paths_from_nonterminals_list
 
 
 def cfpq_hellings(
-    graph: MultiDiGraph,
+    graph: GraphLike,
     cfg: CFG,
     start: Set = None,
     finish: Set = None,
     start_nonterminal: Variable = Variable("S"),
-) -> Set[Tuple]:
+    output: str = "set",
+):
     """
-    :param graph: The graph
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
     :param cfg: The context-free grammar
     :param start: The set of start vertices
     :param finish: The set of final vertices
-    :return: Set of tuples (start_node, end_node). Pairs of vertices which are connected by a path, corresponding to a cfg
+    :param output: The output format, see pairs_output.
+    :return: Pairs (start_node, end_node) of vertices which are connected by a path, corresponding to a cfg
     """
-    if start is None:
-        start = set(graph.nodes())
-    if finish is None:
-        finish = set(graph.nodes())
-
-    r = hellings(cfg, graph)
-    result = set()
-    for (u, N, v) in r:
-        if u in start and v in finish and N == start_nonterminal:
-            result.add((u, v))
-    return result
+    graph_matrices = as_graph_matrices(graph)
+    pairs = [
+        (graph_matrices.node_to_index[u], graph_matrices.node_to_index[v])
+        for (u, N, v) in hellings(cfg, graph_matrices)
+        if N == start_nonterminal
+    ]
+    rows, cols = np.asarray(pairs, dtype=np.int64).reshape(-1, 2).T
+    matrix = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)),
+        shape=(graph_matrices.nodes_num, graph_matrices.nodes_num),
+        dtype=bool,
+    )
+    return matrix_pairs_output(graph_matrices, matrix, start, finish, output)
@@ -1,18 +1,37 @@
-from typing import Set, Tuple
+import time
+from typing import Dict, Set, Tuple
 
-from networkx import MultiDiGraph
 from pyformlang.cfg import CFG, Variable
-from scipy.sparse import dok_matrix
+from scipy.sparse import csr_matrix
 
+from project.graph_matrices import (
+    GraphLike,
+    LabeledGraphMatrices,
+    as_graph_matrices,
+    matrix_pairs_output,
+)
+from project.query_stats import QueryStats
+from project.sparse_backend import BackendLike, get_backend
 from project.task_6 import cfg_to_weak_cnf
 
 
-def matrices_algo(cfg: CFG, graph: MultiDiGraph) -> Set[Tuple]:
+def matrices_closure(
+    cfg: CFG,
+    graph_matrices: LabeledGraphMatrices,
+    stats: QueryStats = None,
+    backend: BackendLike = None,
+) -> Dict[str, csr_matrix]:
     """
+    Semi-naive matrix CFPQ: every round only productions with changed body nonterminals are evaluated,
+    and only with the pairs added in the previous round: dA = dB @ C + B @ dC.
     :param cfg: The context-free grammar
-    :param graph: The graph
-    :return: Set of tuples (start_node, end_node)
+    :param graph_matrices: The graph
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param backend: The sparse backend or its name, see get_backend.
+    :return: Boolean matrices over node indexes for each nonterminal of the weak CNF
     """
+    be = get_backend(backend)
+    begin = time.perf_counter()
     weak_cnf = cfg_to_weak_cnf(cfg)
     term_prods = set()
     nonterm_prods = set()
@@ -24,64 +43,103 @@ def matrices_algo(cfg: CFG, graph: MultiDiGraph) -> Set[Tuple]:
             nonterm_prods.add(prod)
         else:
             epsilons.add(prod)
-    nodes_num = graph.number_of_nodes()
+    nodes_num = graph_matrices.nodes_num
     nonterm_to_matrix = {}
     for variable in weak_cnf.variables:
-        nonterm_to_matrix[variable.value] = dok_matrix(
-            (nodes_num, nodes_num), dtype=bool
+        nonterm_to_matrix[variable.value] = be.zeros((nodes_num, nodes_num))
+    for prod in epsilons:
+        nonterm_to_matrix[prod.head.value] = be.add(
+            nonterm_to_matrix[prod.head.value], be.identity(nodes_num)
         )
-    for node in graph.nodes:
-        for prod in epsilons:
-            nonterm_to_matrix[prod.head.value][node, node] = True
 
-    for (u, v, label) in graph.edges(data="label"):
-        for prod in term_prods:
-            if prod.body[0].value == label:
-                nonterm_to_matrix[prod.head.value][u, v] = True
+    for prod in term_prods:
+        if prod.body[0].value in graph_matrices.matrices:
+            nonterm_to_matrix[prod.head.value] = be.add(
+                nonterm_to_matrix[prod.head.value],
+                be.from_scipy(graph_matrices.matrices[prod.body[0].value]),
+            )
 
-    changed = True
+    nonterm_prods = [
+        (prod.head.value, prod.body[0].value, prod.body[1].value)
+        for prod in nonterm_prods
+    ]
+    delta = dict(nonterm_to_matrix)
 
+    changed = {nont for nont, matrix in delta.items() if be.nnz(matrix)}
     while changed:
-        changed = False
-        for prod in nonterm_prods:
-            prevnnz = nonterm_to_matrix[prod.head.value].count_nonzero()
-            nonterm_to_matrix[prod.head.value] += (
-                nonterm_to_matrix[prod.body[0].value]
-                @ nonterm_to_matrix[prod.body[1].value]
+        if stats is not None:
+            stats.iterations += 1
+        renewed = {}
+        for head, left, right in nonterm_prods:
+            if left not in changed and right not in changed:
+                continue
+            product = be.add(
+                be.matmul(delta[left], nonterm_to_matrix[right]),
+                be.matmul(nonterm_to_matrix[left], delta[right]),
             )
-            if nonterm_to_matrix[prod.head.value].count_nonzero() != prevnnz:
-                changed = True
+            renewed[head] = (
+                be.add(renewed[head], product) if head in renewed else product
+            )
+        delta = {}
+        changed = set()
+        for nont, matrix in nonterm_to_matrix.items():
+            if nont in renewed:
+                delta[nont] = be.mask(renewed[nont], matrix)
+                nonterm_to_matrix[nont] = be.add(matrix, delta[nont])
+                if be.nnz(delta[nont]):
+                    changed.add(nont)
+            else:
+                delta[nont] = be.zeros((nodes_num, nodes_num))
+
+    result = {nont: be.to_scipy(matrix) for nont, matrix in nonterm_to_matrix.items()}
+    if stats is not None:
+        stats.visited_states = sum(matrix.nnz for matrix in result.values())
+        stats.elapsed_seconds += time.perf_counter() - begin
+    return result
 
-    res = set()
 
-    for (nont, matrix) in nonterm_to_matrix.items():
-        for elem in zip(*matrix.nonzero()):
-            res.add((elem[0], nont, elem[1]))
+def matrices_algo(
+    cfg: CFG, graph: GraphLike, stats: QueryStats = None, backend: BackendLike = None
+) -> Set[Tuple]:
+    """
+    :param cfg: The context-free grammar
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param backend: The sparse backend or its name, see get_backend.
+    :return: Set of tuples (start_node, nonterminal, end_node)
+    """
+    graph_matrices = as_graph_matrices(graph)
+    res = set()
+    for nont, matrix in matrices_closure(cfg, graph_matrices, stats, backend).items():
+        for i, j in zip(*matrix.nonzero()):
+            res.add((graph_matrices.nodes[i], nont, graph_matrices.nodes[j]))
     return res
 
 
 def cfpq_matrices(
-    graph: MultiDiGraph,
+    graph: GraphLike,
     cfg: CFG,
     start: Set = None,
     finish: Set = None,
     start_nonterminal: Variable = Variable("S"),
-) -> Set[Tuple]:
+    stats: QueryStats = None,
+    output: str = "set",
+    backend: BackendLike = None,
+):
     """
-    :param graph: The graph
+    :param graph: The MultiDiGraph or LabeledGraphMatrices
     :param cfg: The context-free grammar
     :param start: The set of start vertices
     :param finish: The set of final vertices
-    :return: Set of tuples (start_node, end_node). Pairs of vertices which are connected by a path, corresponding to a cfg
+    :param stats: If given, it would be filled with the evaluation statistics.
+    :param output: The output format, see pairs_output.
+    :param backend: The sparse backend or its name, see get_backend.
+    :return: Pairs (start_node, end_node) of vertices which are connected by a path, corresponding to a cfg
     """
-    if start is None:
-        start = set(graph.nodes())
-    if finish is None:
-        finish = set(graph.nodes())
-
-    r = matrices_algo(cfg, graph)
-    result = set()
-    for (u, N, v) in r:
-        if u in start and v in finish and N == start_nonterminal.value:
-            result.add((u, v))
-    return result
+    graph_matrices = as_graph_matrices(graph)
+    nonterm_to_matrix = matrices_closure(cfg, graph_matrices, stats, backend)
+    matrix = nonterm_to_matrix.get(
+        start_nonterminal.value,
+        csr_matrix((graph_matrices.nodes_num, graph_matrices.nodes_num), dtype=bool),
+    )
+    return matrix_pairs_output(graph_matrices, matrix, start, finish, output)
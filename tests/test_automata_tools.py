@@ -2,6 +2,7 @@ import networkx as nx
 from pyformlang.finite_automaton import (
     DeterministicFiniteAutomaton,
     NondeterministicFiniteAutomaton,
+    Symbol,
 )
 from pyformlang.regular_expression import Regex
 
@@ -57,6 +58,16 @@ def test_simple_graph_to_automaton():
     assert expected.minimize() == automaton
 
 
+def test_epsilon_graph_to_nfa():
+    graph = nx.MultiDiGraph(
+        [(0, 1, {"label": "a"}), (1, 2, {"label": "epsilon"}), (2, 3, {"label": "b"})]
+    )
+    automaton = finite_automata_tools.graph_to_nfa(graph, {0}, {3})
+    assert automaton.symbols == {Symbol("a"), Symbol("b")}
+    assert automaton.accepts([Symbol("a"), Symbol("b")])
+    assert not automaton.accepts([Symbol("a")])
+
+
 def test_synthetic_graph_to_nfa():
     expected = NondeterministicFiniteAutomaton()
     expected.add_start_state(0)
@@ -103,3 +114,18 @@ def test_graph_without_labels_to_nfa():
     assert automata.get_number_transitions() == 0
     assert automata.final_states == {1, 2, 3}
     assert automata.start_states == {1, 2, 3}
+
+
+def test_graph_to_nfa_does_not_modify_graph():
+    graph = graph_module.generate_two_cycles_graph(3, 3, ("a", "b"))
+    finite_automata_tools.graph_to_nfa(graph, {0}, {1})
+    assert all(len(data) == 0 for _, data in graph.nodes(data=True))
+
+
+def test_graph_with_epsilon_to_nfa():
+    graph = nx.MultiDiGraph(
+        [(0, 1, {"label": "a"}), (1, 2, {"label": "epsilon"}), (2, 3, {"label": "b"})]
+    )
+    automaton = finite_automata_tools.graph_to_nfa(graph, {0}, {3})
+    assert automaton.accepts(["a", "b"])
+    assert not automaton.accepts(["a"])
@@ -1,7 +1,14 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pytest
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, Symbol, State
 from pyformlang.regular_expression import Regex
 
-from project.bfs_rpq import bfs_rpq
+from project import bfs_rpq as bfs_rpq_module
+from project.bfs_rpq import bfs_rpq, bfs_rpq_chunks
+from project.query_stats import QueryStats
 
 
 def test_1():
@@ -94,3 +101,89 @@ def test_5():
         (1, 7),
         (1, 6),
     }
+
+
+def test_cycles():
+    automaton = NondeterministicFiniteAutomaton()
+    automaton.add_transitions(
+        [
+            (State(0), Symbol("a"), State(1)),
+            (State(1), Symbol("a"), State(2)),
+            (State(2), Symbol("a"), State(0)),
+            (State(2), Symbol("b"), State(3)),
+            (State(3), Symbol("b"), State(3)),
+        ]
+    )
+    graph = automaton.to_networkx()
+    assert bfs_rpq(graph, Regex("a*.b*"), {0}) == {0, 1, 2, 3}
+    assert bfs_rpq(graph, Regex("(a.a.a)*"), {0}) == {0}
+    assert bfs_rpq(graph, Regex("a*.b"), {0, 3}, for_each_node=True) == {
+        (0, 3),
+        (1, 3),
+    }
+
+
+def test_chunks():
+    automaton = NondeterministicFiniteAutomaton()
+    automaton.add_transitions(
+        [
+            (State(i), Symbol("a" if i % 3 else "b"), State((i * 7 + 1) % 20))
+            for i in range(20)
+        ]
+        + [(State(i), Symbol("a"), State((i + 1) % 20)) for i in range(20)]
+    )
+    graph = automaton.to_networkx()
+    regex = Regex("a*.b.a")
+    expected = bfs_rpq(graph, regex, for_each_node=True)
+    assert bfs_rpq(graph, regex, for_each_node=True, chunk_size=3) == expected
+    assert (
+        bfs_rpq(graph, regex, for_each_node=True, chunk_size=6, workers=2) == expected
+    )
+    chunks = list(bfs_rpq_chunks(graph, regex, chunk_size=5))
+    assert len(chunks) == 4
+    assert set().union(*chunks) == expected
+
+
+def test_chunks_spawned_workers(monkeypatch):
+    # spawned workers get another string hash seed, so nothing hashed in the parent may reach them
+    monkeypatch.setattr(
+        bfs_rpq_module,
+        "ProcessPoolExecutor",
+        partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn")),
+    )
+    automaton = NondeterministicFiniteAutomaton()
+    automaton.add_transitions(
+        [
+            (State(i), Symbol("a" if i % 3 else "b"), State((i + 1) % 12))
+            for i in range(12)
+        ]
+    )
+    graph = automaton.to_networkx()
+    regex = Regex("a*.b.a")
+    expected = bfs_rpq(graph, regex, for_each_node=True)
+    assert (
+        bfs_rpq(graph, regex, for_each_node=True, chunk_size=4, workers=2) == expected
+    )
+
+
+def test_limits():
+    automaton = NondeterministicFiniteAutomaton()
+    automaton.add_transitions(
+        [(State(i), Symbol("a"), State(i + 1)) for i in range(5)]
+        + [(State(0), Symbol("b"), State(5))]
+    )
+    graph = automaton.to_networkx()
+    regex = Regex("a*")
+    stats = QueryStats()
+    assert bfs_rpq(graph, regex, {0}, max_path_length=2, stats=stats) == {1, 2}
+    assert stats.truncated and stats.iterations == 2
+    assert bfs_rpq(graph, regex, {0}, stop_when_found=(0, 4)) == {4}
+    assert len(bfs_rpq(graph, regex, {0}, stop_when_found=3)) == 3
+    assert bfs_rpq(
+        graph, regex, {0, 3}, for_each_node=True, chunk_size=1, stop_when_found=2
+    ) == {(State(0), 1), (State(0), 2)}
+    assert bfs_rpq(
+        graph, regex, {0, 3}, for_each_node=True, chunk_size=1, max_path_length=1
+    ) == {(State(0), 1), (State(1), 4)}
+    with pytest.raises(ValueError):
+        bfs_rpq(graph, regex, for_each_node=True, workers=2, stop_when_found="any")
@@ -0,0 +1,69 @@
+import time
+
+from pyformlang.regular_expression import Regex
+from scipy.sparse import block_diag, csr_matrix, lil_matrix, vstack
+
+from project.bfs_rpq import create_bfs_front, normalize_front
+from project.finite_automata_tools import regex_to_dfa
+from project.graph_module import generate_two_cycles_graph
+from project.rpq import FABooleanDecomposition, decompose_automaton, decompose_graph
+
+
+def reference_normalize_front(regex_bin_dec: FABooleanDecomposition, front):
+    # element-wise implementation used before vectorization
+    res = lil_matrix(front.shape, dtype=bool)
+    for i, j in zip(*front.nonzero()):
+        if front[
+            i, len(regex_bin_dec.states_to_index) :
+        ].count_nonzero() > 0 and j < len(regex_bin_dec.states_to_index):
+            node_number = i // len(regex_bin_dec.states_to_index)
+            res[node_number * len(regex_bin_dec.states_to_index) + j, j] = True
+            res[
+                node_number * len(regex_bin_dec.states_to_index) + j,
+                len(regex_bin_dec.states_to_index) :,
+            ] += front[i, len(regex_bin_dec.states_to_index) :]
+    return res.tocsr()
+
+
+def test_normalize_front_benchmark():
+    graph_dec = decompose_graph(generate_two_cycles_graph(60, 40, ("a", "b")))
+    regex_dec = decompose_automaton(regex_to_dfa(Regex("(a|b)*.a.b*")))
+    starts = sorted(graph_dec.states_to_index.values())[:20]
+    front = vstack(
+        [
+            create_bfs_front(len(graph_dec.states_to_index), regex_dec, [index])
+            for index in starts
+        ]
+    ).tocsr()
+    direct_sums = [
+        block_diag(
+            (regex_dec.decomposition[label], graph_dec.decomposition[label])
+        ).tocsr()
+        for label in regex_dec.decomposition.keys() & graph_dec.decomposition.keys()
+    ]
+
+    reference_time = 0.0
+    vectorized_time = 0.0
+    steps = 0
+    for _ in range(5):
+        next_front = csr_matrix(front.shape, dtype=bool)
+        for direct_sum in direct_sums:
+            renewed_front = front @ direct_sum
+
+            begin = time.perf_counter()
+            expected = reference_normalize_front(regex_dec, renewed_front)
+            reference_time += time.perf_counter() - begin
+
+            begin = time.perf_counter()
+            actual = normalize_front(regex_dec, renewed_front)
+            vectorized_time += time.perf_counter() - begin
+
+            assert (actual != expected).nnz == 0
+            next_front += actual
+            steps += 1
+        front = next_front
+
+    print(
+        f"\nnormalize_front per step: reference {reference_time / steps * 1000:.3f} ms,"
+        f" vectorized {vectorized_time / steps * 1000:.3f} ms"
+    )
@@ -0,0 +1,71 @@
+import time
+from typing import Tuple
+
+import cfpq_data
+import numpy as np
+from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix, kron
+
+from project.graph_matrices import LabeledGraphMatrices
+from project.rpq import boolean_closure, compile_regex, product_matrix
+
+
+def matrix_bytes(matrix: csr_matrix) -> int:
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def float_product_matrix(graph_matrices, regex_decomposition) -> csr_matrix:
+    # product matrix as it was built before the boolean layer: float64 sum of integer kron products
+    regex_n = len(regex_decomposition.states_to_index)
+    n = graph_matrices.nodes_num * regex_n
+    matrix = csr_matrix((n, n))
+    for label in graph_matrices.matrices.keys() & regex_decomposition.decomposition:
+        matrix = matrix + kron(
+            graph_matrices.matrices[label].astype(np.int64),
+            regex_decomposition.decomposition[label].astype(np.int64),
+            format="csr",
+        )
+    return matrix
+
+
+def float_closure(matrix: csr_matrix) -> Tuple[csr_matrix, int]:
+    # closure as it was computed before the boolean layer, returns it with the peak bytes of its iterations
+    matrix = matrix.copy()
+    peak_bytes = matrix_bytes(matrix)
+    prev = -1
+    while prev != matrix.nnz:
+        prev = matrix.nnz
+        squared = matrix @ matrix
+        peak_bytes = max(peak_bytes, matrix_bytes(matrix) + matrix_bytes(squared))
+        matrix += squared
+    return matrix, peak_bytes
+
+
+def test_bool_dtype_memory_benchmark():
+    graph = cfpq_data.labeled_binomial_graph(300, 0.01, labels=("a", "b"), seed=42)
+    graph_matrices = LabeledGraphMatrices.from_graph(graph)
+    regex_decomposition = compile_regex(Regex("a*.b.(a|b)*")).decomposition
+
+    bool_product = product_matrix(graph_matrices, regex_decomposition)
+    float_product = float_product_matrix(graph_matrices, regex_decomposition)
+    assert bool_product.dtype == bool
+    assert float_product.dtype == np.float64
+    assert (bool_product != (float_product != 0)).nnz == 0
+
+    begin = time.perf_counter()
+    closure = boolean_closure(bool_product)
+    bool_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    reference, reference_peak = float_closure(float_product)
+    float_time = time.perf_counter() - begin
+
+    assert closure.dtype == bool
+    assert (closure != (reference != 0)).nnz == 0
+    # float64 entries count paths instead of saturating
+    assert reference.data.max() > 1
+    assert matrix_bytes(reference) > matrix_bytes(closure)
+    print(
+        f"\nproduct matrix: float64 {matrix_bytes(float_product)} B, bool {matrix_bytes(bool_product)} B;"
+        f" closure: float64 {matrix_bytes(reference)} B (peak {reference_peak} B, {float_time:.3f} s),"
+        f" bool {matrix_bytes(closure)} B ({bool_time:.3f} s)"
+    )
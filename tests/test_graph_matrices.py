@@ -0,0 +1,149 @@
+import numpy as np
+from networkx import MultiDiGraph
+from pyformlang.cfg import CFG
+from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix
+
+from project.bfs_rpq import bfs_rpq
+from project.graph_matrices import LabeledGraphMatrices, to_bool_csr
+from project.rpq import rpq
+from project.task_10 import cfpq_tensors
+from project.task_8 import cfpq_hellings
+from project.task_9 import cfpq_matrices
+
+
+def build_graph() -> MultiDiGraph:
+    graph = MultiDiGraph()
+    graph.add_edges_from(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 3, {"label": "b"}),
+            (3, 4, {"label": "b"}),
+            (4, 5, {}),
+        ]
+    )
+    return graph
+
+
+def test_from_graph():
+    graph = build_graph()
+    matrices = LabeledGraphMatrices.from_graph(graph, {0}, {3, 4})
+    assert matrices.nodes == [0, 1, 2, 3, 4, 5]
+    assert matrices.labels == {"a", "b"}
+    assert matrices.matrices["a"].dtype == bool
+    assert matrices.matrices["a"].nnz == 2
+    assert matrices.start_nodes() == {0}
+    assert matrices.final_nodes() == {3, 4}
+    assert all("is_start" not in data for _, data in graph.nodes(data=True))
+
+
+def test_from_edges():
+    matrices = LabeledGraphMatrices.from_edges(
+        [("x", "a", "y"), ("y", "b", "z"), ("x", "a", "y")]
+    )
+    assert matrices.nodes == ["x", "y", "z"]
+    assert matrices.matrices["a"].nnz == 1
+    assert matrices.start_nodes() == {"x", "y", "z"}
+    assert matrices.final_nodes() == {"x", "y", "z"}
+
+
+def test_epsilon_edges():
+    graph = MultiDiGraph()
+    graph.add_edges_from(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "epsilon"}),
+            (2, 3, {"label": "b"}),
+            (3, 4, {"label": "epsilon"}),
+        ]
+    )
+    matrices = LabeledGraphMatrices.from_graph(graph, {1}, {4})
+    assert matrices.labels == {"a", "b"}
+    assert matrices.start_nodes() == {1, 2}
+    assert matrices.final_nodes() == {3, 4}
+    assert rpq(graph, Regex("a.b"), {0}, {3}) == {(0, 3)}
+    assert bfs_rpq(graph, Regex("a.b"), {0}, {3}) == {3}
+    # 3 becomes final since its epsilon closure has the final node 4
+    assert rpq(graph, Regex("a.b"), {0}, {4}) == {(0, 3)}
+    cfg = CFG.from_text("S -> a b")
+    assert cfpq_matrices(graph, cfg) == cfpq_tensors(graph, cfg) == {(0, 3)}
+    # start and final nodes given later go through the same epsilon closure
+    for matrices in (
+        LabeledGraphMatrices.from_graph(graph),
+        LabeledGraphMatrices.from_graph(graph).subgraph(np.arange(1, 5)),
+    ):
+        for start, final in (({0}, {4}), ({1}, {3}), ({1}, {4})):
+            assert rpq(matrices, Regex("b"), start, final) == rpq(
+                graph, Regex("b"), start, final
+            )
+    matrices = LabeledGraphMatrices.from_graph(graph)
+    assert rpq(matrices, Regex("a.b"), {0}, {4}) == {(0, 3)}
+    assert bfs_rpq(matrices, Regex("a.b"), {0}, {4}) == {3}
+    assert matrices.with_start_final({1}, {4}).start_nodes() == {1, 2}
+
+
+def test_rpq_engines_accept_matrices():
+    graph = build_graph()
+    matrices = LabeledGraphMatrices.from_graph(graph)
+    regex = Regex("a*.b")
+    assert rpq(matrices, regex, {0}, {3}) == rpq(graph, regex, {0}, {3}) == {(0, 3)}
+    assert bfs_rpq(matrices, regex, {0}) == bfs_rpq(graph, regex, {0}) == {3}
+    assert rpq(matrices.with_start_final({1}, {3, 4}), regex) == {(1, 3)}
+
+
+def test_cfpq_engines_accept_matrices():
+    graph = build_graph()
+    matrices = LabeledGraphMatrices.from_graph(graph)
+    cfg = CFG.from_text("S -> a S b | a b")
+    assert cfpq_matrices(matrices, cfg) == cfpq_matrices(graph, cfg)
+    assert cfpq_tensors(matrices, cfg) == cfpq_tensors(graph, cfg) == {(0, 4), (1, 3)}
+
+
+def test_output_formats():
+    graph = build_graph()
+    cfg = CFG.from_text("S -> a S b | a b")
+    for cfpq in [cfpq_hellings, cfpq_matrices, cfpq_tensors]:
+        pairs = cfpq(graph, cfg, output="pairs")
+        assert pairs.shape == (2, 2)
+        assert {tuple(pair) for pair in pairs} == {(0, 4), (1, 3)}
+        matrix = cfpq(graph, cfg, output="matrix")
+        assert matrix.dtype == bool
+        assert set(zip(*matrix.nonzero())) == {(0, 4), (1, 3)}
+        assert cfpq(graph, cfg, start={1}, output="pairs").tolist() == [[1, 3]]
+        assert cfpq(graph, cfg, start=set()) == set()
+    pairs = rpq(graph, Regex("a*.b"), {0, 1}, output="pairs")
+    assert pairs.tolist() == [[0, 3], [1, 3]]
+    mixed = LabeledGraphMatrices.from_edges([(1, "a", "x"), ("x", "b", 2.5)])
+    pairs = rpq(mixed, Regex("a|b"), output="pairs")
+    assert pairs.dtype == object
+    assert pairs.tolist() == [[1, "x"], ["x", 2.5]]
+    assert mixed.nodes_array.tolist() == [1, "x", 2.5]
+    assert rpq(
+        LabeledGraphMatrices.from_edges([((0, 1), "a", (1, 2))]),
+        Regex("a"),
+        output="pairs",
+    ).tolist() == [[(0, 1), (1, 2)]]
+
+
+def test_matrices_are_boolean():
+    weighted = csr_matrix(([2.0, 0.0], ([0, 1], [1, 0])), shape=(2, 2))
+    assert to_bool_csr(weighted).dtype == bool
+    assert to_bool_csr(weighted).nnz == 1
+    matrices = LabeledGraphMatrices([0, 1], {0: 0, 1: 1}, {"a": weighted})
+    assert matrices.matrices["a"].dtype == bool
+    assert rpq(matrices, Regex("a"), {0}) == {(0, 1)}
+
+
+def test_incident_mask_and_subgraph():
+    matrices = LabeledGraphMatrices.from_edges(
+        [(0, "a", 1), (1, "b", 2), (3, "c", 4)], start_nodes={0, 3}
+    )
+    assert matrices.incident_mask({"a", "x"}).tolist() == [1, 1, 0, 0, 0]
+    assert matrices.with_start_final({1}).label_index is matrices.label_index
+    subgraph = matrices.subgraph([1, 2, 3], {"b", "c"})
+    assert subgraph.nodes == [1, 2, 3]
+    assert subgraph.labels == {"b", "c"}
+    assert subgraph.matrices["b"].nonzero()[0].tolist() == [0]
+    assert subgraph.matrices["c"].nnz == 0
+    assert subgraph.start_nodes() == {3}
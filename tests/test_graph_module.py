@@ -1,6 +1,12 @@
 import os
 
+import pytest
+from pyformlang.regular_expression import Regex
+
 from project import graph_module
+from project.bfs_rpq import bfs_rpq
+from project.graph_matrices import LabeledGraphMatrices
+from project.rpq import rpq
 
 
 def test_get_graph_metrics():
@@ -21,3 +27,68 @@ def test_save_graph():
     with open(expected_path, "r") as expected_file:
         with open(actual_path, "r") as actual_file:
             assert expected_file.read() == actual_file.read()
+
+
+def test_graph_cache(tmp_path):
+    graph = graph_module.generate_two_cycles_graph(3, 2, ("a", "b"))
+    matrices = LabeledGraphMatrices.from_graph(graph, {0}, {1, 2})
+    graph_module.save_graph_matrices(
+        matrices, graph_module.graph_cache_path("two_cycles", tmp_path)
+    )
+    # the graph is not a cfpq_data dataset, so it can only be served from the cache
+    loaded = graph_module.load_graph_matrices("two_cycles", tmp_path)
+    assert loaded.nodes == matrices.nodes
+    assert loaded.start_nodes() == {0}
+    assert loaded.final_nodes() == {1, 2}
+    assert loaded.labels == {"a", "b"}
+    for label in loaded.labels:
+        assert (loaded.matrices[label] != matrices.matrices[label]).nnz == 0
+
+
+def test_get_graph_keeps_parallel_edges(tmp_path):
+    entry = graph_module.graph_cache_path("parallel", tmp_path)
+    (entry.parent / (entry.name + ".csv")).write_text("0 1 a\n0 1 a\n1 2 b\n")
+    graph = graph_module.get_graph("parallel", tmp_path)
+    assert graph_module.get_graph_metrics(graph) == (3, 3, {"a", "b"})
+    matrices = graph_module.load_graph_matrices("parallel", tmp_path)
+    assert matrices.matrices["a"].nnz == 1
+
+
+def test_csv_to_graph_matrices(tmp_path):
+    csv_path = tmp_path / "graph.csv"
+    csv_path.write_text("0 1 a\n1 2 b\n0 1 a\n2 0 a\n1 0 b\n")
+    matrices = graph_module.csv_to_graph_matrices(
+        csv_path, tmp_path / "graph", chunk_size=2
+    )
+    assert matrices.nodes == [0, 1, 2]
+    assert matrices.labels == {"a", "b"}
+    assert set(zip(*matrices.matrices["a"].nonzero())) == {(0, 1), (2, 0)}
+    assert set(zip(*matrices.matrices["b"].nonzero())) == {(1, 2), (1, 0)}
+    assert rpq(matrices, Regex("a.b"), {0}) == {(0, 2), (0, 0)}
+    assert bfs_rpq(matrices, Regex("a.b"), {0}) == {0, 2}
+
+
+def test_csv_to_graph_matrices_keeps_na_names(tmp_path):
+    csv_path = tmp_path / "graph.csv"
+    csv_path.write_text("NA null a\nnull nan b\nnan x NA\n")
+    matrices = graph_module.csv_to_graph_matrices(
+        csv_path, tmp_path / "graph", chunk_size=2
+    )
+    assert matrices.nodes == ["NA", "null", "nan", "x"]
+    assert matrices.labels == {"a", "b", "NA"}
+    assert rpq(matrices, Regex("a.b")) == {("NA", "nan")}
+    for text in ["0 1 a\n1 2\n", "0 1 a\n1  b\n"]:
+        csv_path.write_text(text)
+        with pytest.raises(ValueError):
+            graph_module.csv_to_graph_matrices(csv_path, tmp_path / "bad")
+
+
+def test_csv_to_graph_matrices_folds_epsilon_edges(tmp_path):
+    csv_path = tmp_path / "graph.csv"
+    csv_path.write_text("0 1 a\n1 2 epsilon\n2 3 b\n3 4 epsilon\n")
+    matrices = graph_module.csv_to_graph_matrices(csv_path, tmp_path / "graph")
+    assert matrices.labels == {"a", "b"}
+    assert rpq(matrices, Regex("a.b"), {0}, {4}) == {(0, 3)}
+    graph_module.save_graph_matrices(matrices, tmp_path / "saved")
+    loaded = graph_module.read_graph_matrices(tmp_path / "saved")
+    assert rpq(loaded, Regex("a.b"), {0}, {4}) == {(0, 3)}
@@ -0,0 +1,53 @@
+import pytest
+from pyformlang.regular_expression import Regex
+
+from project.bfs_rpq import bfs_rpq
+from project.graph_matrices import LabeledGraphMatrices
+from project.rpq import rpq
+
+
+def build_matrices() -> LabeledGraphMatrices:
+    return LabeledGraphMatrices.from_edges(
+        [
+            (0, "a", 1),
+            (1, "a", 2),
+            (2, "b", 3),
+            (0, "a", 4),
+            (4, "b", 3),
+            (3, "a", 0),
+        ]
+    )
+
+
+def test_rpq_witnesses():
+    matrices = build_matrices()
+    regex = Regex("a*.b")
+    witnesses = rpq(matrices, regex, output="witnesses")
+    assert set(witnesses) == rpq(matrices, regex)
+    assert witnesses.result() == rpq(matrices, regex, output="result")
+    assert witnesses.path(0, 3) == [(0, "a", 4), (4, "b", 3)]
+    assert witnesses.path(1, 3) == [(1, "a", 2), (2, "b", 3)]
+    assert witnesses.path(3, 3) == [(3, "a", 0), (0, "a", 4), (4, "b", 3)]
+    assert witnesses.path(3, 4) is None
+    assert (3, 4) not in witnesses
+    assert witnesses.parents.dtype == witnesses.entry_nodes.dtype == "int32"
+
+
+def test_witness_cycles():
+    matrices = build_matrices()
+    witnesses = rpq(matrices, Regex("(a.a.b.a)|(a.b.a)"), {0}, output="witnesses")
+    assert dict(witnesses.paths()) == {
+        (0, 0): [(0, "a", 4), (4, "b", 3), (3, "a", 0)],
+    }
+
+
+def test_bfs_rpq_witnesses():
+    matrices = build_matrices()
+    regex = Regex("a*.b")
+    witnesses = bfs_rpq(matrices, regex, {0, 1}, for_each_node=True, output="witnesses")
+    assert witnesses.result() == bfs_rpq(
+        matrices, regex, {0, 1}, for_each_node=True, output="result"
+    )
+    assert len(witnesses.path(1, 3)) == 2
+    with pytest.raises(ValueError):
+        bfs_rpq(matrices, regex, {0}, output="witnesses")
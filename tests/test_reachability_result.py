@@ -0,0 +1,59 @@
+import numpy as np
+from pyformlang.cfg import CFG
+from pyformlang.regular_expression import Regex
+
+from project.bfs_rpq import bfs_rpq
+from project.graph_matrices import LabeledGraphMatrices
+from project.graph_module import generate_two_cycles_graph
+from project.reachability_result import ReachabilityResult, nodes_array
+from project.rpq import rpq
+from project.task_10 import cfpq_tensors
+from project.task_8 import cfpq_hellings
+from project.task_9 import cfpq_matrices
+
+
+def test_set_operations():
+    nodes = ["x", "y", "z"]
+    first = ReachabilityResult(nodes, np.array([0, 0, 1, 0]), np.array([1, 2, 2, 1]))
+    second = ReachabilityResult(nodes, np.array([1, 2]), np.array([2, 0]))
+    assert first.sources.dtype == np.int32
+    assert len(first) == 3
+    assert ("x", "y") in first
+    assert ("y", "x") not in first
+    assert ("w", "x") not in first
+    assert list(first) == [("x", "y"), ("x", "z"), ("y", "z")]
+    assert (first & second) == {("y", "z")}
+    assert (first | second) == {("x", "y"), ("x", "z"), ("y", "z"), ("z", "x")}
+    assert (first - second).to_set() == {("x", "y"), ("x", "z")}
+    assert first.filter(sources={"x"}, targets={"z"}) == {("x", "z")}
+    assert first.filter(targets=set()) == set()
+    assert ReachabilityResult.from_matrix(nodes, first.to_matrix()) == first
+
+
+def test_entry_points():
+    graph = generate_two_cycles_graph(3, 2, ("a", "b"))
+    regex = Regex("a*.b")
+    expected = rpq(graph, regex)
+    result = rpq(graph, regex, output="result")
+    assert isinstance(result, ReachabilityResult)
+    assert result == expected
+    assert bfs_rpq(graph, regex, for_each_node=True, output="result") == expected
+    cfg = CFG.from_text("S -> a S b | a b")
+    for cfpq in [cfpq_hellings, cfpq_matrices, cfpq_tensors]:
+        assert cfpq(graph, cfg, output="result") == cfpq(graph, cfg)
+
+
+def test_mixed_node_types():
+    graph = LabeledGraphMatrices.from_edges(
+        [(1, "a", "x"), ("x", "b", 2.5), ((0, 1), "a", 1)]
+    )
+    result = rpq(graph, Regex("a.b|a"), output="result")
+    assert result == {(1, "x"), (1, 2.5), ((0, 1), 1)}
+    assert (1, "x") in result and ("1", "x") not in result
+    assert result.filter(sources={(0, 1)}) == {((0, 1), 1)}
+    pairs = result.to_pairs()
+    assert pairs.dtype == object
+    assert pairs.tolist() == [[1, "x"], [1, 2.5], [(0, 1), 1]]
+    assert (result - rpq(graph, Regex("a"), output="result")).to_set() == {(1, 2.5)}
+    assert nodes_array([1, 2**70]).dtype == object
+    assert nodes_array([1, 2]).dtype.kind == "i"
@@ -1,8 +1,27 @@
+import time
+
+import numpy as np
+import pytest
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, Symbol, State
 from pyformlang.regular_expression import Regex
+from scipy.sparse import csr_matrix
 
 from project.finite_automata_tools import regex_to_dfa
-from project.rpq import fa_intersection, rpq
+from project.graph_matrices import LabeledGraphMatrices
+from project.parser.interpreter.automations import Automation
+from project.parser.interpreter.set import Set
+from project.parser.interpreter.tuples import Pair
+from project.query_stats import QueryStats
+from project.rpq import (
+    BIDIRECTIONAL_MAX_DEPTH,
+    RegexCache,
+    boolean_closure,
+    decompose_automaton,
+    fa_intersection,
+    prune_graph,
+    rpq,
+    transitive_closure,
+)
 
 
 def test_fa_intersect():
@@ -74,6 +93,22 @@ def test_automata_intersection2():
     assert intersection.accepts([Symbol("b"), Symbol("c"), Symbol("b")])
 
 
+def test_automata_intersection_reachable_only():
+    automaton1 = regex_to_dfa(Regex("a.b.b"))
+    automaton2 = regex_to_dfa(Regex("b*.a.b*"))
+    full = fa_intersection(automaton1, automaton2)
+    pruned = fa_intersection(automaton1, automaton2, reachable_only=True)
+    assert pruned.is_equivalent_to(full)
+    assert len(pruned.states) < len(full.states)
+    assert pruned.accepts([Symbol("a"), Symbol("b"), Symbol("b")])
+    assert not pruned.accepts([Symbol("b"), Symbol("a"), Symbol("b")])
+
+
+def test_automation_intersect_reachable():
+    intersection = Automation.from_str("a*.b").intersect(Automation.from_str("a.b|c"))
+    assert intersection.get_reachable() == Set({Pair("0;2;3;4;2;3;4;5", "1")})
+
+
 def test_rpq1():
     automaton = NondeterministicFiniteAutomaton()
     automaton.add_transition(State(0), Symbol("a"), State(1))
@@ -108,3 +143,208 @@ def test_rpq3():
     assert rpq(
         graph, Regex("(a.b.c.d.e)|(a.b.c.d)|(a.b.c)|(a.b)|(a)"), {0}, {5, 4, 3, 2, 1}
     ) == {(0, 5), (0, 4), (0, 3), (0, 2), (0, 1)}
+
+
+def test_rpq_lazy():
+    automaton = NondeterministicFiniteAutomaton()
+    automaton.add_transition(State(0), Symbol("a"), State(1))
+    automaton.add_transition(State(1), Symbol("b"), State(2))
+    automaton.add_transition(State(2), Symbol("c"), State(3))
+    automaton.add_transition(State(0), Symbol("a"), State(4))
+    automaton.add_transition(State(4), Symbol("d"), State(5))
+    automaton.add_transition(State(5), Symbol("a"), State(0))
+    graph = automaton.to_networkx()
+    regex = Regex("(a.b.c)|(a.d)*")
+    stats = QueryStats()
+    assert rpq(graph, regex, {0}, mode="lazy", stats=stats) == rpq(graph, regex, {0})
+    assert rpq(graph, regex, mode="lazy") == rpq(graph, regex)
+    assert stats.iterations > 0
+    assert 0 < stats.visited_states < len(graph.nodes) * 4
+    assert stats.peak_memory_bytes > 0
+
+
+def test_boolean_closure_strategies():
+    matrix = csr_matrix(
+        (
+            [1, 1, 1, 1, 1],
+            ([0, 1, 2, 3, 4], [1, 2, 0, 4, 4]),
+        ),
+        shape=(6, 6),
+    )
+    expected = {(i, j) for i in range(3) for j in range(3)} | {(3, 4), (4, 4)}
+    for strategy in ["squaring", "linear", "auto"]:
+        closure = boolean_closure(matrix, strategy)
+        assert closure.dtype == bool
+        assert set(zip(*closure.nonzero())) == expected
+    assert matrix.nnz == 5
+    assert set(transitive_closure(matrix)) == expected
+
+
+def test_rpq_modes():
+    automaton = NondeterministicFiniteAutomaton()
+    automaton.add_transition(State(0), Symbol("a"), State(1))
+    automaton.add_transition(State(1), Symbol("b"), State(2))
+    automaton.add_transition(State(2), Symbol("a"), State(0))
+    automaton.add_transition(State(2), Symbol("c"), State(3))
+    automaton.add_transition(State(3), Symbol("b"), State(4))
+    graph = automaton.to_networkx()
+    regex = Regex("(a.b)*.c")
+    for start, final in [({0}, None), ({0, 1, 2}, {3}), (None, None)]:
+        expected = rpq(graph, regex, start, final, mode="closure")
+        assert rpq(graph, regex, start, final, mode="sources") == expected
+        assert rpq(graph, regex, start, final, mode="lazy") == expected
+        assert rpq(graph, regex, start, final) == expected
+    assert rpq(graph, regex, {0}) == {(0, 3)}
+
+
+def test_regex_cache():
+    cache = RegexCache(max_size=2)
+    first = cache.get("a*.b")
+    assert cache.get(Regex("(a)* . b")) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.get("a")
+    cache.get("a*.b")
+    cache.get("b")
+    assert len(cache) == 2
+    assert "a" not in cache and "a*.b" in cache
+    cache.invalidate("a*.b")
+    assert "a*.b" not in cache
+    cache.invalidate()
+    assert len(cache) == 0 and cache.hits == 0
+    assert first.dfa.is_equivalent_to(Regex("a*.b").to_epsilon_nfa())
+
+
+def test_decompose_automaton():
+    nfa = NondeterministicFiniteAutomaton()
+    nfa.add_transitions([(2, "a", 0), (0, "b", 1), (0, "a", 1), (1, "a", 2)])
+    nfa.add_start_state(State(2))
+    nfa.add_final_state(State(1))
+    decomposition = decompose_automaton(nfa)
+    assert decomposition.states_to_index == {0: 0, 1: 1, 2: 2}
+    assert decomposition.start_states == {State(2)}
+    assert decomposition.final_states == {State(1)}
+    assert decomposition.decomposition["a"].dtype == bool
+    assert decomposition.decomposition["a"].toarray().tolist() == [
+        [False, True, False],
+        [False, False, True],
+        [True, False, False],
+    ]
+    assert decomposition.decomposition["b"].nnz == 1
+    assert len(nfa.start_states) == 1
+
+
+def test_prune_graph():
+    matrices = LabeledGraphMatrices.from_edges(
+        [(0, "a", 1), (1, "b", 2), (2, "c", 3), (4, "a", 5), (6, "b", 0)],
+        start_nodes={0, 7},
+        nodes=range(8),
+    )
+    pruned, kept = prune_graph(matrices, {"a", "b"})
+    assert pruned.nodes == [0, 1, 2, 7]
+    assert kept.tolist() == [0, 1, 2, 7]
+    assert pruned.labels == {"a", "b"}
+    regex = Regex("a.b")
+    assert rpq(matrices, regex, {0}) == rpq(matrices, regex, {0}, prune=False)
+    assert rpq(matrices, regex, {0}, output="matrix").nonzero()[1].tolist() == [2]
+
+
+def test_rpq_bidirectional():
+    matrices = LabeledGraphMatrices.from_edges(
+        [(0, "a", 1), (1, "a", 2), (2, "b", 3), (3, "b", 0), (1, "b", 4)]
+    )
+    regex = Regex("a*.b")
+    for start, final in [({0}, {3}), ({0, 1}, {3, 4}), ({3}, {0, 4}), ({4}, {0})]:
+        stats = QueryStats()
+        expected = rpq(matrices, regex, start, final, mode="closure")
+        assert (
+            rpq(matrices, regex, start, final, mode="bidirectional", stats=stats)
+            == expected
+        )
+        assert rpq(matrices, regex, start, final) == expected
+    assert matrices.transposed_matrices.keys() == {"a", "b"}
+    assert rpq(matrices, Regex("a.a.b"), {0}, {3}, mode="bidirectional") == {(0, 3)}
+
+
+def test_rpq_limits():
+    matrices = LabeledGraphMatrices.from_edges(
+        [(0, "a", 1), (1, "a", 2), (2, "a", 3), (3, "b", 4)]
+    )
+    regex = Regex("a*.b")
+    for mode in ["closure", "sources", "lazy", "bidirectional"]:
+        stats = QueryStats()
+        assert rpq(matrices, regex, mode=mode, max_path_length=2, stats=stats) == {
+            (2, 4),
+            (3, 4),
+        }
+        assert stats.truncated
+        assert rpq(matrices, regex, mode=mode, max_path_length=4) == rpq(
+            matrices, regex, mode=mode
+        )
+    for mode in ["sources", "lazy", "bidirectional"]:
+        stats = QueryStats()
+        assert rpq(
+            matrices, regex, {0}, mode=mode, stop_when_found=(0, 4), stats=stats
+        ) == {(0, 4)}
+        assert len(rpq(matrices, regex, mode=mode, stop_when_found="any")) == 1
+        assert rpq(matrices, regex, mode=mode, stop_when_found=2) < rpq(matrices, regex)
+    stats = QueryStats()
+    rpq(matrices, Regex("a*"), {0}, mode="lazy", stop_when_found="any", stats=stats)
+    assert stats.truncated and stats.iterations == 1 and stats.frontier_size == 1
+    witnesses = rpq(matrices, regex, output="witnesses", stop_when_found=1)
+    assert dict(witnesses.paths()) == {(3, 4): [(3, "b", 4)]}
+    assert transitive_closure(matrices.matrices["a"], max_path_length=1) == [
+        (0, 1),
+        (1, 2),
+        (2, 3),
+    ]
+    with pytest.raises(ValueError):
+        rpq(matrices, regex, mode="closure", stop_when_found="any")
+    with pytest.raises(ValueError):
+        rpq(matrices, regex, stop_when_found="all")
+
+
+def test_rpq_searches_on_random_graphs():
+    random = np.random.default_rng(7)
+    for _ in range(20):
+        edges = [
+            (int(u), str(label), int(v))
+            for u, label, v in zip(
+                random.integers(0, 12, 30),
+                random.choice(["a", "b"], 30),
+                random.integers(0, 12, 30),
+            )
+        ]
+        matrices = LabeledGraphMatrices.from_edges(edges)
+        start = set(random.choice(12, 3, replace=False).tolist())
+        final = set(random.choice(12, 4, replace=False).tolist())
+        for regex in [Regex("a*.b"), Regex("(a|b)*.a.b*")]:
+            expected = rpq(matrices, regex, start, final, mode="closure")
+            for mode in ["lazy", "bidirectional"]:
+                assert rpq(matrices, regex, start, final, mode=mode) == expected
+            witnesses = rpq(matrices, regex, start, final, output="witnesses")
+            assert set(dict(witnesses.paths())) == expected
+
+
+@pytest.mark.parametrize("mode", ["lazy", "bidirectional"])
+def test_rpq_searches_scale_on_long_chains(mode):
+    # a chain of length n takes n levels, so a visited set rebuilt on every level makes the search quadratic
+    timings = []
+    for n in (1000, 8000):
+        matrices = LabeledGraphMatrices.from_edges([(i, "a", i + 1) for i in range(n)])
+        begin = time.perf_counter()
+        assert rpq(matrices, Regex("a*"), {0}, {n}, mode=mode) == {(0, n)}
+        timings.append(time.perf_counter() - begin)
+    assert timings[1] < 16 * timings[0]
+
+
+def test_rpq_auto_leaves_deep_searches_to_sources():
+    matrices = LabeledGraphMatrices.from_edges([(i, "a", i + 1) for i in range(100)])
+    expected = rpq(matrices, Regex("a*"), {0}, {100}, mode="sources")
+    stats = QueryStats()
+    assert rpq(matrices, Regex("a*"), {0}, {100}, stats=stats) == expected
+    assert stats.iterations > BIDIRECTIONAL_MAX_DEPTH and not stats.truncated
+    stats = QueryStats()
+    assert rpq(matrices, Regex("a*"), {0}, {10}, stats=stats) == {(0, 10)}
+    assert stats.iterations <= BIDIRECTIONAL_MAX_DEPTH
+    assert rpq(matrices, Regex("a*"), {0}, {100}, stop_when_found="any") == expected
+    assert rpq(matrices, Regex("a*"), {0}, {100}, max_path_length=50) == set()
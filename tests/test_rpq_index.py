@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from pyformlang.regular_expression import Regex
+
+from project.graph_matrices import LabeledGraphMatrices
+from project.rpq import rpq
+from project.rpq_index import RPQIndex
+
+
+def test_rpq_index_updates():
+    edges = [(0, "a", 1), (1, "b", 2)]
+    index = RPQIndex(LabeledGraphMatrices.from_edges(edges), Regex("a*.b"))
+    assert index.result() == {(0, 2), (1, 2)}
+    assert index.add_edge(2, "b", 3) == {(2, 3)}
+    assert index.add_edges([(3, "a", 0), (4, "a", 3)]) == {(3, 2), (4, 2)}
+    assert index.remove_edge(1, "b", 2) == {(0, 2), (1, 2), (3, 2), (4, 2)}
+    assert index.result() == {(2, 3)}
+    assert index.remove_edges([(1, "b", 2), ("x", "a", 0)]) == set()
+    assert index.result(output="pairs").tolist() == [[2, 3]]
+
+
+def test_rpq_index_parallel_labels():
+    edges = [(0, "a", 1), (0, "b", 1)]
+    index = RPQIndex(LabeledGraphMatrices.from_edges(edges), Regex("(a|b)*"))
+    assert index.remove_edge(0, "a", 1) == set()
+    assert index.remove_edge(0, "b", 1) == {(0, 1)}
+
+
+def test_rpq_index_matches_rpq():
+    random.seed(7)
+    for regex in [Regex("a*.b"), Regex("(a|b)*.c"), Regex("a.b.a")]:
+        edges = {
+            (random.randrange(10), random.choice("abc"), random.randrange(10))
+            for _ in range(20)
+        }
+        index = RPQIndex(
+            LabeledGraphMatrices.from_edges(sorted(edges)), regex, {0, 1, 2}
+        )
+        for _ in range(10):
+            batch = [
+                (random.randrange(12), random.choice("abc"), random.randrange(12))
+                for _ in range(3)
+            ]
+            if random.random() < 0.5:
+                index.add_edges(batch)
+                edges |= set(batch)
+            else:
+                batch += random.sample(sorted(edges), min(3, len(edges)))
+                index.remove_edges(batch)
+                edges -= set(batch)
+            graph = LabeledGraphMatrices.from_edges(sorted(edges), nodes=index.nodes)
+            assert index.result() == rpq(graph, regex, {0, 1, 2}, mode="closure")
+
+
+def test_rpq_index_rejects_epsilon_edges():
+    index = RPQIndex(LabeledGraphMatrices.from_edges([(0, "a", 1)]), Regex("a"))
+    with pytest.raises(ValueError):
+        index.add_edge(1, "epsilon", 0)
+
+
+def test_rpq_index_folds_added_edges_through_epsilon_closure():
+    graph = LabeledGraphMatrices.from_edges(
+        [(0, "a", 1), (1, "epsilon", 2), (3, "epsilon", 4)]
+    )
+    index = RPQIndex(graph, Regex("a.b"), {0}, {4})
+    assert index.result() == rpq(graph, Regex("a.b"), {0}, {4}) == set()
+    assert index.add_edge(2, "b", 3) == {(0, 3)}
+    with pytest.raises(ValueError):
+        index.remove_edge(2, "b", 3)
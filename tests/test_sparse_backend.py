@@ -0,0 +1,34 @@
+import pytest
+from pyformlang.cfg import CFG
+from pyformlang.regular_expression import Regex
+
+from project.bfs_rpq import bfs_rpq
+from project.graph_module import generate_two_cycles_graph
+from project.rpq import rpq
+from project.sparse_backend import BACKENDS, SPARSE_BACKEND_ENV, get_backend
+from project.task_10 import cfpq_tensors
+from project.task_9 import cfpq_matrices
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+def test_backends_agree(backend):
+    graph = generate_two_cycles_graph(3, 2, ("a", "b"))
+    regex = Regex("a*.b")
+    expected = rpq(graph, regex, mode="lazy")
+    assert rpq(graph, regex, mode="closure", backend=backend) == expected
+    assert rpq(graph, regex, {0}, mode="sources", backend=backend) == {
+        pair for pair in expected if pair[0] == 0
+    }
+    assert bfs_rpq(graph, regex, {0}, backend=backend) == bfs_rpq(graph, regex, {0})
+    cfg = CFG.from_text("S -> a S b | a b")
+    assert cfpq_matrices(graph, cfg, backend=backend) == cfpq_matrices(graph, cfg)
+    assert cfpq_tensors(graph, cfg, backend=backend) == cfpq_tensors(graph, cfg)
+
+
+def test_backend_selection(monkeypatch):
+    assert get_backend().name == "scipy"
+    monkeypatch.setenv(SPARSE_BACKEND_ENV, "packed")
+    assert get_backend().name == "packed"
+    assert get_backend("scipy").name == "scipy"
+    with pytest.raises(ValueError):
+        get_backend("unknown")
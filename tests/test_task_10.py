@@ -1,6 +1,7 @@
 from networkx import MultiDiGraph
 from pyformlang.cfg import CFG
 
+from project.query_stats import QueryStats
 from project.task_10 import cfpq_tensors
 
 
@@ -77,3 +78,20 @@ def test_3():
         (0, 6),
         (1, 10),
     }
+
+
+def test_incremental_closure():
+    text = """
+    S -> a S b | a b
+    """
+    cfg = CFG.from_text(text)
+    graph = MultiDiGraph()
+    graph.add_edges_from(
+        [(i, i + 1, {"label": "a"}) for i in range(5)]
+        + [(i, i + 1, {"label": "b"}) for i in range(5, 10)]
+    )
+    stats = QueryStats()
+    assert cfpq_tensors(graph, cfg, stats=stats) == {
+        (5 - i, 5 + i) for i in range(1, 6)
+    }
+    assert stats.iterations > 0
@@ -78,3 +78,26 @@ def test_3():
         (0, 6),
         (1, 10),
     }
+
+
+def test_cycle_with_epsilon():
+    text = """
+    S -> a S b | $
+    """
+    cfg = CFG.from_text(text)
+    graph = MultiDiGraph()
+    graph.add_edges_from(
+        [
+            ("x", "y", {"label": "a"}),
+            ("y", "x", {"label": "a"}),
+            ("x", "z", {"label": "b"}),
+        ]
+    )
+    facts = hellings(cfg, graph)
+    assert len(facts) == len(set(facts))
+    assert cfpq_hellings(graph, cfg) == {
+        ("x", "x"),
+        ("y", "y"),
+        ("z", "z"),
+        ("y", "z"),
+    }
@@ -1,6 +1,7 @@
 from networkx import MultiDiGraph
 from pyformlang.cfg import CFG
 
+from project.query_stats import QueryStats
 from project.task_9 import cfpq_matrices
 
 
@@ -77,3 +78,21 @@ def test_3():
         (0, 6),
         (1, 10),
     }
+
+
+def test_stats():
+    text = """
+    S -> a S b | a b
+    """
+    cfg = CFG.from_text(text)
+    graph = MultiDiGraph()
+    graph.add_edges_from(
+        [(i, i + 1, {"label": "a"}) for i in range(5)]
+        + [(i, i + 1, {"label": "b"}) for i in range(5, 10)]
+    )
+    stats = QueryStats()
+    assert cfpq_matrices(graph, cfg, stats=stats) == {
+        (5 - i, 5 + i) for i in range(1, 6)
+    }
+    assert stats.iterations >= 5
+    assert stats.elapsed_seconds > 0